@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Сквозной бенчмарк сценариев бота: /track, /status, /measurements и добавление измерения
+
+Обновления проходят через настоящий диспетчер и роутер bot.py (middleware,
+FSM в SQLite, очередь записи), Google Sheets и Telegram заменены
+поддельными клиентами в памяти. Все пользователи выполняют сценарий
+одновременно, каждый - последовательно, как в переписке.
+
+Запуск: python benchmarks/bench_bot_flows.py [--users 1,100,10000] [--max-calls-per-entry 3]
+
+Сверх ответов бот делает запросы к Sheets: на каждую запись /track - не
+больше --max-calls-per-entry (первая запись в таблицу: листы, схема
+одним batchGet и values.append; следующие - только values.append,
+строка собирается по закэшированной схеме). Если запросов
+больше, какой-то сценарий не прошел проверку или обработчик упал, скрипт
+завершается с кодом 1.
+"""
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+
+from harness import BotHarness, TRACK_ANSWERS, percentile
+
+from fake_telegram import make_message_update, make_callback_update
+
+NEW_MEASUREMENT = "Бенчмарк"
+
+
+def track_flow(user_id: int) -> list:
+    return [make_message_update(user_id, '/track')] + [make_message_update(user_id, answer) for answer in TRACK_ANSWERS]
+
+
+def status_flow(user_id: int) -> list:
+    return [make_message_update(user_id, '/status')]
+
+
+def measurements_flow(user_id: int) -> list:
+    return [make_message_update(user_id, '/measurements')]
+
+
+def add_measurement_flow(user_id: int) -> list:
+    return [
+        make_callback_update(user_id, 'add_measurement'),
+        make_message_update(user_id, NEW_MEASUREMENT),
+        make_message_update(user_id, '1'),
+        make_message_update(user_id, '10'),
+        make_callback_update(user_id, 'save_measurement'),
+    ]
+
+
+# (название, сценарий, создает записи)
+PHASES = (
+    ('track', track_flow, True),
+    ('track (повтор)', track_flow, True),
+    ('status', status_flow, False),
+    ('measurements', measurements_flow, False),
+    ('add_measurement', add_measurement_flow, False),
+)
+
+
+async def run_user(harness: BotHarness, user_id: int, flow, result: dict) -> None:
+    started = time.perf_counter()
+    for raw_update in flow(user_id):
+        try:
+            result['updates'].append(await harness.feed(raw_update))
+        except Exception as e:
+            result['errors'] += 1
+            result['last_error'] = f"{type(e).__name__}: {e}"
+            return
+    result['flows'].append(time.perf_counter() - started)
+
+
+async def run_phase(harness: BotHarness, user_ids: list, name: str, flow, creates_entries: bool) -> dict:
+    result = {'phase': name, 'users': len(user_ids), 'flows': [], 'updates': [], 'errors': 0, 'last_error': None}
+    calls_before = harness.sheets.total_calls
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(harness, user_id, flow, result) for user_id in user_ids))
+    result['elapsed'] = time.perf_counter() - started
+
+    if creates_entries:
+        # Фоновая запись тоже считается: она - часть стоимости записи
+        await harness.drain_append_queue()
+    result['sheets_calls'] = harness.sheets.total_calls - calls_before
+    result['entries'] = len(user_ids) if creates_entries else 0
+    return result
+
+
+def check_sheets(harness: BotHarness, user_ids: list, track_rounds: int, measurement_added: bool) -> list:
+    """Проверяет, что сценарии действительно дошли до таблиц"""
+    problems = []
+    for user_id in user_ids:
+        worksheet = harness.sheets.worksheet(harness.sheet_for(user_id))
+        rows = worksheet.values
+        if len(rows) - 1 != track_rounds:
+            problems.append(f"таблица пользователя {user_id}: {len(rows) - 1} записей вместо {track_rounds}")
+        elif rows[-1][1:5] != TRACK_ANSWERS:
+            problems.append(f"таблица пользователя {user_id}: строка {rows[-1]} не совпадает с ответами")
+        if measurement_added and NEW_MEASUREMENT not in rows[0]:
+            problems.append(f"таблица пользователя {user_id}: не добавлен столбец {NEW_MEASUREMENT}")
+        if len(problems) >= 5:
+            break
+    return problems
+
+
+def print_result(result: dict) -> None:
+    flows = result['flows']
+    elapsed = result['elapsed'] or 1e-9
+    per_entry = f"{result['sheets_calls'] / result['entries']:.2f}" if result['entries'] else '-'
+    print(
+        f"{result['users']:>7} | {result['phase']:<16} | {len(flows) / elapsed:>10.1f} | "
+        f"{len(result['updates']) / elapsed:>10.1f} | "
+        f"{percentile(flows, 50) * 1000:>8.1f} | {percentile(flows, 95) * 1000:>8.1f} | "
+        f"{percentile(flows, 99) * 1000:>8.1f} | {result['errors']:>6} | "
+        f"{result['sheets_calls'] / max(result['users'], 1):>9.2f} | {per_entry:>9}"
+    )
+
+
+async def run(args) -> int:
+    workdir = tempfile.mkdtemp(prefix='bench_bot_flows_')
+    harness = BotHarness(workdir, args.sheets_latency, args.telegram_latency, args.log_level)
+    await harness.start()
+
+    print(f"Рабочий каталог: {workdir}")
+    print(f"{'польз.':>7} | {'сценарий':<16} | {'сценар./с':>10} | {'обновл./с':>10} | "
+          f"{'p50, мс':>8} | {'p95, мс':>8} | {'p99, мс':>8} | {'ошибок':>6} | "
+          f"{'Sheets/п.':>9} | {'Sheets/з.':>9}")
+    print("-" * 120)
+
+    failures = []
+    try:
+        for scale_index, users in enumerate(args.users):
+            # У каждого масштаба свои пользователи и таблицы: кэши для них холодные
+            user_ids = [(scale_index + 1) * 1_000_000 + i for i in range(users)]
+            await harness.add_users(user_ids)
+
+            track_rounds = 0
+            for name, flow, creates_entries in PHASES:
+                result = await run_phase(harness, user_ids, name, flow, creates_entries)
+                print_result(result)
+                track_rounds += creates_entries
+
+                if result['errors']:
+                    failures.append(f"{users} польз., {name}: {result['errors']} ошибок ({result['last_error']})")
+                if creates_entries and result['sheets_calls'] / result['entries'] > args.max_calls_per_entry:
+                    failures.append(
+                        f"{users} польз., {name}: {result['sheets_calls'] / result['entries']:.2f} запросов к Sheets "
+                        f"на запись (допустимо {args.max_calls_per_entry})"
+                    )
+
+            problems = check_sheets(harness, user_ids, track_rounds, measurement_added=True)
+            failures.extend(f"{users} польз.: {problem}" for problem in problems)
+            print("-" * 120)
+    finally:
+        await harness.stop()
+
+    print(f"Запросы к Sheets по методам: {dict(harness.sheets.calls)}")
+    print(f"Запросы к Telegram по методам: {dict(harness.telegram.calls)}")
+    if failures:
+        print("\n❌ Бенчмарк не пройден:")
+        for failure in failures:
+            print(f"  • {failure}")
+        return 1
+    print("\n✅ Все сценарии выполнены, усиление запросов к Sheets в пределах нормы")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="1,100,10000",
+                        help="количества одновременных пользователей через запятую")
+    parser.add_argument("--max-calls-per-entry", type=float, default=3.0,
+                        help="допустимое число запросов к Sheets на одну запись /track")
+    parser.add_argument("--sheets-latency", type=float, default=0.0,
+                        help="задержка каждого запроса к поддельному Sheets, с")
+    parser.add_argument("--telegram-latency", type=float, default=0.0,
+                        help="задержка каждого запроса к поддельному Telegram, с")
+    parser.add_argument("--log-level", default="WARNING", help="уровень логов бота")
+    args = parser.parse_args()
+    args.users = [int(value) for value in args.users.split(",") if value.strip()]
+
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк сборки строки таблицы: старый вложенный цикл против ColumnMap
+
+Запуск: python benchmarks/bench_column_map.py [--widths 10,50,200]
+Правила сопоставления проверяются в tests/test_column_map.py.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from column_map import compile_column_map
+
+
+def legacy_assemble(headers: list, timestamp: str, values: dict) -> list:
+    """Прежний алгоритм save_complete_data: подстроки, O(H×M)"""
+    row = [timestamp]
+    for header in headers[1:]:
+        value = ''
+        for name, measurement_value in values.items():
+            if name.lower() in header.lower() or header.lower() in name.lower():
+                value = measurement_value
+                break
+        row.append(value)
+    return row
+
+
+def make_schema(width: int, suffix: str = " (0-10)"):
+    """Заголовки с суффиксом и значения, названные без него"""
+    headers = ["Время"] + [f"Измерение {i}{suffix}" for i in range(1, width)]
+    values = {f"Измерение {i}": str(i % 11) for i in range(1, width)}
+    return headers, values
+
+
+def run(widths, number):
+    print(f"{'схема':>8} | {'столбцов':>9} | {'старый, мкс':>12} | {'ColumnMap, мкс':>15} | {'ускорение':>9}")
+    print("-" * 67)
+    for label, suffix in (("точная", ""), ("суффикс", " (0-10)")):
+        for width in widths:
+            headers, values = make_schema(width, suffix)
+            headers_key = tuple(headers)
+            # Карта строится один раз на схему, как в боте
+            compile_column_map(headers_key).assemble("t", values)
+
+            legacy = timeit.timeit(lambda: legacy_assemble(headers, "t", values), number=number)
+            compiled = timeit.timeit(lambda: compile_column_map(headers_key).assemble("t", values), number=number)
+
+            legacy_us = legacy / number * 1e6
+            compiled_us = compiled / number * 1e6
+            print(f"{label:>8} | {width:>9} | {legacy_us:>12.1f} | {compiled_us:>15.1f} | {legacy_us / compiled_us:>8.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--widths', default='5,15,50,200', help='Количество столбцов через запятую')
+    parser.add_argument('--number', type=int, default=200, help='Повторений на замер')
+    args = parser.parse_args()
+
+    run([int(w) for w in args.widths.split(',')], args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Поддельные Google Sheets и Telegram для бенчмарков
+
+FakeSheetsClient повторяет интерфейс SheetsClient и хранит таблицы в памяти,
+FakeTelegramSession заменяет HTTP-сессию бота и отвечает на запросы сразу.
+Оба считают вызовы, чтобы бенчмарки могли проверять усиление запросов.
+"""
+
+import asyncio
+import collections
+import datetime
+import itertools
+import random
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message
+
+from sheets import SheetsAPIError, column_index
+
+
+def _split_range(range_name: str) -> Tuple[Optional[str], str]:
+    """Делит A1-диапазон на название листа и ячейки: "'Лист 1'!1:1" -> ('Лист 1', '1:1')"""
+    if range_name.startswith("'"):
+        index = 1
+        while index < len(range_name):
+            if range_name[index] == "'":
+                if range_name[index + 1:index + 2] == "'":
+                    index += 2
+                    continue
+                break
+            index += 1
+        title = range_name[1:index].replace("''", "'")
+        return title, range_name[index + 2:]
+    title, _, cells = range_name.partition('!')
+    return title, cells
+
+
+def _parse_cell(cell: str) -> Tuple[Optional[int], Optional[int]]:
+    """'B3' -> (3, 2), 'B' -> (None, 2), '3' -> (3, None); нумерация с 1"""
+    letters = ''.join(c for c in cell if c.isalpha())
+    digits = ''.join(c for c in cell if c.isdigit())
+    return (int(digits) if digits else None), (column_index(letters) if letters else None)
+
+
+class FakeWorksheet:
+    def __init__(self, title: str, sheet_id: int, index: int, values: List[list] = None):
+        self.title = title
+        self.sheet_id = sheet_id
+        self.index = index
+        self.values: List[list] = [list(row) for row in values or []]
+
+    def properties(self) -> dict:
+        return {'title': self.title, 'sheetId': self.sheet_id, 'index': self.index}
+
+    def _bounds(self, cells: str) -> Tuple[int, int, int, int]:
+        """Строки и столбцы диапазона в виде полуинтервалов с 0"""
+        if not cells:
+            return 0, len(self.values), 0, max((len(row) for row in self.values), default=0)
+        start, _, end = cells.partition(':')
+        start_row, start_col = _parse_cell(start)
+        end_row, end_col = _parse_cell(end) if end else (start_row, start_col)
+        width = max((len(row) for row in self.values), default=0)
+        return (
+            (start_row or 1) - 1, end_row or len(self.values),
+            (start_col or 1) - 1, end_col or width
+        )
+
+    def get(self, cells: str) -> List[List[str]]:
+        """Как values.get: пустые ячейки в конце строк и пустые строки в конце не возвращаются"""
+        row_start, row_end, col_start, col_end = self._bounds(cells)
+        result = []
+        for row in self.values[row_start:row_end]:
+            row = [str(value) for value in row[col_start:col_end]]
+            while row and row[-1] == '':
+                row.pop()
+            result.append(row)
+        while result and not result[-1]:
+            result.pop()
+        return result
+
+    def set(self, cells: str, rows: List[list]) -> None:
+        row_start, _, col_start, _ = self._bounds(cells)
+        for row_offset, row in enumerate(rows):
+            while len(self.values) <= row_start + row_offset:
+                self.values.append([])
+            target = self.values[row_start + row_offset]
+            for col_offset, value in enumerate(row):
+                while len(target) <= col_start + col_offset:
+                    target.append('')
+                target[col_start + col_offset] = value
+
+    def append(self, rows: List[list]) -> None:
+        while self.values and not any(self.values[-1]):
+            self.values.pop()
+        self.values.extend(list(row) for row in rows)
+
+
+class FakeSheetsClient:
+    """Таблицы в памяти с интерфейсом SheetsClient.
+
+    latency - средняя задержка каждого запроса в секундах (имитация сети),
+    jitter - ее разброс в долях (0.5 - от 0.5 до 1.5 latency),
+    error_rate - доля запросов, завершающихся ошибкой 503.
+    calls - количество вызовов по методам API, errors - внесенных ошибок.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls: Dict[str, int] = collections.Counter()
+        self.errors = 0
+        self.spreadsheets: Dict[str, List[FakeWorksheet]] = {}
+        self._worksheet_ids = itertools.count(1)
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def add_spreadsheet(self, spreadsheet_id: str, headers: list, metadata: List[list] = None) -> None:
+        """Создает таблицу с заголовками на первом листе и (если задан) листом метаданных"""
+        worksheets = [FakeWorksheet('Лист1', 0, 0, [headers])]
+        if metadata is not None:
+            worksheets.append(FakeWorksheet(
+                'Метаданные', next(self._worksheet_ids), 1,
+                [["Измерение", "Тип", "Макс. значение", "Описание"]] + metadata
+            ))
+        self.spreadsheets[spreadsheet_id] = worksheets
+
+    def worksheet(self, spreadsheet_id: str, title: Optional[str] = None) -> FakeWorksheet:
+        try:
+            worksheets = self.spreadsheets[spreadsheet_id]
+        except KeyError:
+            raise SheetsAPIError(404, f"Requested entity was not found: {spreadsheet_id}")
+        if title is None:
+            return worksheets[0]
+        for worksheet in worksheets:
+            if worksheet.title == title:
+                return worksheet
+        raise SheetsAPIError(400, f"Unable to parse range: {title}")
+
+    def _resolve(self, spreadsheet_id: str, range_name: str) -> Tuple[FakeWorksheet, str]:
+        title, cells = _split_range(range_name)
+        return self.worksheet(spreadsheet_id, title), cells
+
+    async def _call(self, name: str) -> None:
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            raise SheetsAPIError(503, "The service is currently unavailable.")
+
+    async def get_spreadsheet(self, spreadsheet_id: str, fields: str = 'sheets.properties') -> dict:
+        await self._call('get_spreadsheet')
+        self.worksheet(spreadsheet_id)
+        return {'sheets': [{'properties': w.properties()} for w in self.spreadsheets[spreadsheet_id]]}
+
+    async def values_get(self, spreadsheet_id: str, range_name: str) -> List[List[str]]:
+        await self._call('values_get')
+        worksheet, cells = self._resolve(spreadsheet_id, range_name)
+        return worksheet.get(cells)
+
+    async def values_batch_get(self, spreadsheet_id: str, ranges: List[str]) -> List[List[List[str]]]:
+        await self._call('values_batch_get')
+        result = []
+        for range_name in ranges:
+            worksheet, cells = self._resolve(spreadsheet_id, range_name)
+            result.append(worksheet.get(cells))
+        return result
+
+    async def values_append(self, spreadsheet_id: str, range_name: str, rows: List[list],
+                            value_input_option: str = 'RAW') -> dict:
+        await self._call('values_append')
+        worksheet, _ = self._resolve(spreadsheet_id, range_name)
+        worksheet.append(rows)
+        return {'updates': {'updatedRows': len(rows)}}
+
+    async def values_update(self, spreadsheet_id: str, range_name: str, rows: List[list],
+                            value_input_option: str = 'RAW') -> dict:
+        await self._call('values_update')
+        worksheet, cells = self._resolve(spreadsheet_id, range_name)
+        worksheet.set(cells, rows)
+        return {'updatedRows': len(rows)}
+
+    async def values_clear(self, spreadsheet_id: str, range_name: str) -> dict:
+        await self._call('values_clear')
+        worksheet, _ = self._resolve(spreadsheet_id, range_name)
+        worksheet.values = []
+        return {}
+
+    async def batch_update(self, spreadsheet_id: str, requests: List[dict]) -> dict:
+        await self._call('batch_update')
+        worksheets = self.spreadsheets.get(spreadsheet_id)
+        if worksheets is None:
+            raise SheetsAPIError(404, f"Requested entity was not found: {spreadsheet_id}")
+        replies = []
+        for request in requests:
+            # Форматирование и прочие запросы на данные не влияют
+            if 'addSheet' in request:
+                title = request['addSheet']['properties']['title']
+                worksheet = FakeWorksheet(title, next(self._worksheet_ids), len(worksheets))
+                worksheets.append(worksheet)
+                replies.append({'addSheet': {'properties': worksheet.properties()}})
+            else:
+                replies.append({})
+        return {'replies': replies}
+
+    async def add_worksheet(self, spreadsheet_id: str, title: str, rows: int = 100, cols: int = 10) -> dict:
+        return await self.batch_update(spreadsheet_id, [{'addSheet': {'properties': {'title': title}}}])
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeTelegramSession(BaseSession):
+    """Сессия бота без сети: на каждый запрос сразу возвращает успешный ответ.
+
+    Запросы с chat_id (sendMessage, editMessageText и т.п.) получают
+    сообщение, остальные - True. calls - количество запросов по методам,
+    last_text - последний текст, отправленный в каждый чат.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Dict[str, int] = collections.Counter()
+        self.last_text: Dict[int, str] = {}
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return True
+        text = getattr(method, 'text', None)
+        if text is not None:
+            self.last_text[int(chat_id)] = text
+        message = Message(
+            message_id=getattr(method, 'message_id', None) or next(self._message_ids),
+            date=datetime.datetime.now(),
+            chat=Chat(id=int(chat_id), type='private'),
+            text=text
+        )
+        return message.as_(bot)
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self) -> None:
+        pass
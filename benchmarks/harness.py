@@ -0,0 +1,116 @@
+"""
+Запуск настоящего бота (роутер и обработчики из bot.py) на поддельных сервисах
+
+Переменные окружения задаются до импорта bot.py: база данных и файлы бота
+создаются во временном каталоге, лимиты Telegram и квоты Sheets сняты,
+чтобы измерялась собственная работа бота. Любую переменную можно
+переопределить снаружи.
+"""
+
+import logging
+import math
+import os
+import sys
+import time
+from typing import List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Таблица каждого пользователя: время и три цифровых измерения + одно текстовое
+SHEET_HEADERS = ["Время", "Настроение", "Энергия", "Сон", "Комментарий"]
+SHEET_METADATA = [
+    ["Настроение", "numeric", "10", ""],
+    ["Энергия", "numeric", "10", ""],
+    ["Сон", "numeric", "12", ""],
+]
+# Ответы на вопросы /track в порядке столбцов
+TRACK_ANSWERS = ["7", "5", "8", "бенчмарк"]
+
+
+def configure_environment(workdir: str) -> None:
+    defaults = {
+        'BOT_TOKEN': '123456:benchmark',
+        'DATABASE_PATH': os.path.join(workdir, 'bench.db'),
+        'TRACE_FILE': os.path.join(workdir, 'slow_updates.jsonl'),
+        'TELEGRAM_GLOBAL_RATE': '1000000',
+        'TELEGRAM_CHAT_INTERVAL': '0',
+        'TELEGRAM_GROUP_INTERVAL': '0',
+        'SHEETS_READ_PER_MINUTE': '1000000000',
+        'SHEETS_WRITE_PER_MINUTE': '1000000000',
+        'SHEETS_QUOTA_BURST': '1000000000',
+        # Кэши вмещают всех пользователей бенчмарка: иначе при 10k пользователей
+        # измеряется вытеснение из кэша, а не лишние запросы в обработчиках
+        'SCHEMA_CACHE_SIZE': '100000',
+        'SHEETS_PROPS_CACHE_SIZE': '100000',
+        'USER_SHEETS_CACHE_SIZE': '100000',
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+class BotHarness:
+    """bot.py с FakeSheetsClient вместо Google Sheets и FakeTelegramSession вместо Telegram"""
+
+    def __init__(self, workdir: str, sheets_latency: float = 0.0, telegram_latency: float = 0.0,
+                 log_level: str = 'WARNING', sheets_jitter: float = 0.0, sheets_error_rate: float = 0.0):
+        configure_environment(workdir)
+        # bot.log и прочие файлы бота пишутся во временный каталог
+        os.chdir(workdir)
+
+        import bot
+        from fakes import FakeSheetsClient, FakeTelegramSession
+
+        logging.getLogger().setLevel(log_level)
+
+        self.module = bot
+        self.sheets = FakeSheetsClient(sheets_latency, sheets_jitter, sheets_error_rate)
+        bot.sheets.configure(self.sheets)
+        bot.google_sheets_available = True
+
+        # Планировщик исходящих запросов остается в цепочке, меняется только транспорт
+        self.telegram = FakeTelegramSession(telegram_latency)
+        self.telegram.middleware(bot.outbound)
+        bot.bot.session = self.telegram
+
+    async def start(self) -> None:
+        await self.module.on_startup()
+
+    async def stop(self) -> None:
+        await self.module.on_shutdown()
+
+    async def add_users(self, user_ids: List[int]) -> None:
+        """Создает каждому пользователю таблицу и привязывает ее"""
+        bindings = []
+        for user_id in user_ids:
+            sheet_id = self.sheet_for(user_id)
+            self.sheets.add_spreadsheet(sheet_id, SHEET_HEADERS, SHEET_METADATA)
+            bindings.append((str(user_id), sheet_id))
+        await self.module.db.set_user_sheets_bulk(bindings)
+
+    @staticmethod
+    def sheet_for(user_id: int) -> str:
+        return f"bench-sheet-{user_id}"
+
+    async def feed(self, raw_update: dict) -> float:
+        """Обрабатывает обновление так же, как polling/вебхук; возвращает время обработки"""
+        from aiogram.types import Update
+
+        update = Update.model_validate(raw_update, context={"bot": self.module.bot})
+        started = time.perf_counter()
+        await self.module.dp.feed_update(self.module.bot, update)
+        return time.perf_counter() - started
+
+    async def drain_append_queue(self) -> None:
+        """Дописывает в таблицы все строки из очереди записи"""
+        await self.module.append_queue.stop()
+        self.module.append_queue.start()
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(percent / 100 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
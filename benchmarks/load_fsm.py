@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест диалогов FSM: пользователи одновременно проходят Form и MeasurementForm
+
+Виртуальные пользователи работают через настоящий диспетчер bot.py (см.
+harness.py), а обновления проходят тот же прием, что и в рабочих процессах
+supervisor.py: UpdateSequencer с --max-in-flight местами. Пользователи
+отвечают на вопросы бота с паузами на размышление, часть
+диалогов бросают на середине. Поддельный Sheets добавляет задержку и
+ошибки 503. Количество пользователей растет по этапам (--users), каждый
+этап длится --duration секунд.
+
+Для каждого этапа выводятся задержка event loop, рост FSM-хранилища
+(состояния в памяти и в БД, RSS, с --tracemalloc - память fsm_storage.py
+и cache.py) и по каждому шагу диалога: ожидание перед обработкой (от
+передачи обновления в очередь приема до входа в диспетчер), p50/p95/p99 обработки, время в Sheets, БД и ожидании квоты. В конце -
+количество пользователей, с которого p95 шага track:save (последний
+ответ get_custom_measurement -> save_complete_data) превышает --slo.
+
+Запуск: python benchmarks/load_fsm.py --users 100,1000,5000 --duration 60 --think-time 3
+
+Лимиты Telegram и квоты Sheets в harness.py сняты; чтобы включить
+реальные, задайте SHEETS_READ_PER_MINUTE и т.п. в окружении.
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import random
+import re
+import tempfile
+import time
+import tracemalloc
+
+from harness import BotHarness, percentile
+
+from aiogram import BaseMiddleware
+from fake_telegram import make_message_update, make_callback_update
+from supervisor import UpdateSequencer
+from tracing import current_trace
+
+# Вопрос бота о цифровом измерении: "Настроение (0-10)?"
+NUMERIC_QUESTION_RE = re.compile(r'\(0-(\d+)\)\?$')
+# Не больше стольких новых измерений на пользователя (каждое - новый столбец)
+MAX_ADDED_MEASUREMENTS = 3
+
+STEP_ORDER = (
+    'track:start', 'track:answer', 'track:save',
+    'measurement:start', 'measurement:name', 'measurement:type', 'measurement:max', 'measurement:save',
+)
+
+
+class TraceCollector(BaseMiddleware):
+    """Замеряет обработку каждого обновления (регистрируется после TracingMiddleware)"""
+
+    def __init__(self):
+        # update_id -> future с (начало обработки, время обработки, трасса) или None при ошибке
+        self.waiters = {}
+
+    def wait(self, update_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[update_id] = future
+        return future
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        result = None
+        try:
+            response = await handler(event, data)
+            result = (started, time.perf_counter() - started, current_trace())
+            return response
+        finally:
+            future = self.waiters.pop(event.update_id, None)
+            if future is not None and not future.done():
+                future.set_result(result)
+
+
+class StepStats:
+    def __init__(self):
+        self.queue = []
+        self.latency = []
+        self.sheets = []
+        self.quota = []
+        self.db = []
+        self.errors = 0
+
+    def add(self, queue: float, latency: float, trace) -> None:
+        self.queue.append(queue)
+        self.latency.append(latency)
+        sheets = quota = db = 0.0
+        for span in trace.spans if trace is not None else ():
+            duration = span['duration_ms'] / 1000
+            if span['kind'] == 'sheets':
+                if span['name'] == 'quota_wait':
+                    quota += duration
+                else:
+                    sheets += duration
+            elif span['kind'] == 'db':
+                db += duration
+        self.sheets.append(sheets)
+        self.quota.append(quota)
+        self.db.append(db)
+
+
+class LoadTest:
+    def __init__(self, harness: BotHarness, args):
+        self.harness = harness
+        self.args = args
+        self.collector = TraceCollector()
+        harness.module.dp.update.outer_middleware(self.collector)
+        # Тот же прием обновлений, что в рабочих процессах supervisor.py
+        self.sequencer = UpdateSequencer(harness.module.dp, harness.module.bot, args.max_in_flight)
+        self.steps = collections.defaultdict(StepStats)
+        self.abandoned = 0
+        self.conversations = 0
+
+    def reset(self) -> None:
+        self.steps = collections.defaultdict(StepStats)
+        self.abandoned = 0
+        self.conversations = 0
+
+    async def think(self) -> None:
+        """Пауза пользователя перед сообщением"""
+        delay = random.expovariate(1 / self.args.think_time) if self.args.think_time > 0 else 0
+        await asyncio.sleep(delay)
+
+    def abandons(self) -> bool:
+        if random.random() < self.args.abandon_rate:
+            self.abandoned += 1
+            return True
+        return False
+
+    async def send(self, raw_update: dict):
+        """Обрабатывает обновление; возвращает (ожидание, время обработки, трасса) или None при ошибке"""
+        done = self.collector.wait(raw_update['update_id'])
+        submitted = time.perf_counter()
+        try:
+            # Ждет свободного места в приеме, как вебхук при заполненном лимите
+            await self.sequencer.submit(raw_update)
+        except Exception:
+            self.collector.waiters.pop(raw_update['update_id'], None)
+            return None
+        result = await done
+        if result is None:
+            return None
+        started, latency, trace = result
+        return started - submitted, latency, trace
+
+    def record(self, step: str, result) -> bool:
+        if result is None:
+            self.steps[step].errors += 1
+            return False
+        self.steps[step].add(*result)
+        return True
+
+    def answer(self, user_id: int):
+        """Ответ на последний вопрос бота или None, если бот ничего не спрашивает"""
+        question = self.harness.telegram.last_text.get(user_id, '')
+        match = NUMERIC_QUESTION_RE.search(question)
+        if match:
+            return str(random.randint(0, int(match.group(1))))
+        if question.endswith('(текст)?'):
+            return random.choice(("норм", "устал", "все хорошо"))
+        return None
+
+    async def track(self, user_id: int) -> None:
+        """Form: /track и ответы на вопросы об измерениях до сохранения записи"""
+        await self.think()
+        result = await self.send(make_message_update(user_id, '/track'))
+        if not self.record('track:start', result):
+            return
+        while True:
+            answer = self.answer(user_id)
+            if answer is None or self.abandons():
+                return
+            await self.think()
+            result = await self.send(make_message_update(user_id, answer))
+            saved = self.harness.telegram.last_text.get(user_id, '').startswith('✅ Записал')
+            if not self.record('track:save' if saved else 'track:answer', result) or saved:
+                return
+
+    async def add_measurement(self, user_id: int, number: int) -> None:
+        """MeasurementForm: кнопка, название, тип, максимум и сохранение"""
+        steps = (
+            ('measurement:start', lambda: make_callback_update(user_id, 'add_measurement')),
+            ('measurement:name', lambda: make_message_update(user_id, f"Измерение {number}")),
+            ('measurement:type', lambda: make_message_update(user_id, '1')),
+            ('measurement:max', lambda: make_message_update(user_id, '10')),
+            ('measurement:save', lambda: make_callback_update(user_id, 'save_measurement')),
+        )
+        for index, (step, make_update) in enumerate(steps):
+            if index and self.abandons():
+                return
+            await self.think()
+            if not self.record(step, await self.send(make_update())):
+                return
+
+    async def user(self, user_id: int, added: dict, stop_at: float) -> None:
+        while time.monotonic() < stop_at:
+            self.conversations += 1
+            if random.random() < self.args.measurement_share and added[user_id] < MAX_ADDED_MEASUREMENTS:
+                added[user_id] += 1
+                await self.add_measurement(user_id, added[user_id])
+            else:
+                await self.track(user_id)
+
+
+async def monitor_loop_lag(samples: list, interval: float = 0.05) -> None:
+    """Задержка event loop: насколько sleep(interval) просыпается позже срока"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+def rss_mb() -> float:
+    """Текущий RSS процесса (только Linux, иначе 0)"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return 0.0
+
+
+def fsm_traced_mb() -> float:
+    """Память, выделенная в fsm_storage.py и cache.py (горячий слой FSM)"""
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(True, '*fsm_storage.py'),
+        tracemalloc.Filter(True, '*cache.py'),
+    ))
+    return sum(stat.size for stat in snapshot.statistics('filename')) / 2 ** 20
+
+
+def ms(value: float) -> str:
+    return f"{value * 1000:.1f}"
+
+
+def print_stage(load: LoadTest, users: int, elapsed: float, lag: list, memory: dict, previous: dict) -> None:
+    updates = sum(len(stats.latency) for stats in load.steps.values())
+    errors = sum(stats.errors for stats in load.steps.values())
+    print(f"\n=== {users} пользователей, {elapsed:.0f} с ===")
+    print(f"Обновлений: {updates} ({updates / elapsed:.1f}/с), ошибок: {errors}, "
+          f"диалогов: {load.conversations}, брошено: {load.abandoned}, "
+          f"внесено ошибок Sheets: {load.harness.sheets.errors}")
+    print(f"Задержка event loop: p50 {ms(percentile(lag, 50))} мс, p99 {ms(percentile(lag, 99))} мс, "
+          f"макс {ms(max(lag, default=0))} мс")
+
+    growth = {key: value - previous.get(key, 0) for key, value in memory.items()}
+    line = (f"FSM: в памяти {memory['hot']} ({growth['hot']:+}), ожидают записи {memory['pending']}, "
+            f"в БД незавершенных {memory['stored']} ({growth['stored']:+}), "
+            f"RSS {memory['rss']:.0f} МБ ({growth['rss']:+.0f})")
+    if 'traced' in memory:
+        line += f", fsm_storage+cache {memory['traced']:.2f} МБ ({growth['traced']:+.2f})"
+    print(line)
+
+    print(f"{'шаг':<18} | {'кол-во':>7} | {'ожид. p95':>9} | {'p50, мс':>8} | {'p95, мс':>8} | "
+          f"{'p99, мс':>8} | {'Sheets':>7} | {'квота':>7} | {'БД':>7} | {'ошибок':>6}")
+    print("-" * 112)
+    for step in STEP_ORDER:
+        stats = load.steps.get(step)
+        if stats is None:
+            continue
+        count = len(stats.latency) or 1
+        print(
+            f"{step:<18} | {len(stats.latency):>7} | {ms(percentile(stats.queue, 95)):>9} | "
+            f"{ms(percentile(stats.latency, 50)):>8} | {ms(percentile(stats.latency, 95)):>8} | "
+            f"{ms(percentile(stats.latency, 99)):>8} | {ms(sum(stats.sheets) / count):>7} | "
+            f"{ms(sum(stats.quota) / count):>7} | {ms(sum(stats.db) / count):>7} | {stats.errors:>6}"
+        )
+    print("(Sheets, квота, БД - среднее время на обновление, мс)")
+
+
+async def run(args) -> None:
+    if args.tracemalloc:
+        tracemalloc.start()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix='load_fsm_')
+    harness = BotHarness(
+        workdir, args.sheets_latency, args.telegram_latency, args.log_level,
+        sheets_jitter=args.sheets_jitter, sheets_error_rate=args.sheets_error_rate
+    )
+    await harness.start()
+    print(f"Рабочий каталог: {workdir}")
+
+    load = LoadTest(harness, args)
+    storage = harness.module.storage
+    user_ids = []
+    added = collections.Counter()
+    previous = {}
+    save_p95 = []
+    try:
+        for users in args.users:
+            # Этапы наращивают нагрузку: пользователи прошлых этапов продолжают работать
+            new_ids = list(range(len(user_ids) + 1, users + 1))
+            await harness.add_users(new_ids)
+            user_ids.extend(new_ids)
+
+            load.reset()
+            harness.sheets.errors = 0
+            lag = []
+            monitor = asyncio.create_task(monitor_loop_lag(lag))
+            started = time.perf_counter()
+            stop_at = time.monotonic() + args.duration
+            await asyncio.gather(*(load.user(user_id, added, stop_at) for user_id in user_ids[:users]))
+            elapsed = time.perf_counter() - started
+            monitor.cancel()
+
+            memory = {
+                'hot': storage.hot_size,
+                'pending': storage.pending_writes,
+                'stored': sum((await harness.module.db.count_fsm_states(time.time() - storage.ttl)).values()),
+                'rss': rss_mb(),
+            }
+            if args.tracemalloc:
+                memory['traced'] = fsm_traced_mb()
+            print_stage(load, users, elapsed, lag, memory, previous)
+            previous = memory
+
+            save = load.steps.get('track:save')
+            save_p95.append((users, percentile(save.latency, 95) if save else 0.0))
+    finally:
+        await harness.stop()
+
+    print("\np95 шага track:save по этапам: " + ", ".join(f"{users}: {ms(p95)} мс" for users, p95 in save_p95))
+    breaking = next((users for users, p95 in save_p95 if p95 > args.slo), None)
+    if breaking is None:
+        print(f"✅ p95 сохранения записи не превысил {args.slo} с ни на одном этапе")
+    else:
+        print(f"⚠️ p95 сохранения записи превышает {args.slo} с начиная с {breaking} пользователей")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", default="100,1000,5000",
+                        help="количество одновременных пользователей на этапах, через запятую")
+    parser.add_argument("--duration", type=float, default=60, help="длительность этапа, с")
+    parser.add_argument("--think-time", type=float, default=3.0,
+                        help="средняя пауза пользователя перед каждым сообщением, с (экспоненциальная)")
+    parser.add_argument("--abandon-rate", type=float, default=0.05,
+                        help="вероятность бросить диалог на каждом шаге")
+    parser.add_argument("--measurement-share", type=float, default=0.05,
+                        help="доля диалогов добавления измерения (остальные - /track)")
+    parser.add_argument("--sheets-latency", type=float, default=0.15,
+                        help="средняя задержка запроса к поддельному Sheets, с")
+    parser.add_argument("--sheets-jitter", type=float, default=0.5,
+                        help="разброс задержки Sheets в долях от средней")
+    parser.add_argument("--sheets-error-rate", type=float, default=0.01,
+                        help="доля запросов к Sheets, завершающихся ошибкой 503")
+    parser.add_argument("--telegram-latency", type=float, default=0.05,
+                        help="задержка запроса к поддельному Telegram, с")
+    parser.add_argument("--max-in-flight", type=int, default=int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '100')),
+                        help="сколько обновлений обрабатывается одновременно (остальные ждут в приеме)")
+    parser.add_argument("--slo", type=float, default=1.0,
+                        help="допустимое p95 шага track:save, с")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="замерять память fsm_storage.py и cache.py (замедляет бота)")
+    parser.add_argument("--seed", type=int, default=1, help="seed генератора случайных чисел")
+    parser.add_argument("--log-level", default="WARNING", help="уровень логов бота")
+    args = parser.parse_args()
+    args.users = sorted(int(value) for value in args.users.split(",") if value.strip())
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,32 @@
 from aiogram import Bot, Dispatcher, types, Router
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import json
 import datetime
+import time
 import asyncio
 import logging
 import os
+from typing import Optional
 from database import db
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+from cache import LRUCache
+from column_map import compile_column_map
+from sheets import sheets, SheetsClient, SheetsUnavailableError, quote_worksheet
+from sheet_writer import append_queue
+from status_service import StatusService
+from fsm_storage import SQLiteStorage
+from quota import background
+from telegram_scheduler import OutboundScheduler
+from metrics import registry, function_seconds, timed, start_metrics_server
+from middlewares import MetricsMiddleware, TracingMiddleware
+from webhook import WebhookServer
+from logging_setup import setup_logging
+
+# Настройка логирования: консоль и файл пишутся в фоновом потоке (см. logging_setup.py)
+log_pipeline = setup_logging()
 logger = logging.getLogger(__name__)
 
 # Telegram токен
@@ -32,54 +36,93 @@ if not BOT_TOKEN:
     logger.error("💡 Установите переменную окружения BOT_TOKEN")
     raise ValueError("BOT_TOKEN не найден в переменных окружения")
 
-logger.info(f"Инициализация бота с токеном: {BOT_TOKEN[:10]}...")
+logger.info("Инициализация бота с токеном: %s...", BOT_TOKEN[:10])
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
 
 bot = Bot(token=BOT_TOKEN, session_name="psycho_bot_session")
-storage = MemoryStorage()
+# Все исходящие запросы проходят через планировщик с учетом лимитов Telegram
+outbound = OutboundScheduler()
+bot.session.middleware(outbound)
+storage = SQLiteStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
+# Трасса каждого обновления и время обработчиков команд, сообщений и кнопок
+dp.update.outer_middleware(TracingMiddleware())
+router.message.middleware(MetricsMiddleware())
+router.callback_query.middleware(MetricsMiddleware())
 
 logger.info("Бот инициализирован успешно")
 
+# Кэш схем таблиц: sheet_id -> {'headers': [...], 'measurements': [...]}
+schema_cache = LRUCache(
+    maxsize=int(os.getenv('SCHEMA_CACHE_SIZE', '1000')),
+    ttl=float(os.getenv('SCHEMA_CACHE_TTL', '600'))
+)
+
+# Сообщение на время недоступности Google Sheets (предохранитель шлюза разомкнут)
+READ_ONLY_NOTICE = "⚠️ Google Sheets временно недоступен: таблица открыта только для чтения, показаны последние сохраненные данные."
+READ_ONLY_REFUSAL = "⚠️ Google Sheets временно недоступен, таблица открыта только для чтения.\nИзменить структуру таблицы пока нельзя, попробуйте через несколько минут."
+
+def invalidate_sheet_schema(sheet_id: str):
+    """Сбрасывает закэшированную схему таблицы после изменения ее структуры"""
+    schema_cache.invalidate(sheet_id)
+    status_snapshots.invalidate(sheet_id)
+    logger.info("Схема таблицы %s сброшена, кэш схем: %s", sheet_id, schema_cache.stats())
+
+def parse_metadata(metadata_values: list) -> dict:
+    """Разбирает лист метаданных в словарь: название -> (тип, макс. значение)"""
+    metadata = {}
+    for row in metadata_values:
+        if len(row) < 2 or row[0] in metadata:
+            continue
+        # API не возвращает пустые ячейки в конце строки
+        row = row + [''] * (3 - len(row))
+        measurement_type = row[1] if row[1] in ['numeric', 'text'] else 'text'
+        try:
+            max_value = int(row[2]) if row[2] else 10
+        except ValueError:
+            max_value = 10
+        metadata[row[0]] = (measurement_type, max_value)
+    return metadata
+
 # Функция для получения измерений из таблицы
+@timed(function_seconds)
 async def get_measurements_from_sheet(sheet_id: str) -> list:
     """Получает измерения из таблицы Google Sheets"""
+    schema = schema_cache.get(sheet_id)
+    if schema is not None:
+        return schema['measurements']
+    
     try:
-        sheet = client.open_by_key(sheet_id).sheet1
-        all_values = sheet.get_all_values()
+        # Заголовки и лист метаданных читаются одним batchGet
+        titles = await sheets.worksheet_titles(sheet_id)
+        if not titles:
+            return []
+        ranges = [f"{quote_worksheet(titles[0])}!1:1"]
+        has_metadata = "Метаданные" in titles[1:]
+        if has_metadata:
+            ranges.append(f"{quote_worksheet('Метаданные')}!A:C")
+        
+        values = await sheets.batch_get(sheet_id, ranges)
+        header_values = values[0]
+        metadata = parse_metadata(values[1]) if has_metadata else {}
         
-        if not all_values or len(all_values) == 0:
+        if not header_values:
+            schema_cache.set(sheet_id, {'headers': [], 'measurements': []})
             return []
         
         # Получаем заголовки (первая строка)
-        headers = all_values[0]
+        headers = header_values[0]
         measurements = []
         
         # Пропускаем первый столбец (время)
         for i, header in enumerate(headers[1:], 1):
             if header.strip():  # Пропускаем пустые заголовки
-                # Определяем тип измерения по умолчанию
-                measurement_type = 'text'  # По умолчанию текстовый
-                max_value = 10  # По умолчанию 10
-                
-                # Проверяем лист метаданных
-                try:
-                    metadata_sheet = client.open_by_key(sheet_id).worksheet("Метаданные")
-                    metadata_values = metadata_sheet.get_all_values()
-                    
-                    # Ищем информацию о текущем измерении
-                    for row in metadata_values:
-                        if len(row) >= 3 and row[0] == header:
-                            measurement_type = row[1] if row[1] in ['numeric', 'text'] else 'text'
-                            try:
-                                max_value = int(row[2]) if row[2] else 10
-                            except ValueError:
-                                max_value = 10
-                            break
-                except:
-                    # Если лист метаданных не существует, используем значения по умолчанию
-                    pass
+                # Если измерения нет в метаданных: текстовое, максимум 10
+                measurement_type, max_value = metadata.get(header, ('text', 10))
                 
                 measurements.append({
                     'name': header,
@@ -88,69 +131,107 @@ async def get_measurements_from_sheet(sheet_id: str) -> list:
                     'column_index': i
                 })
         
+        schema_cache.set(sheet_id, {'headers': headers, 'measurements': measurements})
         return measurements
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при получении измерений из таблицы {sheet_id}: {e}")
+        # Во время сбоя Google отвечаем по последней известной схеме
+        stale = schema_cache.get_stale(sheet_id)
+        if stale is not None:
+            logger.warning("Измерения таблицы %s взяты из устаревшего кэша: %s", sheet_id, e)
+            return stale['measurements']
+        logger.error("❌ Ошибка при получении измерений из таблицы %s: %s", sheet_id, e)
         return []
 
+# Функция для чтения заголовков таблицы
+async def get_sheet_headers(sheet_id: str, allow_stale: bool = False) -> list:
+    """Читает только первую строку первого листа (заголовки)"""
+    try:
+        header_values = await sheets.get_cells(sheet_id, '1:1')
+    except SheetsUnavailableError:
+        stale = schema_cache.get_stale(sheet_id) if allow_stale else None
+        if stale is None:
+            raise
+        logger.warning("Заголовки таблицы %s взяты из кэша: Google Sheets недоступен", sheet_id)
+        return stale['headers']
+    return header_values[0] if header_values else []
+
+async def build_sheet_rows(sheet_id: str, items: list) -> list:
+    """Раскладывает значения записей журнала по столбцам таблицы (первый столбец - время).
+
+    Вызывается очередью записи перед values.append. Заголовки берутся из
+    кэша схемы, а если его нет - читаются из таблицы (при сбое Google -
+    последние известные).
+    """
+    schema = schema_cache.get(sheet_id)
+    headers = schema['headers'] if schema is not None else await get_sheet_headers(sheet_id, allow_stale=True)
+    if not headers:
+        raise ValueError(f"в таблице {sheet_id} нет заголовков")
+    
+    column_map = compile_column_map(tuple(headers))
+    rows = []
+    for item in items:
+        row, unmatched = column_map.assemble(item['recorded_at'], item['values'])
+        if unmatched:
+            logger.warning("Не найдены столбцы для измерений %s в таблице %s", unmatched, sheet_id)
+        rows.append(row)
+    return rows
+
+append_queue.build_rows = build_sheet_rows
+
 # Функция для добавления измерения в таблицу
 async def add_measurement_to_sheet(sheet_id: str, measurement_name: str, measurement_type: str = 'text', max_value: int = 10) -> bool:
     """Добавляет новое измерение в таблицу Google Sheets"""
     try:
-        sheet = client.open_by_key(sheet_id).sheet1
-        all_values = sheet.get_all_values()
+        headers = await get_sheet_headers(sheet_id)
         
-        if not all_values:
+        if not headers:
             return False
         
         # Получаем количество столбцов
-        num_columns = len(all_values[0])
+        num_columns = len(headers)
         
         # Добавляем заголовок в последний столбец первой строки
         last_column_letter = chr(ord('A') + num_columns)
         
         # Используем правильный формат для обновления ячейки
-        sheet.update_cell(1, num_columns + 1, measurement_name)
+        await sheets.update_cell(sheet_id, 1, num_columns + 1, measurement_name)
         
         # Форматируем заголовок
-        sheet.format(f'{last_column_letter}1', {
+        await sheets.format(sheet_id, f'{last_column_letter}1', {
             'textFormat': {'bold': True},
             'backgroundColor': {'red': 0.9, 'green': 0.9, 'blue': 0.9}
         })
         
         # Добавляем информацию в лист метаданных
-        try:
-            metadata_sheet = client.open_by_key(sheet_id).worksheet("Метаданные")
-        except:
+        if not await sheets.has_worksheet(sheet_id, "Метаданные"):
             # Создаем лист метаданных если его нет
-            spreadsheet = client.open_by_key(sheet_id)
-            metadata_sheet = spreadsheet.add_worksheet(title="Метаданные", rows=100, cols=10)
+            await sheets.add_worksheet(sheet_id, "Метаданные", rows=100, cols=10)
             # Добавляем заголовки
-            metadata_sheet.append_row(["Измерение", "Тип", "Макс. значение", "Описание"])
-            metadata_sheet.format('A1:D1', {
+            await sheets.append_row(sheet_id, ["Измерение", "Тип", "Макс. значение", "Описание"], "Метаданные")
+            await sheets.format(sheet_id, 'A1:D1', {
                 'textFormat': {'bold': True},
                 'backgroundColor': {'red': 0.8, 'green': 0.8, 'blue': 0.8}
-            })
+            }, "Метаданные")
         
         # Добавляем информацию об измерении
-        metadata_sheet.append_row([measurement_name, measurement_type, str(max_value), f"Добавлено автоматически"])
+        await sheets.append_row(sheet_id, [measurement_name, measurement_type, str(max_value), f"Добавлено автоматически"], "Метаданные")
         
-        logger.info(f"✅ Добавлено измерение '{measurement_name}' в таблицу {sheet_id}")
+        logger.info("✅ Добавлено измерение '%s' в таблицу %s", measurement_name, sheet_id)
         return True
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при добавлении измерения в таблицу {sheet_id}: {e}")
+        logger.error("❌ Ошибка при добавлении измерения в таблицу %s: %s", sheet_id, e)
         return False
+    finally:
+        invalidate_sheet_schema(sheet_id)
 
 # Функция для инициализации шаблона таблицы
 async def initialize_table_template(sheet_id: str) -> bool:
     """Инициализирует таблицу с базовым шаблоном"""
     try:
-        sheet = client.open_by_key(sheet_id).sheet1
-        
         # Очищаем таблицу
-        sheet.clear()
+        await sheets.clear(sheet_id)
         
         # Добавляем базовые заголовки
         headers = [
@@ -158,21 +239,22 @@ async def initialize_table_template(sheet_id: str) -> bool:
             "Настроение (0-10)",
             "Комментарий"
         ]
-        sheet.append_row(headers)
+        await sheets.append_row(sheet_id, headers)
         
         # Форматируем заголовки
-        sheet.format('A1:C1', {
+        await sheets.format(sheet_id, 'A1:C1', {
             'textFormat': {'bold': True},
             'backgroundColor': {'red': 0.9, 'green': 0.9, 'blue': 0.9}
         })
         
         # Настраиваем ширину колонок (используем batch_update)
         try:
+            worksheet_id = await sheets.first_worksheet_id(sheet_id)
             requests = [
                 {
                     'updateDimensionProperties': {
                         'range': {
-                            'sheetId': sheet.id,
+                            'sheetId': worksheet_id,
                             'dimension': 'COLUMNS',
                             'startIndex': 0,
                             'endIndex': 1
@@ -186,7 +268,7 @@ async def initialize_table_template(sheet_id: str) -> bool:
                 {
                     'updateDimensionProperties': {
                         'range': {
-                            'sheetId': sheet.id,
+                            'sheetId': worksheet_id,
                             'dimension': 'COLUMNS',
                             'startIndex': 1,
                             'endIndex': 2
@@ -200,7 +282,7 @@ async def initialize_table_template(sheet_id: str) -> bool:
                 {
                     'updateDimensionProperties': {
                         'range': {
-                            'sheetId': sheet.id,
+                            'sheetId': worksheet_id,
                             'dimension': 'COLUMNS',
                             'startIndex': 2,
                             'endIndex': 3
@@ -213,30 +295,30 @@ async def initialize_table_template(sheet_id: str) -> bool:
                 }
             ]
             
-            sheet.spreadsheet.batch_update({'requests': requests})
+            await sheets.batch_update(sheet_id, {'requests': requests})
         except Exception as width_error:
-            logger.warning(f"Не удалось установить ширину столбцов: {width_error}")
+            logger.warning("Не удалось установить ширину столбцов: %s", width_error)
             # Продолжаем без установки ширины
         
-        logger.info(f"✅ Шаблон инициализирован для таблицы {sheet_id}")
+        # Таблица очищена: записей в ней больше нет
+        await db.set_sheet_summary(sheet_id, 0, None, [])
+        
+        logger.info("✅ Шаблон инициализирован для таблицы %s", sheet_id)
         return True
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при инициализации шаблона для таблицы {sheet_id}: {e}")
+        logger.error("❌ Ошибка при инициализации шаблона для таблицы %s: %s", sheet_id, e)
         return False
+    finally:
+        invalidate_sheet_schema(sheet_id)
 
 # Функция для проверки структуры таблицы
 async def check_table_structure(sheet_id: str) -> bool:
     """Проверяет, подходит ли структура таблицы для работы с ботом"""
     try:
-        sheet = client.open_by_key(sheet_id).sheet1
-        all_values = sheet.get_all_values()
-        
-        if not all_values or len(all_values) == 0:
-            return False
+        headers = await get_sheet_headers(sheet_id)
         
         # Проверяем, есть ли хотя бы один столбец
-        headers = all_values[0]
         if len(headers) < 1:
             return False
         
@@ -246,9 +328,128 @@ async def check_table_structure(sheet_id: str) -> bool:
         return has_time_column
         
     except Exception as e:
-        logger.error(f"❌ Ошибка при проверке структуры таблицы {sheet_id}: {e}")
+        logger.error("❌ Ошибка при проверке структуры таблицы %s: %s", sheet_id, e)
         return False
 
+# Сводка по таблице (количество записей, последняя запись)
+SUMMARY_RECONCILE_INTERVAL = float(os.getenv('SUMMARY_RECONCILE_INTERVAL', str(24 * 3600)))
+reconciling_sheets = set()
+background_tasks = set()
+
+async def reconcile_sheet_summary(sheet_id: str) -> dict:
+    """Сверяет сводку с таблицей: читает только столбец времени и последнюю строку"""
+    reconciling_sheets.add(sheet_id)
+    try:
+        time_column = await sheets.get_cells(sheet_id, 'A:A')
+        record_count = max(len(time_column) - 1, 0)
+        last_values = []
+        if record_count:
+            last_row = len(time_column)
+            last_values = (await sheets.get_cells(sheet_id, f'{last_row}:{last_row}') or [[]])[0]
+        last_timestamp = last_values[0] if last_values else None
+        
+        await db.set_sheet_summary(sheet_id, record_count, last_timestamp, last_values)
+        logger.info("Сводка по таблице %s сверена: %s записей", sheet_id, record_count)
+        return {
+            'record_count': record_count,
+            'last_timestamp': last_timestamp,
+            'last_values': last_values,
+            'reconciled_at': time.time()
+        }
+    finally:
+        reconciling_sheets.discard(sheet_id)
+
+async def reconcile_sheet_summary_background(sheet_id: str):
+    try:
+        with background():
+            await reconcile_sheet_summary(sheet_id)
+    except Exception as e:
+        logger.warning("Не удалось сверить сводку по таблице %s: %s", sheet_id, e)
+
+async def get_sheet_summary(sheet_id: str) -> dict:
+    """Возвращает сводку по таблице; устаревшая сводка сверяется в фоне"""
+    summary = await db.get_sheet_summary(sheet_id)
+    if summary is None:
+        return await reconcile_sheet_summary(sheet_id)
+    
+    stale = time.time() - summary['reconciled_at'] > SUMMARY_RECONCILE_INTERVAL
+    if stale and sheet_id not in reconciling_sheets and not sheets.degraded:
+        reconciling_sheets.add(sheet_id)
+        task = asyncio.create_task(reconcile_sheet_summary_background(sheet_id))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return summary
+
+async def build_status_snapshot(sheet_id: str) -> dict:
+    """Снимок статуса таблицы: сводка и схема читаются параллельно"""
+    summary, measurements = await asyncio.gather(
+        get_sheet_summary(sheet_id),
+        get_measurements_from_sheet(sheet_id)
+    )
+    return {
+        'record_count': summary['record_count'],
+        'last_timestamp': summary['last_timestamp'],
+        'measurements': measurements,
+        'built_at': time.time()
+    }
+
+# Снимки статуса для /status и кнопки "Статус": отдаются из кэша, устаревшие обновляются в фоне.
+# Снимок сбрасывается после записи строк в таблицу и после изменения ее структуры
+status_snapshots = StatusService(build_status_snapshot)
+append_queue.on_written = status_snapshots.invalidate
+
+async def get_user_entries_text(user_id: str) -> str:
+    """Записи пользователя из локального журнала (без обращения к Google Sheets)"""
+    count = await db.count_entries(user_id)
+    if not count:
+        return ""
+    last_entry = await db.get_last_entry(user_id)
+    last_date = last_entry['recorded_at'] if last_entry else "Неизвестно"
+    return f"\n👤 Ваших записей: {count}, последняя: {last_date}"
+
+async def get_status_text(sheet_id: str, user_id: str, username: str) -> str:
+    """Текст статуса подключенной таблицы (общий для /status и кнопки "Статус")"""
+    sheet_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}"
+    if not (google_sheets_available and sheets.available):
+        user_entries = await get_user_entries_text(user_id)
+        return f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n⚠️ Google Sheets API недоступен{user_entries}\n📝 Используйте кнопку 'Записать данные'"
+    
+    try:
+        snapshot = await status_snapshots.get(sheet_id)
+    except Exception as e:
+        logger.error("Ошибка при получении статуса для пользователя %s: %s", username, str(e))
+        return f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n❌ Ошибка при чтении данных: {str(e)}\n📝 Используйте кнопку 'Записать данные'"
+    
+    if snapshot['record_count'] == 0:  # Только заголовки или пустая таблица
+        status_text = f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n📊 Записей: 0\n📝 Используйте кнопку 'Записать данные' для первой записи"
+    else:
+        last_date = snapshot['last_timestamp'] or "Неизвестно"
+        user_entries = await get_user_entries_text(user_id)
+        status_text = f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n📊 Всего записей: {snapshot['record_count']}\n📅 Последняя запись: {last_date}{user_entries}\n\n📝 Используйте кнопку 'Записать данные' для новой записи"
+    
+    # Предустановленные измерения (из шаблона)
+    status_text += "\n\n📋 Измерения:"
+    status_text += "\n🔧 Предустановленные:"
+    status_text += "\n• Время"
+    status_text += "\n• Настроение (0-10)"
+    status_text += "\n• Комментарий"
+    
+    # Пользовательские измерения
+    if snapshot['measurements']:
+        status_text += "\n\n📊 Пользовательские:"
+        for measurement in snapshot['measurements']:
+            if measurement['type'] == 'numeric':
+                status_text += f"\n• {measurement['name']} (0-{measurement['max_value']})"
+            else:
+                status_text += f"\n• {measurement['name']} (текст)"
+    else:
+        status_text += "\n\n📊 Пользовательских измерений нет"
+        status_text += "\n💡 Используйте кнопку 'Измерения' для добавления"
+    
+    if sheets.degraded:
+        status_text += f"\n\n{READ_ONLY_NOTICE}"
+    return status_text
+
 # Функции для создания кнопок
 def get_main_keyboard() -> InlineKeyboardMarkup:
     """Создает основную клавиатуру с кнопками"""
@@ -289,20 +490,67 @@ def get_template_choice_keyboard() -> InlineKeyboardMarkup:
     ])
     return keyboard
 
-def get_measurements_keyboard() -> InlineKeyboardMarkup:
-    """Создает клавиатуру для управления измерениями"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="➕ Добавить измерение", callback_data="add_measurement")
-        ],
+def get_measurements_keyboard(read_only: bool = False) -> InlineKeyboardMarkup:
+    """Создает клавиатуру для управления измерениями (только для чтения - без добавления)"""
+    rows = [
         [
             InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")
         ]
-    ])
-    return keyboard
-
-# Словарь user_id -> Google Sheet ID (загружается из БД при старте)
-user_sheets = {}
+    ]
+    if not read_only:
+        rows.insert(0, [InlineKeyboardButton(text="➕ Добавить измерение", callback_data="add_measurement")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def get_measurements_text(measurements: list) -> str:
+    """Список измерений для /measurements и кнопки "Измерения" """
+    if sheets.degraded:
+        hint = f"\n\n{READ_ONLY_NOTICE}"
+    else:
+        hint = "\n\n💡 Нажмите 'Добавить измерение' для создания нового"
+    if not measurements:
+        return "📋 В таблице пока нет измерений." + hint
+    
+    measurements_text = "📋 Измерения в таблице:\n\n"
+    for i, measurement in enumerate(measurements, 1):
+        if measurement['type'] == 'numeric':
+            measurements_text += f"{i}. {measurement['name']} (0-{measurement['max_value']})\n"
+        else:
+            measurements_text += f"{i}. {measurement['name']} (текст)\n"
+    return measurements_text.rstrip("\n") + hint
+
+# Кэш привязок user_id -> Google Sheet ID перед БД. None означает, что таблица не подключена:
+# такие записи живут недолго, чтобы не обращаться к БД на каждое сообщение нового пользователя
+user_sheets = LRUCache(
+    maxsize=int(os.getenv('USER_SHEETS_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('USER_SHEETS_CACHE_TTL', '3600'))
+)
+USER_SHEETS_NEGATIVE_TTL = float(os.getenv('USER_SHEETS_NEGATIVE_TTL', '60'))
+
+# Метрики кэшей и очередей, вычисляемые при каждом чтении /metrics
+registry.track_cache('schema', schema_cache)
+registry.track_cache('user_sheets', user_sheets)
+registry.track_cache('status', status_snapshots.cache)
+registry.track_cache('fsm_hot', storage._hot)
+registry.gauge('append_queue_depth', 'Строки, ожидающие записи в таблицы', lambda: append_queue.depth)
+registry.gauge('fsm_pending_writes', 'Состояния FSM, ожидающие записи в БД', lambda: storage.pending_writes)
+registry.gauge('fsm_states', 'Незавершенные диалоги по состояниям FSM', lambda: db.count_fsm_states(time.time() - storage.ttl), ('state',))
+registry.gauge('telegram_requests_total', 'Исходящие запросы к Telegram по результату', lambda: {
+    (result,): outbound.stats()[result] for result in ('sent', 'merged', 'retried', 'failed', 'delayed')
+}, ('result',), kind='counter')
+registry.gauge('telegram_pending_edits', 'Правки сообщений, ожидающие отправки', lambda: outbound.stats()['pending_edits'])
+registry.gauge('log_queue_depth', 'Записи логов, ожидающие записи', lambda: log_pipeline.depth)
+registry.gauge('log_records_dropped_total', 'Записи логов, отброшенные при переполнении очереди', lambda: log_pipeline.dropped, kind='counter')
+_NOT_CACHED = object()
+
+async def get_user_sheet_id(user_id_str: str) -> Optional[str]:
+    """Возвращает ID таблицы пользователя из кэша или из БД"""
+    sheet_id = user_sheets.get(user_id_str, _NOT_CACHED)
+    if sheet_id is not _NOT_CACHED:
+        return sheet_id
+    
+    sheet_id = await db.get_user_sheet(user_id_str)
+    user_sheets.set(user_id_str, sheet_id, ttl=None if sheet_id else USER_SHEETS_NEGATIVE_TTL)
+    return sheet_id
 
 # FSM
 class Form(StatesGroup):
@@ -324,36 +572,30 @@ class MeasurementForm(StatesGroup):
 
 # Google API - optional
 try:
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    
     # Проверяем переменную окружения для Google credentials
     google_creds_json = os.getenv('GOOGLE_CREDS_JSON')
     if google_creds_json:
         # Используем credentials из переменной окружения
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(
-            json.loads(google_creds_json), scope
-        )
-        client = gspread.authorize(creds)
+        sheets.configure(SheetsClient(json.loads(google_creds_json)))
         google_sheets_available = True
         logger.info("Google Sheets API подключен через переменную окружения")
     else:
         # Пробуем файл creds.json (для локальной разработки)
-        creds = ServiceAccountCredentials.from_json_keyfile_name("creds.json", scope)
-        client = gspread.authorize(creds)
+        with open("creds.json") as creds_file:
+            sheets.configure(SheetsClient(json.load(creds_file)))
         google_sheets_available = True
         logger.info("Google Sheets API подключен через файл creds.json")
         
-except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
-    logger.warning(f"Google Sheets не настроен: {e}")
+except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError) as e:
+    logger.warning("Google Sheets не настроен: %s", e)
     google_sheets_available = False
-    client = None
 
 # Команды
 @router.message(Command("start"))
 async def start(message: Message):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
-    logger.info(f"Команда /start от пользователя {username} (ID: {user_id})")
+    logger.info("Команда /start от пользователя %s (ID: %s)", username, user_id)
     
     response = f"""Привет, {username}! 👋 Я бот для отслеживания психологического состояния.
 
@@ -365,13 +607,13 @@ async def start(message: Message):
 🚀 Начните с подключения Google таблицы!"""
     
     await message.reply(response, reply_markup=get_main_keyboard())
-    logger.info(f"Отправлен ответ пользователю {username}")
+    logger.info("Отправлен ответ пользователю %s", username)
 
 @router.message(Command("help"))
 async def help_command(message: Message):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
-    logger.info(f"Команда /help от пользователя {username} (ID: {user_id})")
+    logger.info("Команда /help от пользователя %s (ID: %s)", username, user_id)
     
     help_text = """📚 Доступные команды:
 
@@ -392,7 +634,7 @@ async def help_command(message: Message):
 💡 Рекомендуем создать новую таблицу через /createsheet!"""
     
     await message.reply(help_text)
-    logger.info(f"Отправлена справка пользователю {username}")
+    logger.info("Отправлена справка пользователю %s", username)
 
 
 
@@ -401,10 +643,11 @@ async def show_measurements(message: Message):
     """Показывает все измерения из таблицы"""
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
-    logger.info(f"Команда /measurements от пользователя {username} (ID: {user_id})")
+    logger.info("Команда /measurements от пользователя %s (ID: %s)", username, user_id)
     
     user_id_str = str(user_id)
-    if user_id_str not in user_sheets:
+    sheet_id = await get_user_sheet_id(user_id_str)
+    if not sheet_id:
         await message.reply(
             "❌ Таблица не подключена\n\n🔗 Используйте /setsheet <ссылка> для подключения таблицы",
             reply_markup=get_main_keyboard()
@@ -412,31 +655,15 @@ async def show_measurements(message: Message):
         return
     
     try:
-        sheet_id = user_sheets[user_id_str]
         measurements = await get_measurements_from_sheet(sheet_id)
-        
-        if not measurements:
-            await message.reply(
-                "📋 В таблице пока нет измерений.\n\n"
-                "💡 Нажмите 'Добавить измерение' для создания нового.",
-                reply_markup=get_measurements_keyboard()
-            )
-            return
-        
-        measurements_text = "📋 Измерения в таблице:\n\n"
-        for i, measurement in enumerate(measurements, 1):
-            if measurement['type'] == 'numeric':
-                measurements_text += f"{i}. {measurement['name']} (0-{measurement['max_value']})\n"
-            else:
-                measurements_text += f"{i}. {measurement['name']} (текст)\n"
-        
-        measurements_text += "\n💡 Нажмите 'Добавить измерение' для создания нового"
-        
-        await message.reply(measurements_text, reply_markup=get_measurements_keyboard())
-        logger.info(f"Показаны измерения пользователю {username}")
+        await message.reply(
+            get_measurements_text(measurements),
+            reply_markup=get_measurements_keyboard(read_only=sheets.degraded)
+        )
+        logger.info("Показаны измерения пользователю %s", username)
         
     except Exception as e:
-        logger.error(f"Ошибка при получении измерений для пользователя {username}: {e}")
+        logger.error("Ошибка при получении измерений для пользователя %s: %s", username, e)
         await message.reply(
             "❌ Ошибка при получении измерений из таблицы.",
             reply_markup=get_main_keyboard()
@@ -448,17 +675,17 @@ async def show_measurements(message: Message):
 async def set_sheet(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
-    logger.info(f"Команда /setsheet от пользователя {username} (ID: {user_id})")
+    logger.info("Команда /setsheet от пользователя %s (ID: %s)", username, user_id)
     
     if not google_sheets_available:
-        logger.warning(f"Google Sheets недоступен для пользователя {username}")
+        logger.warning("Google Sheets недоступен для пользователя %s", username)
         await message.reply("Google Sheets не настроен. Добавьте файл creds.json для работы с таблицами.")
         return
     
     try:
         url = message.text.split(' ')[1]
         sheet_id = url.split('/d/')[1].split('/')[0]
-        logger.info(f"Извлечен ID таблицы: {sheet_id}")
+        logger.info("Извлечен ID таблицы: %s", sheet_id)
         
         # Проверяем структуру таблицы
         structure_ok = await check_table_structure(sheet_id)
@@ -479,10 +706,10 @@ async def set_sheet(message: Message, state: FSMContext):
         await save_table_connection(message, sheet_id, user_id, username)
         
     except IndexError:
-        logger.warning(f"Пользователь {username} не указал ссылку на таблицу")
+        logger.warning("Пользователь %s не указал ссылку на таблицу", username)
         await message.reply("Пожалуйста, укажите ссылку на таблицу: /setsheet <ссылка>")
     except Exception as e:
-        logger.error(f"Ошибка при подключении таблицы для пользователя {username}: {str(e)}")
+        logger.error("Ошибка при подключении таблицы для пользователя %s: %s", username, str(e))
         await message.reply(f"Ошибка при подключении таблицы: {str(e)}")
 
 async def save_table_connection(message: Message, sheet_id: str, user_id: int, username: str):
@@ -491,10 +718,10 @@ async def save_table_connection(message: Message, sheet_id: str, user_id: int, u
         success = await db.set_user_sheet(str(user_id), sheet_id)
         if success:
             # Обновляем локальный словарь
-            user_sheets[str(user_id)] = sheet_id
+            user_sheets.set(str(user_id), sheet_id)
             
             sheet_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}"
-            logger.info(f"Таблица {sheet_id} подключена для пользователя {username}")
+            logger.info("Таблица %s подключена для пользователя %s", sheet_id, username)
             await message.reply(
                 f"✅ Таблица подключена!\n\n"
                 f"🔗 [Открыть таблицу]({sheet_url})\n\n"
@@ -504,14 +731,14 @@ async def save_table_connection(message: Message, sheet_id: str, user_id: int, u
                 disable_web_page_preview=True
             )
         else:
-            logger.error(f"Не удалось сохранить таблицу в БД для пользователя {username}")
+            logger.error("Не удалось сохранить таблицу в БД для пользователя %s", username)
             await message.reply("❌ Ошибка при сохранении таблицы. Попробуйте еще раз."        )
     except Exception as e:
-        logger.error(f"Ошибка при сохранении в БД: {e}")
+        logger.error("Ошибка при сохранении в БД: %s", e)
         # Сохраняем только в локальный словарь как fallback
-        user_sheets[str(user_id)] = sheet_id
+        user_sheets.set(str(user_id), sheet_id)
         sheet_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}"
-        logger.warning(f"Сохранено только в локальный словарь для пользователя {username}")
+        logger.warning("Сохранено только в локальный словарь для пользователя %s", username)
         await message.reply(
             f"✅ Таблица подключена! (временное сохранение)\n\n"
             f"🔗 [Открыть таблицу]({sheet_url})\n\n"
@@ -527,10 +754,10 @@ async def save_table_connection_callback(callback: CallbackQuery, sheet_id: str,
         success = await db.set_user_sheet(str(user_id), sheet_id)
         if success:
             # Обновляем локальный словарь
-            user_sheets[str(user_id)] = sheet_id
+            user_sheets.set(str(user_id), sheet_id)
             
             sheet_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}"
-            logger.info(f"Таблица {sheet_id} подключена для пользователя {username}")
+            logger.info("Таблица %s подключена для пользователя %s", sheet_id, username)
             
             # Обновляем сообщение с информацией о подключении
             await callback.message.edit_text(
@@ -542,17 +769,17 @@ async def save_table_connection_callback(callback: CallbackQuery, sheet_id: str,
                 disable_web_page_preview=True
             )
         else:
-            logger.error(f"Не удалось сохранить таблицу в БД для пользователя {username}")
+            logger.error("Не удалось сохранить таблицу в БД для пользователя %s", username)
             await callback.message.edit_text(
                 "❌ Ошибка при сохранении таблицы. Попробуйте еще раз.",
                 reply_markup=get_main_keyboard()
             )
     except Exception as e:
-        logger.error(f"Ошибка при сохранении в БД: {e}")
+        logger.error("Ошибка при сохранении в БД: %s", e)
         # Сохраняем только в локальный словарь как fallback
-        user_sheets[str(user_id)] = sheet_id
+        user_sheets.set(str(user_id), sheet_id)
         sheet_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}"
-        logger.warning(f"Сохранено только в локальный словарь для пользователя {username}")
+        logger.warning("Сохранено только в локальный словарь для пользователя %s", username)
         await callback.message.edit_text(
             f"✅ Таблица подключена! (временное сохранение)\n\n"
             f"🔗 [Открыть таблицу]({sheet_url})\n\n"
@@ -566,21 +793,21 @@ async def save_table_connection_callback(callback: CallbackQuery, sheet_id: str,
 async def track(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
-    logger.info(f"Команда /track от пользователя {username} (ID: {user_id})")
+    logger.info("Команда /track от пользователя %s (ID: %s)", username, user_id)
     
     if not google_sheets_available:
-        logger.warning(f"Google Sheets недоступен для пользователя {username}")
+        logger.warning("Google Sheets недоступен для пользователя %s", username)
         await message.reply("Google Sheets не настроен. Добавьте файл creds.json для работы с таблицами.")
         return
     
     user_id_str = str(user_id)
-    if user_id_str not in user_sheets:
-        logger.warning(f"Пользователь {username} не подключил таблицу")
+    sheet_id = await get_user_sheet_id(user_id_str)
+    if not sheet_id:
+        logger.warning("Пользователь %s не подключил таблицу", username)
         await message.reply("Сначала отправь ссылку на таблицу через /setsheet")
         return
     
     # Проверяем, есть ли измерения в таблице
-    sheet_id = user_sheets[user_id_str]
     custom_measurements = await get_measurements_from_sheet(sheet_id)
     
     if not custom_measurements:
@@ -594,74 +821,25 @@ async def track(message: Message, state: FSMContext):
     # Начинаем сбор данных с первого измерения
     await state.update_data(custom_measurements=custom_measurements, current_measurement_index=0)
     await ask_next_custom_measurement(message, state)
-    logger.info(f"Начинаем отслеживание для пользователя {username} с {len(custom_measurements)} измерениями")
+    logger.info("Начинаем отслеживание для пользователя %s с %s измерениями", username, len(custom_measurements))
 
 @router.message(Command("status"))
 async def status_command(message: Message):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
-    logger.info(f"Команда /status от пользователя {username} (ID: {user_id})")
+    logger.info("Команда /status от пользователя %s (ID: %s)", username, user_id)
     
     user_id_str = str(user_id)
-    if user_id_str not in user_sheets:
+    sheet_id = await get_user_sheet_id(user_id_str)
+    if not sheet_id:
         status_text = "❌ Таблица не подключена\n\n🔗 Используйте /setsheet <ссылка> для подключения таблицы"
         await message.reply(status_text)
-        logger.info(f"Отправлен статус пользователю {username}")
+        logger.info("Отправлен статус пользователю %s", username)
         return
     
-    try:
-        sheet_id = user_sheets[user_id_str]
-        sheet_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}"
-        
-        # Получаем данные из таблицы
-        if google_sheets_available and client:
-            sheet = client.open_by_key(sheet_id).sheet1
-            all_values = sheet.get_all_values()
-            
-            if len(all_values) <= 1:  # Только заголовки или пустая таблица
-                status_text = f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n📊 Записей: 0\n📝 Используйте кнопку 'Записать данные' для первой записи"
-            else:
-                # Подсчитываем количество записей (исключая заголовок)
-                total_records = len(all_values) - 1
-
-                # Получаем последнюю запись
-                last_record = all_values[-1]
-                last_date = last_record[0] if last_record else "Неизвестно"
-
-                status_text = f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n📊 Всего записей: {total_records}\n📅 Последняя запись: {last_date}\n\n📝 Используйте кнопку 'Записать данные' для новой записи"
-                
-                # Добавляем информацию об измерениях
-                status_text += "\n\n📋 Измерения:"
-                
-                # Предустановленные измерения (из шаблона)
-                status_text += "\n🔧 Предустановленные:"
-                status_text += "\n• Время"
-                status_text += "\n• Настроение (0-10)"
-                status_text += "\n• Комментарий"
-                
-                # Пользовательские измерения
-                user_id_str = str(user_id)
-                custom_measurements = await get_measurements_from_sheet(sheet_id)
-                
-                if custom_measurements:
-                    status_text += "\n\n📊 Пользовательские:"
-                    for measurement in custom_measurements:
-                        if measurement['type'] == 'numeric':
-                            status_text += f"\n• {measurement['name']} (0-{measurement['max_value']})"
-                        else:
-                            status_text += f"\n• {measurement['name']} (текст)"
-                else:
-                    status_text += "\n\n📊 Пользовательских измерений нет"
-                    status_text += "\n💡 Используйте кнопку 'Измерения' для добавления"
-        else:
-            status_text = f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n⚠️ Google Sheets API недоступен\n📝 Используйте кнопку 'Записать данные'"
-            
-    except Exception as e:
-        logger.error(f"Ошибка при получении статуса для пользователя {username}: {str(e)}")
-        status_text = f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n❌ Ошибка при чтении данных: {str(e)}\n📝 Используйте кнопку 'Записать данные'"
-    
+    status_text = await get_status_text(sheet_id, user_id_str, username)
     await message.reply(status_text, parse_mode="Markdown", disable_web_page_preview=True)
-    logger.info(f"Отправлен статус пользователю {username}")
+    logger.info("Отправлен статус пользователю %s", username)
 
 # Обработчики кнопок
 @router.callback_query()
@@ -670,12 +848,13 @@ async def handle_callback(callback: CallbackQuery, state: FSMContext):
     username = callback.from_user.username or "Unknown"
     data = callback.data
     
-    logger.info(f"Нажата кнопка {data} пользователем {username}")
+    logger.info("Нажата кнопка %s пользователем %s", data, username)
     
     if data == "track_data":
         # Проверяем, подключена ли таблица
         user_id_str = str(user_id)
-        if user_id_str not in user_sheets:
+        sheet_id = await get_user_sheet_id(user_id_str)
+        if not sheet_id:
             await callback.answer("❌ Сначала подключите таблицу!", show_alert=True)
             await callback.message.edit_text(
                 "❌ Таблица не подключена\n\n🔗 Используйте /setsheet <ссылка> для подключения таблицы",
@@ -689,62 +868,13 @@ async def handle_callback(callback: CallbackQuery, state: FSMContext):
         
     elif data == "check_status":
         user_id_str = str(user_id)
-        if user_id_str not in user_sheets:
+        sheet_id = await get_user_sheet_id(user_id_str)
+        if not sheet_id:
             status_text = "❌ Таблица не подключена\n\n🔗 Используйте /setsheet <ссылка> для подключения таблицы"
             await callback.message.edit_text(status_text, reply_markup=get_main_keyboard())
             return
         
-        try:
-            sheet_id = user_sheets[user_id_str]
-            sheet_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}"
-            
-            # Получаем данные из таблицы
-            if google_sheets_available and client:
-                sheet = client.open_by_key(sheet_id).sheet1
-                all_values = sheet.get_all_values()
-                
-                if len(all_values) <= 1:  # Только заголовки или пустая таблица
-                    status_text = f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n📊 Записей: 0\n📝 Используйте кнопку 'Записать данные' для первой записи"
-                else:
-                    # Подсчитываем количество записей (исключая заголовок)
-                    total_records = len(all_values) - 1
-                    
-                    # Получаем последнюю запись
-                    last_record = all_values[-1]
-                    last_date = last_record[0] if last_record else "Неизвестно"
-                    
-                    status_text = f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n📊 Всего записей: {total_records}\n📅 Последняя запись: {last_date}\n\n📝 Используйте кнопку 'Записать данные' для новой записи"
-                
-                # Добавляем информацию об измерениях
-                status_text += "\n\n📋 Измерения:"
-                
-                # Предустановленные измерения (из шаблона)
-                status_text += "\n🔧 Предустановленные:"
-                status_text += "\n• Время"
-                status_text += "\n• Настроение (0-10)"
-                status_text += "\n• Комментарий"
-                
-                # Пользовательские измерения
-                user_id_str = str(user_id)
-                custom_measurements = await get_measurements_from_sheet(sheet_id)
-                
-                if custom_measurements:
-                    status_text += "\n\n📊 Пользовательские:"
-                    for measurement in custom_measurements:
-                        if measurement['type'] == 'numeric':
-                            status_text += f"\n• {measurement['name']} (0-{measurement['max_value']})"
-                        else:
-                            status_text += f"\n• {measurement['name']} (текст)"
-                else:
-                    status_text += "\n\n📊 Пользовательских измерений нет"
-                    status_text += "\n💡 Используйте кнопку 'Измерения' для добавления"
-            else:
-                status_text = f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n⚠️ Google Sheets API недоступен\n📝 Используйте кнопку 'Записать данные'"
-                
-        except Exception as e:
-            logger.error(f"Ошибка при получении статуса для пользователя {username}: {str(e)}")
-            status_text = f"✅ Таблица подключена\n🔗 [Открыть таблицу]({sheet_url})\n\n❌ Ошибка при чтении данных: {str(e)}\n📝 Используйте кнопку 'Записать данные'"
-        
+        status_text = await get_status_text(sheet_id, user_id_str, username)
         await callback.message.edit_text(status_text, reply_markup=get_main_keyboard(), parse_mode="Markdown", disable_web_page_preview=True)
         
     elif data == "connect_sheet":
@@ -757,7 +887,8 @@ async def handle_callback(callback: CallbackQuery, state: FSMContext):
     
     elif data == "manage_measurements":
         user_id_str = str(user_id)
-        if user_id_str not in user_sheets:
+        sheet_id = await get_user_sheet_id(user_id_str)
+        if not sheet_id:
             await callback.message.edit_text(
                 "❌ Таблица не подключена\n\n🔗 Используйте /setsheet <ссылка> для подключения таблицы",
                 reply_markup=get_main_keyboard()
@@ -765,31 +896,13 @@ async def handle_callback(callback: CallbackQuery, state: FSMContext):
             return
         
         try:
-            sheet_id = user_sheets[user_id_str]
             measurements = await get_measurements_from_sheet(sheet_id)
-            
-            if not measurements:
-                await callback.message.edit_text(
-                    "📋 В таблице пока нет измерений.\n\n"
-                    "💡 Нажмите 'Добавить измерение' для создания нового.",
-                    reply_markup=get_measurements_keyboard()
-                )
-            else:
-                measurements_text = "📋 Измерения в таблице:\n\n"
-                for i, measurement in enumerate(measurements, 1):
-                    if measurement['type'] == 'numeric':
-                        measurements_text += f"{i}. {measurement['name']} (0-{measurement['max_value']})\n"
-                    else:
-                        measurements_text += f"{i}. {measurement['name']} (текст)\n"
-                
-                measurements_text += "\n💡 Нажмите 'Добавить измерение' для создания нового"
-                
-                await callback.message.edit_text(
-                    measurements_text,
-                    reply_markup=get_measurements_keyboard()
-                )
+            await callback.message.edit_text(
+                get_measurements_text(measurements),
+                reply_markup=get_measurements_keyboard(read_only=sheets.degraded)
+            )
         except Exception as e:
-            logger.error(f"Ошибка при получении измерений для пользователя {username}: {e}")
+            logger.error("Ошибка при получении измерений для пользователя %s: %s", username, e)
             await callback.message.edit_text(
                 "❌ Ошибка при получении измерений из таблицы.",
                 reply_markup=get_main_keyboard()
@@ -803,12 +916,8 @@ async def handle_callback(callback: CallbackQuery, state: FSMContext):
         user_id_str = str(user_id)
         temp_sheet_id = None
         
-        # Попробуем получить из состояния или из текущей таблицы пользователя
-        if user_id_str in user_sheets:
-            temp_sheet_id = user_sheets[user_id_str]
-        else:
-            # Если нет в словаре, попробуем получить из БД
-            temp_sheet_id = await db.get_user_sheet(user_id_str)
+        # Попробуем получить текущую таблицу пользователя (из кэша или БД)
+        temp_sheet_id = await get_user_sheet_id(user_id_str)
         
         if not temp_sheet_id:
             await callback.message.edit_text(
@@ -817,6 +926,10 @@ async def handle_callback(callback: CallbackQuery, state: FSMContext):
             )
             return
         
+        if sheets.degraded:
+            await callback.message.edit_text(READ_ONLY_REFUSAL, reply_markup=get_main_keyboard())
+            return
+        
         success = await initialize_table_template(temp_sheet_id)
         if success:
             await callback.message.edit_text(
@@ -845,6 +958,11 @@ async def handle_callback(callback: CallbackQuery, state: FSMContext):
         )
     
     elif data == "add_measurement":
+        # В режиме только для чтения отказываем сразу, а не после заполнения формы
+        if sheets.degraded:
+            await callback.message.edit_text(READ_ONLY_REFUSAL, reply_markup=get_main_keyboard())
+            return
+        
         # Начинаем процесс добавления измерения
         await callback.message.edit_text(
             "📊 Создание нового измерения\n\n"
@@ -911,86 +1029,86 @@ async def get_fatigue(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
     fatigue = message.text
-    logger.info(f"Получена усталость от {username}: {fatigue}")
+    logger.info("Получена усталость от %s: %s", username, fatigue)
     
     await state.update_data(fatigue=fatigue)
     await message.reply("Настроение (0–10)?")
     await state.set_state(Form.mood)
-    logger.info(f"Переход к состоянию mood для пользователя {username}")
+    logger.info("Переход к состоянию mood для пользователя %s", username)
 
 @router.message(Form.mood)
 async def get_mood(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
     mood = message.text
-    logger.info(f"Получено настроение от {username}: {mood}")
+    logger.info("Получено настроение от %s: %s", username, mood)
     
     await state.update_data(mood=mood)
     await message.reply("Как спал?")
     await state.set_state(Form.sleep)
-    logger.info(f"Переход к состоянию sleep для пользователя {username}")
+    logger.info("Переход к состоянию sleep для пользователя %s", username)
 
 @router.message(Form.sleep)
 async def get_sleep(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
     sleep = message.text
-    logger.info(f"Получен сон от {username}: {sleep}")
+    logger.info("Получен сон от %s: %s", username, sleep)
     
     await state.update_data(sleep=sleep)
     await message.reply("Физическая нагрузка (0–10)?")
     await state.set_state(Form.physical_load)
-    logger.info(f"Переход к состоянию physical_load для пользователя {username}")
+    logger.info("Переход к состоянию physical_load для пользователя %s", username)
 
 @router.message(Form.physical_load)
 async def get_physical_load(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
     physical_load = message.text
-    logger.info(f"Получена физическая нагрузка от {username}: {physical_load}")
+    logger.info("Получена физическая нагрузка от %s: %s", username, physical_load)
     
     await state.update_data(physical_load=physical_load)
     await message.reply("Умственная нагрузка (0–10)?")
     await state.set_state(Form.mental_load)
-    logger.info(f"Переход к состоянию mental_load для пользователя {username}")
+    logger.info("Переход к состоянию mental_load для пользователя %s", username)
 
 @router.message(Form.mental_load)
 async def get_mental_load(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
     mental_load = message.text
-    logger.info(f"Получена умственная нагрузка от {username}: {mental_load}")
+    logger.info("Получена умственная нагрузка от %s: %s", username, mental_load)
     
     await state.update_data(mental_load=mental_load)
     await message.reply("Симптомы (если есть)?")
     await state.set_state(Form.symptoms)
-    logger.info(f"Переход к состоянию symptoms для пользователя {username}")
+    logger.info("Переход к состоянию symptoms для пользователя %s", username)
 
 @router.message(Form.symptoms)
 async def get_symptoms(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
     symptoms = message.text
-    logger.info(f"Получены симптомы от {username}: {symptoms}")
+    logger.info("Получены симптомы от %s: %s", username, symptoms)
     
     await state.update_data(symptoms=symptoms)
     await message.reply("Заметки/комментарии?")
     await state.set_state(Form.notes)
-    logger.info(f"Переход к состоянию notes для пользователя {username}")
+    logger.info("Переход к состоянию notes для пользователя %s", username)
 
 @router.message(Form.notes)
 async def get_notes(message: Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "Unknown"
     notes = message.text
-    logger.info(f"Получены заметки от {username}: {notes}")
+    logger.info("Получены заметки от %s: %s", username, notes)
     
     await state.update_data(notes=notes)
     user_id_str = str(user_id)
     
     # Проверяем, есть ли измерения в таблице
-    if user_id_str in user_sheets:
-        sheet_id = user_sheets[user_id_str]
+    sheet_id = await get_user_sheet_id(user_id_str)
+    if sheet_id:
         custom_measurements = await get_measurements_from_sheet(sheet_id)
         
         if custom_measurements:
@@ -1028,7 +1146,7 @@ async def ask_next_custom_measurement(message: Message, state: FSMContext):
     
     await state.update_data(current_measurement=measurement)
     await state.set_state(Form.custom_measurement)
-    logger.info(f"Спрашиваем измерение: {measurement_name}")
+    logger.info("Спрашиваем измерение: %s", measurement_name)
 
 @router.message(Form.custom_measurement)
 async def get_custom_measurement(message: Message, state: FSMContext):
@@ -1070,8 +1188,9 @@ async def get_custom_measurement(message: Message, state: FSMContext):
         # Все измерения собраны, сохраняем данные
         await save_complete_data(message, state)
     
-    logger.info(f"Получено значение для {measurement_name}: {value}")
+    logger.info("Получено значение для %s: %s", measurement_name, value)
 
+@timed(function_seconds)
 async def save_complete_data(message: Message, state: FSMContext):
     """Сохраняет полные данные в таблицу"""
     user_id = message.from_user.id
@@ -1080,53 +1199,45 @@ async def save_complete_data(message: Message, state: FSMContext):
     user_id_str = str(user_id)
     
     custom_values = data.get('custom_values', {})
-    logger.info(f"Данные для записи от {username}: custom_values={custom_values}")
+    logger.info("Данные для записи от %s: custom_values=%s", username, custom_values)
+
+    sheet_id = await get_user_sheet_id(user_id_str)
 
-    if user_id_str not in user_sheets:
-        logger.error(f"Пользователь {username} не подключил таблицу")
+    if not sheet_id:
+        logger.error("Пользователь %s не подключил таблицу", username)
         await message.reply("Сначала отправь ссылку на таблицу через /setsheet")
         return
 
+    # Пустую таблицу видно по кэшу схемы, без обращения к Google
+    schema = schema_cache.get_stale(sheet_id)
+    if schema is not None and not schema['headers']:
+        await message.reply("❌ Таблица пустая. Проверьте структуру таблицы.")
+        return
+
     try:
-        logger.info(f"Попытка записи в таблицу для пользователя {username}")
-        sheet = client.open_by_key(user_sheets[user_id_str]).sheet1
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
         
-        # Получаем заголовки таблицы
-        all_values = sheet.get_all_values()
-        if not all_values:
-            await message.reply("❌ Таблица пустая. Проверьте структуру таблицы.")
-            return
-        
-        headers = all_values[0]
-        row_data = [now]  # Начинаем с времени
-        
-        # Добавляем значения в том же порядке, что и заголовки (кроме времени)
-        for i, header in enumerate(headers[1:], 1):
-            # Ищем соответствующее измерение
-            value = ''
-            for measurement_name, measurement_value in custom_values.items():
-                if measurement_name.lower() in header.lower() or header.lower() in measurement_name.lower():
-                    value = measurement_value
-                    break
-            row_data.append(value)
-        
-        logger.info(f"Записываем строку: {row_data}")
-        
-        sheet.append_row(row_data)
-        logger.info(f"✅ Данные успешно записаны в таблицу для пользователя {username}")
+        # Запись сохраняется в журнал до любых запросов к Google Sheets. Строку по столбцам
+        # таблицы собирает фоновая очередь (build_sheet_rows) перед записью в таблицу
+        entry_id = await db.add_entry(user_id_str, sheet_id, now, custom_values)
+        await append_queue.enqueue(sheet_id, None, user_id_str, entry_id, custom_values, now)
+        logger.info("✅ Данные поставлены в очередь записи для пользователя %s", username)
         
+        if sheets.degraded:
+            saved_text = "📊 Google Sheets временно недоступен: запись сохранена и появится в таблице, когда он снова заработает."
+        else:
+            saved_text = "📊 Все данные сохранены в таблицу."
         await message.reply(
-            "✅ Записал! 🙌\n\n📊 Все данные сохранены в таблицу.\n\nХотите записать еще одну запись?",
+            f"✅ Записал! 🙌\n\n{saved_text}\n\nХотите записать еще одну запись?",
             reply_markup=get_track_keyboard()
         )
     except Exception as e:
-        logger.error(f"❌ Ошибка при записи в таблицу для пользователя {username}: {str(e)}")
-        logger.error(f"Тип ошибки: {type(e).__name__}")
+        logger.error("❌ Ошибка при записи в таблицу для пользователя %s: %s", username, str(e))
+        logger.error("Тип ошибки: %s", type(e).__name__)
         await message.reply(f"❌ Ошибка при записи в таблицу: {str(e)}")
     
     await state.clear()
-    logger.info(f"Состояние очищено для пользователя {username}")
+    logger.info("Состояние очищено для пользователя %s", username)
 
 
 
@@ -1150,7 +1261,7 @@ async def get_measurement_name(message: Message, state: FSMContext):
         f"Отправьте 1 или 2:"
     )
     await state.set_state(MeasurementForm.measurement_type)
-    logger.info(f"Получено название измерения от {username}: {measurement_name}")
+    logger.info("Получено название измерения от %s: %s", username, measurement_name)
 
 @router.message(MeasurementForm.measurement_type)
 async def get_measurement_type(message: Message, state: FSMContext):
@@ -1176,7 +1287,7 @@ async def get_measurement_type(message: Message, state: FSMContext):
         data = await state.get_data()
         await save_measurement(message, state, data)
     
-    logger.info(f"Получен тип измерения от {username}: {measurement_type}")
+    logger.info("Получен тип измерения от %s: %s", username, measurement_type)
 
 @router.message(MeasurementForm.max_value)
 async def get_max_value(message: Message, state: FSMContext):
@@ -1212,7 +1323,7 @@ async def get_max_value(message: Message, state: FSMContext):
         f"Нажмите 'Сохранить' для создания:",
         reply_markup=keyboard
     )
-    logger.info(f"Получено максимальное значение от {username}: {max_value}")
+    logger.info("Получено максимальное значение от %s: %s", username, max_value)
 
 async def save_measurement(message: Message, state: FSMContext, data: dict):
     """Сохраняет новое измерение в таблицу"""
@@ -1224,15 +1335,21 @@ async def save_measurement(message: Message, state: FSMContext, data: dict):
     measurement_type = data.get('measurement_type')
     max_value = data.get('max_value', 10)
     
-    if user_id_str not in user_sheets:
+    sheet_id = await get_user_sheet_id(user_id_str)
+    
+    if not sheet_id:
         await message.reply(
             "❌ Таблица не подключена. Сначала подключите таблицу.",
             reply_markup=get_measurements_keyboard()
         )
         return
     
+    if sheets.degraded:
+        await message.reply(READ_ONLY_REFUSAL, reply_markup=get_measurements_keyboard())
+        await state.clear()
+        return
+    
     # Добавляем измерение в таблицу
-    sheet_id = user_sheets[user_id_str]
     success = await add_measurement_to_sheet(sheet_id, measurement_name, measurement_type, max_value)
     
     if success:
@@ -1250,7 +1367,7 @@ async def save_measurement(message: Message, state: FSMContext, data: dict):
         )
     
     await state.clear()
-    logger.info(f"Измерение сохранено для пользователя {username}: {measurement_name}")
+    logger.info("Измерение сохранено для пользователя %s: %s", username, measurement_name)
 
 async def save_measurement_callback(callback: CallbackQuery, data: dict, user_id: int, username: str):
     """Сохраняет новое измерение в таблицу через callback"""
@@ -1260,15 +1377,20 @@ async def save_measurement_callback(callback: CallbackQuery, data: dict, user_id
     measurement_type = data.get('measurement_type')
     max_value = data.get('max_value', 10)
     
-    if user_id_str not in user_sheets:
+    sheet_id = await get_user_sheet_id(user_id_str)
+    
+    if not sheet_id:
         await callback.message.edit_text(
             "❌ Таблица не подключена. Сначала подключите таблицу.",
             reply_markup=get_measurements_keyboard()
         )
         return
     
+    if sheets.degraded:
+        await callback.message.edit_text(READ_ONLY_REFUSAL, reply_markup=get_measurements_keyboard())
+        return
+    
     # Добавляем измерение в таблицу
-    sheet_id = user_sheets[user_id_str]
     success = await add_measurement_to_sheet(sheet_id, measurement_name, measurement_type, max_value)
     
     if success:
@@ -1285,90 +1407,102 @@ async def save_measurement_callback(callback: CallbackQuery, data: dict, user_id
             reply_markup=get_measurements_keyboard()
         )
     
-    logger.info(f"Измерение сохранено для пользователя {username}: {measurement_name}")
+    logger.info("Измерение сохранено для пользователя %s: %s", username, measurement_name)
 
-async def main():
-    logger.info("🚀 Запуск бота...")
+# HTTP-сервер метрик (если задан METRICS_PORT)
+metrics_runner = None
+
+async def on_startup():
+    """Подготовка базы данных и фоновых задач перед приемом обновлений"""
+    logger.info("🗄️ Инициализация базы данных...")
+    logger.info("📁 Путь к базе данных: %s", db.db_path)
     
-    try:
-        # Инициализируем базу данных
-        logger.info("🗄️ Инициализация базы данных...")
-        logger.info(f"📁 Путь к базе данных: {db.db_path}")
-        
-        # Проверяем, нужно ли мигрировать данные из временной базы
-        temp_db_path = "/tmp/bot_data.db"
-        if os.path.exists(temp_db_path) and not os.path.exists(db.db_path):
-            logger.info("🔄 Обнаружена временная база данных, выполняем миграцию...")
-            try:
-                import shutil
-                # Создаем директорию для постоянной базы
-                persistent_dir = os.path.dirname(db.db_path)
-                if not os.path.exists(persistent_dir):
-                    os.makedirs(persistent_dir, exist_ok=True)
-                
-                # Копируем данные
-                shutil.copy2(temp_db_path, db.db_path)
-                logger.info("✅ Данные мигрированы в постоянную базу")
-            except Exception as e:
-                logger.error(f"❌ Ошибка при миграции данных: {e}")
-        
+    # Проверяем, нужно ли мигрировать данные из временной базы
+    temp_db_path = "/tmp/bot_data.db"
+    if os.path.exists(temp_db_path) and not os.path.exists(db.db_path):
+        logger.info("🔄 Обнаружена временная база данных, выполняем миграцию...")
         try:
-            await db.init()
-            logger.info("✅ База данных инициализирована успешно")
-            
-            # Проверяем работоспособность базы данных
-            logger.info("🔍 Проверка работоспособности базы данных...")
-            test_user_id = "startup_test_user"
-            test_sheet_id = "startup_test_sheet"
+            import shutil
+            # Создаем директорию для постоянной базы
+            persistent_dir = os.path.dirname(db.db_path)
+            if not os.path.exists(persistent_dir):
+                os.makedirs(persistent_dir, exist_ok=True)
             
-            # Тестируем запись и чтение
-            success = await db.set_user_sheet(test_user_id, test_sheet_id)
-            if success:
-                retrieved_sheet = await db.get_user_sheet(test_user_id)
-                if retrieved_sheet == test_sheet_id:
-                    logger.info("✅ База данных работает корректно")
-                    # Удаляем тестовые данные
-                    await db.remove_user_sheet(test_user_id)
-                else:
-                    logger.warning("⚠️ База данных работает частично (чтение)")
-            else:
-                logger.warning("⚠️ База данных работает частично (запись)")
-                
+            # Копируем данные
+            shutil.copy2(temp_db_path, db.db_path)
+            logger.info("✅ Данные мигрированы в постоянную базу")
         except Exception as e:
-            logger.error(f"❌ Ошибка при инициализации БД: {e}")
-            logger.warning("⚠️ Продолжаем работу без базы данных")
+            logger.error("❌ Ошибка при миграции данных: %s", e)
+    
+    try:
+        await db.init()
+        logger.info("✅ База данных инициализирована успешно")
         
-        # Загружаем данные пользователей из БД
-        logger.info("📥 Загрузка данных пользователей из БД...")
-        global user_sheets
-        try:
-            user_sheets = await db.get_all_user_sheets()
-            logger.info(f"✅ Загружено {len(user_sheets)} привязок пользователей к таблицам")
-            
-            # Логируем информацию о загруженных пользователях
-            if user_sheets:
-                logger.info("📋 Загруженные пользователи:")
-                for user_id, sheet_id in user_sheets.items():
-                    logger.info(f"   Пользователь {user_id} -> Таблица {sheet_id}")
-            else:
-                logger.info("📋 Пользователи не найдены (это нормально для нового деплоя)")
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка при загрузке данных из БД: {e}")
-            user_sheets = {}
-            logger.warning("⚠️ Используем пустой словарь пользователей")
+        # Проверяем работоспособность базы данных
+        logger.info("🔍 Проверка работоспособности базы данных...")
+        test_user_id = f"startup_test_user_{os.getpid()}"
+        test_sheet_id = "startup_test_sheet"
         
-        # Удаляем webhook перед запуском polling
-        logger.info("📡 Удаление webhook...")
-        await bot.delete_webhook(drop_pending_updates=True)
-        logger.info("✅ Webhook удален успешно")
+        # Тестируем запись и чтение
+        success = await db.set_user_sheet(test_user_id, test_sheet_id)
+        if success:
+            retrieved_sheet = await db.get_user_sheet(test_user_id)
+            if retrieved_sheet == test_sheet_id:
+                logger.info("✅ База данных работает корректно")
+                # Удаляем тестовые данные
+                await db.remove_user_sheet(test_user_id)
+            else:
+                logger.warning("⚠️ База данных работает частично (чтение)")
+        else:
+            logger.warning("⚠️ База данных работает частично (запись)")
+            
+    except Exception as e:
+        logger.error("❌ Ошибка при инициализации БД: %s", e)
+        logger.warning("⚠️ Продолжаем работу без базы данных")
+    
+    # Привязки пользователей к таблицам читаются из БД по требованию
+    logger.info("📥 Привязки пользователей загружаются по требованию (кэш до %s пользователей)", user_sheets.maxsize)
+    
+    # Запускаем фоновую запись в таблицы
+    append_queue.start()
+    
+    global metrics_runner
+    metrics_runner = await start_metrics_server()
+
+async def on_shutdown():
+    """Сохранение накопленных данных перед остановкой"""
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    # Дописываем накопленные строки перед остановкой
+    await append_queue.stop()
+    await sheets.close()
+    # Сохраняем состояния незавершенных диалогов
+    await storage.close()
+    await db.close()
+
+async def main():
+    logger.info("🚀 Запуск бота...")
+    
+    try:
+        await on_startup()
         
-        logger.info("🔄 Начинаем polling...")
-        # Запускаем с минимальными настройками
-        await dp.start_polling(bot, skip_updates=True)
+        if BOT_MODE == 'webhook':
+            logger.info("🌐 Запуск в режиме webhook...")
+            await WebhookServer(dp, bot).serve()
+        else:
+            # Удаляем webhook перед запуском polling
+            logger.info("📡 Удаление webhook...")
+            await bot.delete_webhook(drop_pending_updates=True)
+            logger.info("✅ Webhook удален успешно")
+            
+            logger.info("🔄 Начинаем polling...")
+            # Запускаем с минимальными настройками
+            await dp.start_polling(bot, skip_updates=True)
     except Exception as e:
-        logger.error(f"❌ Ошибка при запуске бота: {str(e)}")
+        logger.error("❌ Ошибка при запуске бота: %s", str(e))
         raise
+    finally:
+        await on_shutdown()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,87 @@
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """Предохранитель для внешнего сервиса.
+
+    После failure_threshold ошибок подряд размыкается, и запросы сразу
+    отклоняются. Через reset_timeout секунд пропускает один пробный запрос:
+    при успехе замыкается, при ошибке снова размыкается на reset_timeout.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = None, reset_timeout: float = None):
+        if failure_threshold is None:
+            failure_threshold = int(os.getenv('SHEETS_BREAKER_THRESHOLD', '5'))
+        if reset_timeout is None:
+            reset_timeout = float(os.getenv('SHEETS_BREAKER_RESET_TIMEOUT', '30'))
+
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self.trips = 0
+        self._probe_in_flight = False
+
+    @property
+    def closed(self) -> bool:
+        return self.state == CLOSED
+
+    def allow(self) -> bool:
+        """Можно ли выполнить запрос сейчас"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def retry_after(self) -> float:
+        """Через сколько секунд предохранитель пропустит пробный запрос (0 - уже сейчас)"""
+        if self.state != OPEN:
+            return 0.0
+        return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            logger.info("✅ %s: сервис снова доступен", self.name)
+        self.state = CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            if self.state == CLOSED:
+                self.trips += 1
+                logger.error("❌ %s: %s ошибок подряд, запросы приостановлены на %s с", self.name, self.failures, self.reset_timeout)
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def abandon(self) -> None:
+        """Пробный запрос отменен без результата: следующий запрос станет пробным"""
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'trips': self.trips
+        }
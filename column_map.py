@@ -0,0 +1,77 @@
+import re
+from functools import lru_cache
+from typing import Optional, Dict, List, Tuple
+
+# Суффикс с диапазоном или пояснением в заголовке: "Настроение (0-10)"
+_SUFFIX_RE = re.compile(r'\s*\([^()]*\)\s*$')
+
+
+def normalize_name(name: str) -> str:
+    """Приводит название столбца или измерения к виду для сравнения"""
+    return ' '.join(name.split()).casefold()
+
+
+def base_name(name: str) -> str:
+    """Название без суффикса в скобках в конце"""
+    return normalize_name(_SUFFIX_RE.sub('', name))
+
+
+class ColumnMap:
+    """Соответствие названий измерений столбцам таблицы.
+
+    Строится один раз для набора заголовков. Первый столбец всегда время.
+    Правила сопоставления:
+    1. точное совпадение названия с заголовком (без учета регистра и лишних пробелов);
+    2. если точного совпадения нет - совпадение с заголовком без суффикса
+       в скобках ("Настроение" -> "Настроение (0-10)"), только если такой
+       заголовок единственный.
+    Значения, для которых столбец не найден, в строку не попадают.
+    """
+
+    def __init__(self, headers: Tuple[str, ...]):
+        self.headers = tuple(headers)
+        self.width = len(self.headers)
+        self._exact: Dict[str, int] = {}
+        self._base: Dict[str, Optional[int]] = {}
+        # Уже сопоставленные названия: набор измерений от записи к записи не меняется
+        self._resolved: Dict[str, Optional[int]] = {}
+
+        for index, header in enumerate(self.headers[1:], 1):
+            if not header.strip():
+                continue
+            self._exact.setdefault(normalize_name(header), index)
+            key = base_name(header)
+            # None отмечает неоднозначное базовое название
+            self._base[key] = None if key in self._base else index
+
+    def column_for(self, name: str) -> Optional[int]:
+        """Индекс столбца для измерения или None"""
+        try:
+            return self._resolved[name]
+        except KeyError:
+            pass
+        index = self._exact.get(normalize_name(name))
+        if index is None:
+            index = self._base.get(base_name(name))
+        self._resolved[name] = index
+        return index
+
+    def assemble(self, timestamp: str, values: Dict[str, str]) -> Tuple[List[str], List[str]]:
+        """Собирает строку таблицы; возвращает строку и названия без столбца"""
+        row = [''] * max(self.width, 1)
+        row[0] = timestamp
+        unmatched = []
+        resolved = self._resolved
+        for name, value in values.items():
+            index = resolved[name] if name in resolved else self.column_for(name)
+            if index is None:
+                unmatched.append(name)
+            else:
+                row[index] = value
+        return row, unmatched
+
+
+@lru_cache(maxsize=1024)
+def compile_column_map(headers: Tuple[str, ...]) -> ColumnMap:
+    """Возвращает ColumnMap для набора заголовков (кэшируется по заголовкам)"""
+    return ColumnMap(headers)
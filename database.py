@@ -1,16 +1,96 @@
 import aiosqlite
+import asyncio
 import os
+import json
+import time
 import logging
-from typing import Optional, Dict
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, List, Iterable, Tuple, AsyncIterator
+
+from metrics import instrument_methods, db_query_seconds
 
 logger = logging.getLogger(__name__)
 
+# Миграции схемы: (версия, список запросов). Текущая версия хранится в PRAGMA user_version,
+# новые миграции добавляются в конец списка со следующим номером.
+MIGRATIONS = [
+    (1, [
+        "CREATE INDEX IF NOT EXISTS idx_custom_measurements_user ON custom_measurements (user_id, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_user_sheets_sheet ON user_sheets (sheet_id)",
+    ]),
+    (2, [
+        # Состояния FSM незавершенных диалогов
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            storage_key TEXT PRIMARY KEY,
+            state TEXT,
+            data_json TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states (updated_at)",
+    ]),
+]
+
+@instrument_methods(db_query_seconds)
 class Database:
     def __init__(self, db_path: str = None):
         if db_path is None:
             # В Railway используем переменную окружения или постоянную директорию
             db_path = os.getenv('DATABASE_PATH', '/app/data/bot_data.db')
         self.db_path = db_path
+        # Одно долгоживущее соединение на процесс (открывается в init)
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        # Записи сериализуются, чтобы транзакции разных корутин не смешивались
+        self._write_lock = asyncio.Lock()
+    
+    async def _get_connection(self) -> aiosqlite.Connection:
+        """Возвращает общее соединение, открывая его при первом обращении"""
+        if self._conn is not None:
+            return self._conn
+        async with self._connect_lock:
+            if self._conn is None:
+                conn = await aiosqlite.connect(
+                    self.db_path,
+                    cached_statements=int(os.getenv('DATABASE_CACHED_STATEMENTS', '256'))
+                )
+                await conn.execute("PRAGMA journal_mode=WAL")
+                await conn.execute("PRAGMA synchronous=NORMAL")
+                await conn.execute(f"PRAGMA cache_size=-{int(os.getenv('DATABASE_CACHE_KB', '16384'))}")
+                await conn.execute("PRAGMA temp_store=MEMORY")
+                await conn.execute("PRAGMA busy_timeout=5000")
+                self._conn = conn
+                logger.info("Открыто соединение с базой данных: %s", self.db_path)
+        return self._conn
+    
+    @asynccontextmanager
+    async def _connection(self):
+        """Соединение для чтения"""
+        yield await self._get_connection()
+    
+    @asynccontextmanager
+    async def _transaction(self):
+        """Соединение для записи: коммит при успехе, откат при ошибке или отмене задачи"""
+        conn = await self._get_connection()
+        async with self._write_lock:
+            committed = False
+            try:
+                yield conn
+                await conn.commit()
+                committed = True
+            finally:
+                if not committed:
+                    # Иначе незавершенные изменения закоммитит следующая запись в общем соединении.
+                    # shield: откат доходит до соединения, даже если задачу отменят еще раз
+                    await asyncio.shield(conn.rollback())
+    
+    async def close(self):
+        """Закрывает соединение с базой данных"""
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+            logger.info("Соединение с базой данных закрыто")
     
     async def init(self):
         """Инициализация базы данных"""
@@ -19,11 +99,11 @@ class Database:
         if not os.path.exists(db_dir):
             try:
                 os.makedirs(db_dir, exist_ok=True)
-                logger.info(f"Создана директория для базы данных: {db_dir}")
+                logger.info("Создана директория для базы данных: %s", db_dir)
             except Exception as e:
-                logger.error(f"Ошибка при создании директории {db_dir}: {e}")
+                logger.error("Ошибка при создании директории %s: %s", db_dir, e)
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._transaction() as db:
             # Таблица для привязок пользователей к таблицам
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS user_sheets (
@@ -48,28 +128,68 @@ class Database:
                 )
             """)
             
-            await db.commit()
-            logger.info(f"База данных инициализирована: {self.db_path}")
+            # Журнал записей: основное хранилище данных, копируется в Google Sheets
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    sheet_id TEXT NOT NULL,
+                    recorded_at TEXT NOT NULL,
+                    values_json TEXT NOT NULL,
+                    row_json TEXT NOT NULL,
+                    synced INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_entries_user ON entries (user_id, id)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_entries_unsynced ON entries (id) WHERE synced = 0")
+            
+            # Сводка по таблице: количество записей и последняя запись
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS sheet_summaries (
+                    sheet_id TEXT PRIMARY KEY,
+                    record_count INTEGER NOT NULL DEFAULT 0,
+                    last_timestamp TEXT,
+                    last_values_json TEXT,
+                    reconciled_at REAL NOT NULL DEFAULT 0
+                )
+            """)
+            
+            await self._migrate(db)
+            logger.info("База данных инициализирована: %s", self.db_path)
+    
+    async def _migrate(self, db: aiosqlite.Connection):
+        """Применяет миграции схемы, которые еще не были применены"""
+        async with db.execute("PRAGMA user_version") as cursor:
+            current_version = (await cursor.fetchone())[0]
+        
+        for version, statements in MIGRATIONS:
+            if version <= current_version:
+                continue
+            for statement in statements:
+                await db.execute(statement)
+            # PRAGMA не поддерживает параметры, версия - целое число из MIGRATIONS
+            await db.execute(f"PRAGMA user_version = {int(version)}")
+            logger.info("Применена миграция базы данных до версии %s", version)
     
     async def set_user_sheet(self, user_id: str, sheet_id: str) -> bool:
         """Установить таблицу для пользователя"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._transaction() as db:
                 await db.execute("""
                     INSERT OR REPLACE INTO user_sheets (user_id, sheet_id, updated_at)
                     VALUES (?, ?, CURRENT_TIMESTAMP)
                 """, (user_id, sheet_id))
-                await db.commit()
-                logger.info(f"Таблица {sheet_id} установлена для пользователя {user_id}")
+                logger.info("Таблица %s установлена для пользователя %s", sheet_id, user_id)
                 return True
         except Exception as e:
-            logger.error(f"Ошибка при установке таблицы для пользователя {user_id}: {e}")
+            logger.error("Ошибка при установке таблицы для пользователя %s: %s", user_id, e)
             return False
     
     async def get_user_sheet(self, user_id: str) -> Optional[str]:
         """Получить ID таблицы пользователя"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._connection() as db:
                 async with db.execute(
                     "SELECT sheet_id FROM user_sheets WHERE user_id = ?", 
                     (user_id,)
@@ -77,57 +197,81 @@ class Database:
                     row = await cursor.fetchone()
                     return row[0] if row else None
         except Exception as e:
-            logger.error(f"Ошибка при получении таблицы пользователя {user_id}: {e}")
+            logger.error("Ошибка при получении таблицы пользователя %s: %s", user_id, e)
             return None
     
     async def get_all_user_sheets(self) -> Dict[str, str]:
         """Получить все привязки пользователей к таблицам"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._connection() as db:
                 async with db.execute("SELECT user_id, sheet_id FROM user_sheets") as cursor:
                     rows = await cursor.fetchall()
                     return {row[0]: row[1] for row in rows}
         except Exception as e:
-            logger.error(f"Ошибка при получении всех привязок: {e}")
+            logger.error("Ошибка при получении всех привязок: %s", e)
             return {}
     
+    async def iter_user_sheets(self, batch_size: int = 500) -> AsyncIterator[Tuple[str, str]]:
+        """Потоково перебрать привязки (user_id, sheet_id), не загружая их все в память"""
+        async with self._connection() as db:
+            async with db.execute("SELECT user_id, sheet_id FROM user_sheets") as cursor:
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row[0], row[1]
+    
+    async def set_user_sheets_bulk(self, bindings: Iterable[Tuple[str, str]]) -> bool:
+        """Установить таблицы для многих пользователей одной транзакцией"""
+        bindings = list(bindings)
+        try:
+            async with self._transaction() as db:
+                await db.executemany("""
+                    INSERT OR REPLACE INTO user_sheets (user_id, sheet_id, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                """, bindings)
+                logger.info("Установлено %s привязок таблиц", len(bindings))
+                return True
+        except Exception as e:
+            logger.error("Ошибка при массовой установке привязок таблиц: %s", e)
+            return False
+    
     async def remove_user_sheet(self, user_id: str) -> bool:
         """Удалить привязку таблицы пользователя"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._transaction() as db:
                 await db.execute("DELETE FROM user_sheets WHERE user_id = ?", (user_id,))
-                await db.commit()
-                logger.info(f"Привязка таблицы удалена для пользователя {user_id}")
+                logger.info("Привязка таблицы удалена для пользователя %s", user_id)
                 return True
         except Exception as e:
-            logger.error(f"Ошибка при удалении привязки таблицы для пользователя {user_id}: {e}")
+            logger.error("Ошибка при удалении привязки таблицы для пользователя %s: %s", user_id, e)
             return False
     
     # Методы для работы с пользовательскими измерениями
     async def add_custom_measurement(self, user_id: str, name: str, measurement_type: str, min_value: int = 0, max_value: int = 10) -> bool:
         """Добавить пользовательское измерение"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._transaction() as db:
                 await db.execute("""
                     INSERT INTO custom_measurements (user_id, name, measurement_type, min_value, max_value)
                     VALUES (?, ?, ?, ?, ?)
                 """, (user_id, name, measurement_type, min_value, max_value))
-                await db.commit()
-                logger.info(f"Добавлено измерение '{name}' для пользователя {user_id}")
+                logger.info("Добавлено измерение '%s' для пользователя %s", name, user_id)
                 return True
         except Exception as e:
-            logger.error(f"Ошибка при добавлении измерения для пользователя {user_id}: {e}")
+            logger.error("Ошибка при добавлении измерения для пользователя %s: %s", user_id, e)
             return False
     
     async def get_custom_measurements(self, user_id: str) -> list:
         """Получить все пользовательские измерения пользователя"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._connection() as db:
                 async with db.execute("""
                     SELECT id, name, measurement_type, min_value, max_value 
                     FROM custom_measurements 
                     WHERE user_id = ? 
-                    ORDER BY created_at
+                    ORDER BY created_at, id
                 """, (user_id,)) as cursor:
                     rows = await cursor.fetchall()
                     return [
@@ -141,23 +285,272 @@ class Database:
                         for row in rows
                     ]
         except Exception as e:
-            logger.error(f"Ошибка при получении измерений для пользователя {user_id}: {e}")
+            logger.error("Ошибка при получении измерений для пользователя %s: %s", user_id, e)
             return []
     
+    async def add_custom_measurements_bulk(self, user_id: str, measurements: List[dict]) -> bool:
+        """Добавить несколько пользовательских измерений одной транзакцией"""
+        try:
+            async with self._transaction() as db:
+                await db.executemany("""
+                    INSERT INTO custom_measurements (user_id, name, measurement_type, min_value, max_value)
+                    VALUES (?, ?, ?, ?, ?)
+                """, [
+                    (user_id, m['name'], m['type'], m.get('min_value', 0), m.get('max_value', 10))
+                    for m in measurements
+                ])
+                logger.info("Добавлено %s измерений для пользователя %s", len(measurements), user_id)
+                return True
+        except Exception as e:
+            logger.error("Ошибка при массовом добавлении измерений для пользователя %s: %s", user_id, e)
+            return False
+    
+    async def remove_custom_measurements_bulk(self, user_id: str, measurement_ids: List[int]) -> bool:
+        """Удалить несколько пользовательских измерений одной транзакцией"""
+        try:
+            async with self._transaction() as db:
+                await db.executemany("""
+                    DELETE FROM custom_measurements 
+                    WHERE id = ? AND user_id = ?
+                """, [(measurement_id, user_id) for measurement_id in measurement_ids])
+                logger.info("Удалено %s измерений для пользователя %s", len(measurement_ids), user_id)
+                return True
+        except Exception as e:
+            logger.error("Ошибка при массовом удалении измерений для пользователя %s: %s", user_id, e)
+            return False
+    
     async def remove_custom_measurement(self, user_id: str, measurement_id: int) -> bool:
         """Удалить пользовательское измерение"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._transaction() as db:
                 await db.execute("""
                     DELETE FROM custom_measurements 
                     WHERE id = ? AND user_id = ?
                 """, (measurement_id, user_id))
-                await db.commit()
-                logger.info(f"Удалено измерение {measurement_id} для пользователя {user_id}")
+                logger.info("Удалено измерение %s для пользователя %s", measurement_id, user_id)
                 return True
         except Exception as e:
-            logger.error(f"Ошибка при удалении измерения для пользователя {user_id}: {e}")
+            logger.error("Ошибка при удалении измерения для пользователя %s: %s", user_id, e)
             return False
 
+    # Методы для работы с журналом записей
+    @staticmethod
+    def _entry_from_row(row) -> dict:
+        return {
+            'id': row[0],
+            'user_id': row[1],
+            'sheet_id': row[2],
+            'recorded_at': row[3],
+            'values': json.loads(row[4]),
+            'row': json.loads(row[5]),
+            'synced': bool(row[6])
+        }
+    
+    async def add_entry(self, user_id: str, sheet_id: str, recorded_at: str, values: dict, row: list = None) -> Optional[int]:
+        """Сохранить запись в журнал, возвращает id записи (row=None - строка таблицы собирается при записи в нее)"""
+        try:
+            async with self._transaction() as db:
+                cursor = await db.execute("""
+                    INSERT INTO entries (user_id, sheet_id, recorded_at, values_json, row_json)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (user_id, sheet_id, recorded_at, json.dumps(values, ensure_ascii=False), json.dumps(row, ensure_ascii=False)))
+                return cursor.lastrowid
+        except Exception as e:
+            logger.error("Ошибка при сохранении записи для пользователя %s: %s", user_id, e)
+            return None
+    
+    async def get_unsynced_entries(self, limit: int = 1000, shard: Optional[Tuple[int, int]] = None) -> List[dict]:
+        """Получить записи, еще не скопированные в Google Sheets (в порядке создания).
+
+        shard - (номер процесса, число процессов): только пользователи с
+        user_id % число процессов == номер (как supervisor.shard_for)
+        """
+        shard_clause, params = "", ()
+        if shard is not None:
+            index, workers = shard
+            shard_clause = "AND CAST(user_id AS INTEGER) % ? = ?"
+            params = (workers, index)
+        try:
+            async with self._connection() as db:
+                async with db.execute(f"""
+                    SELECT id, user_id, sheet_id, recorded_at, values_json, row_json, synced
+                    FROM entries
+                    WHERE synced = 0 {shard_clause}
+                    ORDER BY id
+                    LIMIT ?
+                """, params + (limit,)) as cursor:
+                    rows = await cursor.fetchall()
+                    return [self._entry_from_row(row) for row in rows]
+        except Exception as e:
+            logger.error("Ошибка при получении несинхронизированных записей: %s", e)
+            return []
+    
+    async def mark_entries_synced(self, entry_ids: List[int]) -> bool:
+        """Отметить записи как скопированные в Google Sheets"""
+        if not entry_ids:
+            return True
+        try:
+            async with self._transaction() as db:
+                await db.executemany(
+                    "UPDATE entries SET synced = 1 WHERE id = ?",
+                    [(entry_id,) for entry_id in entry_ids]
+                )
+                return True
+        except Exception as e:
+            logger.error("Ошибка при отметке записей %s как синхронизированных: %s", entry_ids, e)
+            return False
+    
+    async def get_last_entry(self, user_id: str) -> Optional[dict]:
+        """Получить последнюю запись пользователя"""
+        entries = await self.get_entries(user_id, limit=1)
+        return entries[0] if entries else None
+    
+    async def get_entries(self, user_id: str, limit: int = 50) -> List[dict]:
+        """Получить последние записи пользователя (новые первыми)"""
+        try:
+            async with self._connection() as db:
+                async with db.execute("""
+                    SELECT id, user_id, sheet_id, recorded_at, values_json, row_json, synced
+                    FROM entries
+                    WHERE user_id = ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                """, (user_id, limit)) as cursor:
+                    rows = await cursor.fetchall()
+                    return [self._entry_from_row(row) for row in rows]
+        except Exception as e:
+            logger.error("Ошибка при получении записей пользователя %s: %s", user_id, e)
+            return []
+    
+    async def count_entries(self, user_id: str) -> int:
+        """Получить количество записей пользователя"""
+        try:
+            async with self._connection() as db:
+                async with db.execute(
+                    "SELECT COUNT(*) FROM entries WHERE user_id = ?",
+                    (user_id,)
+                ) as cursor:
+                    row = await cursor.fetchone()
+                    return row[0] if row else 0
+        except Exception as e:
+            logger.error("Ошибка при подсчете записей пользователя %s: %s", user_id, e)
+            return 0
+
+    # Методы для работы со сводками по таблицам
+    async def get_sheet_summary(self, sheet_id: str) -> Optional[dict]:
+        """Получить сводку по таблице"""
+        try:
+            async with self._connection() as db:
+                async with db.execute("""
+                    SELECT record_count, last_timestamp, last_values_json, reconciled_at
+                    FROM sheet_summaries
+                    WHERE sheet_id = ?
+                """, (sheet_id,)) as cursor:
+                    row = await cursor.fetchone()
+                    if not row:
+                        return None
+                    return {
+                        'record_count': row[0],
+                        'last_timestamp': row[1],
+                        'last_values': json.loads(row[2]) if row[2] else [],
+                        'reconciled_at': row[3]
+                    }
+        except Exception as e:
+            logger.error("Ошибка при получении сводки по таблице %s: %s", sheet_id, e)
+            return None
+    
+    async def set_sheet_summary(self, sheet_id: str, record_count: int, last_timestamp: Optional[str], last_values: list) -> bool:
+        """Сохранить сводку по таблице, сверенную с самой таблицей"""
+        try:
+            async with self._transaction() as db:
+                await db.execute("""
+                    INSERT OR REPLACE INTO sheet_summaries (sheet_id, record_count, last_timestamp, last_values_json, reconciled_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (sheet_id, record_count, last_timestamp, json.dumps(last_values, ensure_ascii=False), time.time()))
+                return True
+        except Exception as e:
+            logger.error("Ошибка при сохранении сводки по таблице %s: %s", sheet_id, e)
+            return False
+    
+    async def add_to_sheet_summary(self, sheet_id: str, added: int, last_timestamp: str, last_values: list) -> bool:
+        """Учесть в сводке новые строки, добавленные в таблицу"""
+        try:
+            async with self._transaction() as db:
+                # Если сводки еще нет, она будет построена при первой сверке
+                await db.execute("""
+                    UPDATE sheet_summaries
+                    SET record_count = record_count + ?, last_timestamp = ?, last_values_json = ?
+                    WHERE sheet_id = ?
+                """, (added, last_timestamp, json.dumps(last_values, ensure_ascii=False), sheet_id))
+                return True
+        except Exception as e:
+            logger.error("Ошибка при обновлении сводки по таблице %s: %s", sheet_id, e)
+            return False
+
+    # Методы для работы с состояниями FSM
+    async def get_fsm_record(self, storage_key: str, min_updated_at: float = 0) -> Optional[dict]:
+        """Получить состояние и данные FSM, обновленные не раньше min_updated_at"""
+        try:
+            async with self._connection() as db:
+                async with db.execute("""
+                    SELECT state, data_json, updated_at
+                    FROM fsm_states
+                    WHERE storage_key = ? AND updated_at >= ?
+                """, (storage_key, min_updated_at)) as cursor:
+                    row = await cursor.fetchone()
+                    if not row:
+                        return None
+                    return {'state': row[0], 'data': json.loads(row[1]), 'updated_at': row[2]}
+        except Exception as e:
+            logger.error("Ошибка при получении состояния FSM %s: %s", storage_key, e)
+            return None
+    
+    async def save_fsm_records(self, records: List[Tuple[str, Optional[str], dict, float]]) -> bool:
+        """Сохранить состояния FSM одной транзакцией; пустые состояния удаляются"""
+        upserts = []
+        deletes = []
+        for storage_key, state, data, updated_at in records:
+            if state is None and not data:
+                deletes.append((storage_key,))
+            else:
+                upserts.append((storage_key, state, json.dumps(data, ensure_ascii=False), updated_at))
+        try:
+            async with self._transaction() as db:
+                if upserts:
+                    await db.executemany("""
+                        INSERT OR REPLACE INTO fsm_states (storage_key, state, data_json, updated_at)
+                        VALUES (?, ?, ?, ?)
+                    """, upserts)
+                if deletes:
+                    await db.executemany("DELETE FROM fsm_states WHERE storage_key = ?", deletes)
+                return True
+        except Exception as e:
+            logger.error("Ошибка при сохранении %s состояний FSM: %s", len(records), e)
+            return False
+    
+    async def delete_expired_fsm_records(self, before: float) -> int:
+        """Удалить состояния FSM, не обновлявшиеся с момента before"""
+        try:
+            async with self._transaction() as db:
+                cursor = await db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (before,))
+                return cursor.rowcount
+        except Exception as e:
+            logger.error("Ошибка при удалении устаревших состояний FSM: %s", e)
+            return 0
+    
+    async def count_fsm_states(self, min_updated_at: float = 0) -> Dict[str, int]:
+        """Количество незавершенных диалогов по состояниям FSM"""
+        try:
+            async with self._connection() as db:
+                async with db.execute("""
+                    SELECT state, COUNT(*) FROM fsm_states
+                    WHERE state IS NOT NULL AND updated_at >= ?
+                    GROUP BY state
+                """, (min_updated_at,)) as cursor:
+                    return {state: count for state, count in await cursor.fetchall()}
+        except Exception as e:
+            logger.error("Ошибка при подсчете состояний FSM: %s", e)
+            return {}
+
 # Глобальный экземпляр базы данных
 db = Database() 
\ No newline at end of file
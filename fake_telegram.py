@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Отправка поддельных обновлений Telegram в локальный вебхук бота
+
+Бот запускается с BOT_MODE=webhook (WEBHOOK_URL можно не задавать), затем:
+    python fake_telegram.py --users 50 --updates 10 --command /status
+
+Скрипт измеряет время подтверждения обновлений вебхуком. Ответы бота
+уходят в настоящий Telegram на несуществующие чаты и завершаются ошибкой -
+это ожидаемо; для проверки используйте тестовый токен.
+"""
+
+import argparse
+import asyncio
+import itertools
+import os
+import statistics
+import time
+
+import aiohttp
+
+_update_ids = itertools.count(1)
+
+
+def make_message_update(user_id: int, text: str) -> dict:
+    """Обновление с текстовым сообщением от пользователя в личном чате"""
+    update_id = next(_update_ids)
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+        }
+    }
+
+
+def make_callback_update(user_id: int, data: str, message_id: int = 1) -> dict:
+    """Обновление с нажатием кнопки под сообщением бота"""
+    update_id = next(_update_ids)
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'},
+                'text': '🏠 Главное меню'
+            }
+        }
+    }
+
+
+async def send_user_updates(session, url, headers, user_id, count, text, latencies, errors):
+    for _ in range(count):
+        started = time.perf_counter()
+        try:
+            async with session.post(url, json=make_message_update(user_id, text), headers=headers) as response:
+                if response.status != 200:
+                    errors.append(response.status)
+        except aiohttp.ClientError as e:
+            errors.append(str(e))
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(args):
+    url = f"http://{args.host}:{args.port}{args.path}"
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+    latencies, errors = [], []
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(
+            send_user_updates(session, url, headers, args.first_user_id + i, args.updates, args.command, latencies, errors)
+            for i in range(args.users)
+        ))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"📨 Отправлено {len(latencies)} обновлений за {elapsed:.2f} с ({len(latencies) / elapsed:.0f} в секунду)")
+    print(f"⏱️ Подтверждение: p50 {statistics.median(latencies) * 1000:.1f} мс, "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} мс, "
+          f"макс {latencies[-1] * 1000:.1f} мс")
+    if errors:
+        print(f"❌ Ошибок: {len(errors)} (например, {errors[0]})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.getenv('WEBHOOK_PORT', '8080')))
+    parser.add_argument('--path', default=os.getenv('WEBHOOK_PATH', '/webhook'))
+    parser.add_argument('--secret', default=os.getenv('WEBHOOK_SECRET', ''))
+    parser.add_argument('--users', type=int, default=10, help='Количество пользователей')
+    parser.add_argument('--updates', type=int, default=5, help='Обновлений от каждого пользователя')
+    parser.add_argument('--command', default='/status', help='Текст сообщения')
+    parser.add_argument('--first-user-id', type=int, default=900000000)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
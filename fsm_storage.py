@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Optional, Dict, Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+from cache import LRUCache
+from database import db as default_db
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram в SQLite.
+
+    Незавершенные диалоги переживают перезапуск бота. Частые вызовы
+    set_state/update_data одного шага объединяются: изменения копятся в памяти
+    и записываются одной транзакцией раз в flush_interval секунд. Недавно
+    использованные состояния держатся в ограниченном горячем слое в памяти,
+    а диалоги, брошенные дольше ttl секунд назад, удаляются.
+    """
+
+    def __init__(self, database=None, flush_interval: float = None, ttl: float = None,
+                 hot_size: int = None, cleanup_interval: float = None):
+        if flush_interval is None:
+            flush_interval = float(os.getenv('FSM_FLUSH_INTERVAL', '0.5'))
+        if ttl is None:
+            ttl = float(os.getenv('FSM_TTL', str(24 * 3600)))
+        if hot_size is None:
+            hot_size = int(os.getenv('FSM_HOT_SIZE', '5000'))
+        if cleanup_interval is None:
+            cleanup_interval = float(os.getenv('FSM_CLEANUP_INTERVAL', '600'))
+
+        self.db = database or default_db
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        # storage_key -> {'state': ..., 'data': {...}, 'updated_at': ...}
+        self._hot = LRUCache(maxsize=hot_size, ttl=ttl)
+        # Измененные, но еще не записанные в БД состояния
+        self._dirty: Dict[str, dict] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._last_cleanup = time.time()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ':'.join(str(part) if part is not None else '' for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            key.business_connection_id, key.destiny
+        ))
+
+    async def _load(self, storage_key: str) -> dict:
+        record = self._dirty.get(storage_key)
+        if record is not None:
+            return record
+        record = self._hot.get(storage_key)
+        if record is not None:
+            return record
+
+        record = await self.db.get_fsm_record(storage_key, min_updated_at=time.time() - self.ttl)
+        if record is None:
+            record = {'state': None, 'data': {}, 'updated_at': time.time()}
+        self._hot.set(storage_key, record)
+        return record
+
+    def _mark_dirty(self, storage_key: str, record: dict) -> None:
+        record['updated_at'] = time.time()
+        self._hot.set(storage_key, record)
+        self._dirty[storage_key] = record
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later(), name="fsm-storage-flush")
+
+    async def _flush_later(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.time() - self._last_cleanup > self.cleanup_interval:
+                await self.cleanup()
+            # Изменения, сделанные во время записи (или не записанные из-за ошибки), ждут следующего цикла
+            if not self._dirty:
+                break
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения одной транзакцией"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        records = [
+            (storage_key, record['state'], record['data'], record['updated_at'])
+            for storage_key, record in dirty.items()
+        ]
+        saved = False
+        try:
+            saved = await self.db.save_fsm_records(records)
+        finally:
+            if not saved:
+                # Возвращаем изменения, которые не были перезаписаны за время записи
+                for storage_key, record in dirty.items():
+                    self._dirty.setdefault(storage_key, record)
+                logger.warning("Не удалось сохранить %s состояний FSM, повтор при следующей записи", len(records))
+
+    async def cleanup(self) -> int:
+        """Удаляет брошенные диалоги старше ttl"""
+        self._last_cleanup = time.time()
+        removed = await self.db.delete_expired_fsm_records(time.time() - self.ttl)
+        if removed:
+            logger.info("Удалено %s устаревших состояний FSM", removed)
+        return removed
+
+    @property
+    def hot_size(self) -> int:
+        return len(self._hot)
+
+    @property
+    def pending_writes(self) -> int:
+        return len(self._dirty)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        record = await self._load(storage_key)
+        record['state'] = state.state if isinstance(state, State) else state
+        self._mark_dirty(storage_key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._load(self._key(key))
+        return record['state']
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key = self._key(key)
+        record = await self._load(storage_key)
+        record['data'] = dict(data)
+        self._mark_dirty(storage_key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._load(self._key(key))
+        return record['data'].copy()
+
+    async def close(self) -> None:
+        """Записывает все изменения перед остановкой"""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
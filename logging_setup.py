@@ -0,0 +1,201 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from typing import Dict, Optional
+
+from tracing import current_trace
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_exception_formatter = logging.Formatter()
+
+
+class JSONFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON; user_id и update_id - из трассы обновления"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+        }
+        for field in ('user_id', 'update_id'):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Передает записи в фоновый поток, не блокируя event loop.
+
+    Текст сообщения собирается здесь (аргументы могут измениться после
+    вызова), к записи добавляются user_id и update_id текущего обновления.
+    Если очередь переполнена (например, диск не успевает), запись
+    отбрасывается и учитывается в dropped.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.listener: Optional[logging.handlers.QueueListener] = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        trace = current_trace()
+        if trace is not None:
+            if getattr(record, 'update_id', None) is None:
+                record.update_id = trace.update_id
+            if getattr(record, 'user_id', None) is None:
+                record.user_id = trace.user_id
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    @property
+    def depth(self) -> int:
+        """Записи, еще не записанные фоновым потоком"""
+        return self.queue.qsize()
+
+
+class SizeTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Ротация файла логов по размеру (max_bytes) и по времени (раз в interval секунд).
+
+    Хранится не больше backup_count старых файлов, поэтому место на диске
+    ограничено примерно (backup_count + 1) * max_bytes.
+    """
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, interval: float):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=max(backup_count, 1),
+                         encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = self._next_rollover()
+
+    def _next_rollover(self) -> float:
+        return time.time() + self.interval if self.interval > 0 else float('inf')
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.rollover_at = self._next_rollover()
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """'aiogram=WARNING,sheets=DEBUG' -> {'aiogram': 'WARNING', 'sheets': 'DEBUG'}"""
+    levels = {}
+    for item in spec.split(','):
+        name, _, level = item.partition('=')
+        name, level = name.strip(), level.strip().upper()
+        if name and level:
+            levels[name] = level
+    return levels
+
+
+def worker_log_file(log_file: str) -> str:
+    """В режиме нескольких процессов у каждого рабочего процесса свой файл: bot.log -> bot.worker1.log"""
+    index = os.getenv('WORKER_INDEX')
+    if not log_file or index is None:
+        return log_file
+    root, ext = os.path.splitext(log_file)
+    return f"{root}.worker{index}{ext}"
+
+
+# Настроенный конвейер логов процесса
+_pipeline: Optional[ContextQueueHandler] = None
+
+
+def setup_logging(level: str = None, log_file: str = None, console_format: str = None,
+                  module_levels: Dict[str, str] = None, text_format: str = TEXT_FORMAT) -> ContextQueueHandler:
+    """Настраивает логирование процесса через очередь и фоновый поток.
+
+    Обработчики логов (консоль и файл) работают в потоке QueueListener,
+    поэтому медленный диск не останавливает event loop. В файл пишется
+    JSON (по строке на запись), в консоль - текст или JSON (LOG_FORMAT=text,
+    json или off - без вывода в консоль).
+    Повторный вызов возвращает уже настроенный обработчик.
+    """
+    global _pipeline
+    if _pipeline is not None:
+        return _pipeline
+
+    if level is None:
+        level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    if log_file is None:
+        log_file = os.getenv('LOG_FILE', 'bot.log')
+    if console_format is None:
+        console_format = os.getenv('LOG_FORMAT', 'text').lower()
+    if module_levels is None:
+        module_levels = parse_levels(os.getenv('LOG_LEVELS', ''))
+
+    handlers = []
+    if console_format != 'off':
+        console = logging.StreamHandler()
+        console.setFormatter(JSONFormatter() if console_format == 'json' else logging.Formatter(text_format))
+        handlers.append(console)
+
+    log_file = worker_log_file(log_file)
+    if log_file:
+        file_handler = SizeTimeRotatingFileHandler(
+            log_file,
+            max_bytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+            backup_count=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+            interval=float(os.getenv('LOG_ROTATE_INTERVAL', str(24 * 3600)))
+        )
+        file_handler.setFormatter(JSONFormatter())
+        handlers.append(file_handler)
+
+    queue_handler = ContextQueueHandler(queue.Queue(int(os.getenv('LOG_QUEUE_SIZE', '10000'))))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for name, module_level in module_levels.items():
+        logging.getLogger(name).setLevel(module_level)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    queue_handler.listener = listener
+    atexit.register(stop_logging)
+
+    _pipeline = queue_handler
+    return queue_handler
+
+
+def stop_logging() -> None:
+    """Дописывает оставшиеся в очереди записи и останавливает фоновый поток"""
+    if _pipeline is None or _pipeline.listener is None:
+        return
+    listener, _pipeline.listener = _pipeline.listener, None
+    try:
+        listener.stop()
+    except queue.Full:
+        pass
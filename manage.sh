@@ -5,6 +5,8 @@
 
 BOT_SCRIPT="bot.py"
 LOG_FILE="bot.log"
+# Вывод процесса (ошибки запуска); логи бот пишет в LOG_FILE сам, с ротацией
+OUT_FILE="bot.err"
 PID_FILE="bot.pid"
 
 # Цвета для вывода
@@ -43,7 +45,7 @@ start_bot() {
     fi
     
     # Запускаем бота в фоне
-    source venv/bin/activate && python "$BOT_SCRIPT" > "$LOG_FILE" 2>&1 &
+    source venv/bin/activate && LOG_FORMAT=off python "$BOT_SCRIPT" > "$OUT_FILE" 2>&1 &
     local pid=$!
     echo $pid > "$PID_FILE"
     
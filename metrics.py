@@ -0,0 +1,268 @@
+import functools
+import inspect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional, Callable, Dict, List, Tuple
+
+from aiohttp import web
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Content-Type текстового формата Prometheus
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам (задержки в секундах)"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # labels -> [счетчики по корзинам (не накопительные), сумма, количество]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = [[0] * len(self.buckets), 0.0, 0]
+            self._series[key] = series
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][index] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет время выполнения блока"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Значение, которое вычисляется при каждом чтении метрик.
+
+    collect возвращает число или словарь {кортеж значений меток: число};
+    может быть корутиной (например, запрос к базе данных). Для счетчиков,
+    которые ведет сам объект (например, LRUCache.hits), kind='counter'.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, collect: Callable, labelnames: Tuple[str, ...] = (),
+                 kind: str = 'gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+        self.kind = kind
+
+    async def render_async(self) -> List[str]:
+        result = self.collect()
+        if inspect.isawaitable(result):
+            result = await result
+        if not isinstance(result, dict):
+            result = {(): result}
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in result.items()]
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса с выводом в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        # Именованные LRU-кэши для метрик cache_*
+        self._caches: Dict[str, object] = {}
+        for field, name, documentation, kind in (
+            ('hits', 'cache_hits_total', 'Попадания в кэш', 'counter'),
+            ('misses', 'cache_misses_total', 'Промахи кэша', 'counter'),
+            ('hit_rate', 'cache_hit_ratio', 'Доля попаданий в кэш', 'gauge'),
+            ('size', 'cache_entries', 'Записей в кэше', 'gauge'),
+        ):
+            self.gauge(name, documentation, functools.partial(self._cache_stat, field), ('cache',), kind)
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, collect: Callable, labelnames: Tuple[str, ...] = (),
+              kind: str = 'gauge') -> Gauge:
+        """Регистрирует (или заменяет) вычисляемое значение"""
+        metric = Gauge(name, documentation, collect, labelnames, kind)
+        self._metrics[name] = metric
+        return metric
+
+    def track_cache(self, name: str, cache) -> None:
+        """Добавляет попадания, промахи и размер LRUCache в метрики cache_*"""
+        self._caches[name] = cache
+
+    def _cache_stat(self, field: str) -> dict:
+        return {(name,): cache.stats()[field] for name, cache in self._caches.items()}
+
+    async def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                body = await metric.render_async() if isinstance(metric, Gauge) else metric.render()
+            except Exception as e:
+                logger.warning("Не удалось собрать метрику %s: %s", metric.name, e)
+                continue
+            lines.extend(metric.header())
+            lines.extend(body)
+        return '\n'.join(lines) + '\n'
+
+
+# Глобальный реестр метрик процесса
+registry = MetricsRegistry()
+
+db_query_seconds = registry.histogram(
+    'db_query_seconds', 'Время выполнения методов Database', ('method', 'status')
+)
+function_seconds = registry.histogram(
+    'bot_function_seconds', 'Время выполнения отдельных функций бота', ('method', 'status')
+)
+
+
+def instrument_methods(histogram: Histogram, span_kind: str = 'db'):
+    """Декоратор класса: замеряет время всех публичных async-методов (и добавляет их в трассу)"""
+    def decorate(cls):
+        for attr, function in list(vars(cls).items()):
+            if attr.startswith('_') or not inspect.iscoroutinefunction(function):
+                continue
+            setattr(cls, attr, _timed(histogram, attr, function, span_kind))
+        return cls
+    return decorate
+
+
+def timed(histogram: Histogram, name: str = None, span_kind: str = 'function'):
+    """Декоратор async-функции: замеряет время выполнения (и добавляет вызов в трассу)"""
+    def decorate(function):
+        return _timed(histogram, name or function.__name__, function, span_kind)
+    return decorate
+
+
+def _timed(histogram: Histogram, name: str, function, span_kind: str):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            with span(span_kind, name):
+                return await function(*args, **kwargs)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started, method=name, status=status)
+    return wrapper
+
+
+async def start_metrics_server(host: str = None, port: Optional[int] = None):
+    """Запускает HTTP-сервер с /metrics, если задан METRICS_PORT; возвращает AppRunner"""
+    if port is None:
+        if not os.getenv('METRICS_PORT'):
+            return None
+        # В режиме нескольких процессов у каждого свой порт
+        port = int(os.getenv('METRICS_PORT')) + int(os.getenv('WORKER_INDEX', '0'))
+    if host is None:
+        host = os.getenv('METRICS_HOST', '0.0.0.0')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("📈 Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    body = await registry.render()
+    return web.Response(body=body.encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, CallbackQuery, Update
+
+from metrics import registry
+from tracing import SlowTraceWriter, Profiler, start_trace, current_trace, span
+
+logger = logging.getLogger(__name__)
+
+handler_seconds = registry.histogram(
+    'bot_handler_seconds', 'Время обработки команд, сообщений и кнопок', ('handler', 'event', 'status')
+)
+
+# callback_data кнопок бота; остальное (подделанные данные) не создает новых рядов метрик
+_CALLBACK_DATA_RE = re.compile(r'^[a-z_]{1,40}$')
+
+
+def event_label(event: TelegramObject) -> str:
+    """Метка события: данные кнопки или команда"""
+    if isinstance(event, CallbackQuery):
+        data = event.data or ''
+        return data if _CALLBACK_DATA_RE.match(data) else 'other'
+    text = getattr(event, 'text', None) or ''
+    if text.startswith('/'):
+        return 'command'
+    return 'message'
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замеряет время каждого обработчика (регистрируется как внутренняя middleware роутера)"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        trace = current_trace()
+        if trace is not None:
+            trace.handler = name
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            with span('handler', name):
+                return await handler(event, data)
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            handler_seconds.observe(
+                time.perf_counter() - started, handler=name, event=event_label(event), status=status
+            )
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Трасса каждого обновления (внешняя middleware dp.update).
+
+    Спаны вызовов Sheets, БД и Telegram собираются в трассу, и если
+    обновление обрабатывалось дольше TRACE_SLOW_THRESHOLD секунд, трасса
+    дописывается в TRACE_FILE. Здесь же включается выборочное
+    профилирование (PROFILE_MODE).
+    """
+
+    def __init__(self, writer: SlowTraceWriter = None, profiler: Profiler = None):
+        self.writer = writer or SlowTraceWriter()
+        self.profiler = profiler or Profiler()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        with start_trace(event.update_id, user.id if user else None, event.event_type) as trace:
+            try:
+                with self.profiler.maybe_profile(event.update_id):
+                    return await handler(event, data)
+            except Exception:
+                trace.status = 'error'
+                raise
+            finally:
+                # Трасса записывается до выхода из start_trace, поэтому длительность фиксируем здесь
+                trace.finish()
+                if self.writer.should_write(trace):
+                    logger.warning("🐢 Обновление %s (%s) обработано за %.2f с", event.update_id, trace.handler, trace.duration)
+                    try:
+                        await asyncio.to_thread(self.writer.write, trace)
+                    except OSError as e:
+                        logger.error("Не удалось записать трассу: %s", e)
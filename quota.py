@@ -0,0 +1,155 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import time
+from contextlib import contextmanager
+from typing import Optional, List
+
+# Приоритеты запросов: меньше - важнее
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar('sheets_priority', default=INTERACTIVE)
+
+
+@contextmanager
+def background():
+    """Помечает запросы к API внутри блока (и созданных в нем задач) как фоновые"""
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 32.0) -> float:
+    """Экспоненциальная задержка со случайным разбросом (full jitter)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """Ведро токенов с очередью ожидающих по приоритету.
+
+    Токены пополняются равномерно со скоростью rate_per_minute, в запасе
+    не больше burst. Если токенов нет, запрос ждет в очереди, а не
+    завершается ошибкой; интерактивные запросы выходят из очереди раньше
+    фоновых, внутри одного приоритета - в порядке поступления.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: float):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.waited = 0
+        self.throttled = 0
+        # (приоритет, порядковый номер, future)
+        self._waiters: List[tuple] = []
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Task] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, priority: int = INTERACTIVE) -> None:
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+
+        self.waited += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._wakeup is None or self._wakeup.done():
+            self._wakeup = asyncio.create_task(self._release_waiters())
+        await future
+
+    async def _release_waiters(self) -> None:
+        while self._waiters:
+            self._refill()
+            while self._waiters and self.tokens >= 1:
+                _, _, future = heapq.heappop(self._waiters)
+                # Отмененный запрос токен не тратит
+                if not future.done():
+                    self.tokens -= 1
+                    future.set_result(None)
+            if self._waiters:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self) -> None:
+        """Сбрасывает запас после ответа 429: квота исчерпана и для остальных запросов"""
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+        self.throttled += 1
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+
+def worker_count() -> int:
+    """Сколько процессов делят квоту сервисного аккаунта (WORKERS в рабочем процессе supervisor.py)"""
+    if os.getenv('WORKER_INDEX') is None:
+        return 1
+    return max(int(os.getenv('WORKERS', '1')), 1)
+
+
+class QuotaScheduler:
+    """Раздельные квоты на чтение и запись Google Sheets API.
+
+    По умолчанию соответствует квоте Google на одного пользователя
+    (сервисный аккаунт): 60 запросов чтения и 60 запросов записи в минуту.
+    Квоты считаются в каждом процессе отдельно, поэтому в рабочих процессах
+    supervisor.py скорость и запас из настроек делятся на WORKERS: вместе
+    процессы не превышают квоту аккаунта.
+    """
+
+    def __init__(self, read_per_minute: float = None, write_per_minute: float = None, burst: float = None):
+        if read_per_minute is None:
+            read_per_minute = float(os.getenv('SHEETS_READ_PER_MINUTE', '60'))
+        if write_per_minute is None:
+            write_per_minute = float(os.getenv('SHEETS_WRITE_PER_MINUTE', '60'))
+        if burst is None:
+            burst = float(os.getenv('SHEETS_QUOTA_BURST', '10'))
+
+        workers = worker_count()
+        if workers > 1:
+            read_per_minute /= workers
+            write_per_minute /= workers
+            burst = max(burst / workers, 1)
+
+        self.read = TokenBucket(read_per_minute, burst)
+        self.write = TokenBucket(write_per_minute, burst)
+
+    def bucket(self, write: bool) -> TokenBucket:
+        return self.write if write else self.read
+
+    async def acquire(self, write: bool = False, priority: int = None) -> None:
+        """Ждет разрешения на запрос; приоритет по умолчанию берется из контекста"""
+        if priority is None:
+            priority = current_priority()
+        await self.bucket(write).acquire(priority)
+
+    def throttle(self, write: bool) -> None:
+        self.bucket(write).throttle()
+
+    def stats(self) -> dict:
+        """Счетчики ожиданий и ответов 429 по ведрам"""
+        return {
+            name: {
+                'tokens': round(bucket.tokens, 2),
+                'queued': bucket.queued,
+                'waited': bucket.waited,
+                'throttled': bucket.throttled
+            }
+            for name, bucket in (('read', self.read), ('write', self.write))
+        }
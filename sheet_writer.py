@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+from typing import Optional, Awaitable, Callable, Dict, List, Set, Tuple
+
+from database import db
+from quota import background, backoff_delay
+from sheets import sheets as default_gateway, SheetsUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# Маркер остановки фоновой задачи
+_STOP = object()
+
+
+class AppendQueue:
+    """Фоновая запись строк в Google Sheets.
+
+    Строки попадают в очередь и подтверждаются пользователю сразу, а фоновая
+    задача объединяет накопившиеся строки каждой таблицы в один запрос
+    values.append. Сброс происходит, когда накопилось batch_size строк или
+    прошло flush_interval секунд с первой строки в пачке. Порядок строк
+    внутри таблицы (а значит, и для каждого пользователя) сохраняется:
+    если запись не удалась, строки остаются в начале очереди таблицы, а
+    более новые строки ждут за ними. Попытки повторяются с растущей паузой;
+    после max_attempts неудач подряд каждая следующая пишется в лог как ошибка.
+
+    Записи из журнала (таблица entries) отмечаются как синхронизированные
+    после успешной записи. Несинхронизированные записи периодически ставятся
+    в очередь повторно, в том числе после перезапуска бота.
+
+    Доставка "хотя бы один раз": если values.append дошел до Google, но ответ
+    не получен (таймаут, обрыв соединения, остановка бота), запись остается
+    несинхронизированной и при следующей синхронизации будет добавлена в
+    таблицу еще раз. Такие дубли возможны, потери строк - нет.
+    """
+
+    def __init__(self, gateway=None, batch_size: int = None, flush_interval: float = None,
+                 max_attempts: int = None, resync_interval: float = None):
+        if batch_size is None:
+            batch_size = int(os.getenv('SHEETS_APPEND_BATCH_SIZE', '50'))
+        if flush_interval is None:
+            flush_interval = float(os.getenv('SHEETS_APPEND_FLUSH_INTERVAL', '2'))
+        if max_attempts is None:
+            max_attempts = int(os.getenv('SHEETS_APPEND_MAX_ATTEMPTS', '5'))
+        if resync_interval is None:
+            resync_interval = float(os.getenv('SHEETS_RESYNC_INTERVAL', '300'))
+
+        self.gateway = gateway or default_gateway
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.resync_interval = resync_interval
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._resync_task: Optional[asyncio.Task] = None
+        # id записей журнала, которые уже стоят в очереди
+        self._queued_ids: Set[int] = set()
+        # sheet_id -> строки, ожидающие записи (в порядке поступления)
+        self._pending: Dict[str, List[dict]] = {}
+        self._pending_rows = 0
+        # sheet_id -> количество неудачных попыток записи подряд
+        self._attempts: Dict[str, int] = {}
+        # Какие записи журнала синхронизирует этот процесс: (номер процесса, число процессов), None - все
+        self.shard: Optional[Tuple[int, int]] = None
+        # Вызывается с sheet_id после успешной записи строк (например, чтобы сбросить кэши)
+        self.on_written: Optional[Callable[[str], None]] = None
+        # Собирает строки таблицы для записей без готовой строки (по recorded_at и values)
+        self.build_rows: Optional[Callable[[str, List[dict]], Awaitable[List[list]]]] = None
+
+    def start(self) -> None:
+        """Запускает фоновую задачу записи"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="sheets-append-queue")
+            self._resync_task = asyncio.create_task(self._resync_loop(), name="sheets-resync")
+            logger.info("Очередь записи запущена (пачка до %s строк, интервал %s с)", self.batch_size, self.flush_interval)
+
+    async def enqueue(self, sheet_id: str, row: Optional[list], user_id: str = None, entry_id: int = None,
+                      values: dict = None, recorded_at: str = None) -> None:
+        """Ставит строку в очередь на запись в таблицу.
+
+        Если row не задана, строка собирается из values и recorded_at
+        (build_rows) непосредственно перед записью.
+        """
+        if entry_id is not None:
+            if entry_id in self._queued_ids:
+                return
+            self._queued_ids.add(entry_id)
+        await self._queue.put({
+            'sheet_id': sheet_id, 'row': row, 'user_id': user_id, 'entry_id': entry_id,
+            'values': values, 'recorded_at': recorded_at
+        })
+
+    async def resync(self) -> int:
+        """Ставит в очередь записи журнала, еще не скопированные в таблицы"""
+        # Отбор по сегменту - в запросе, иначе LIMIT отдал бы записи чужих сегментов
+        entries = await db.get_unsynced_entries(shard=self.shard)
+        queued = 0
+        for entry in entries:
+            if entry['id'] not in self._queued_ids:
+                await self.enqueue(entry['sheet_id'], entry['row'], entry['user_id'], entry['id'],
+                                   entry['values'], entry['recorded_at'])
+                queued += 1
+        if queued:
+            logger.info("🔄 Поставлено в очередь %s несинхронизированных записей журнала", queued)
+        return queued
+
+    async def _resync_loop(self) -> None:
+        while True:
+            try:
+                await self.resync()
+            except Exception as e:
+                logger.error("Ошибка при синхронизации журнала записей: %s", e)
+            await asyncio.sleep(self.resync_interval)
+
+    @property
+    def depth(self) -> int:
+        """Количество строк, еще не записанных в таблицы"""
+        return self._queue.qsize() + self._pending_rows
+
+    async def stop(self) -> None:
+        """Сбрасывает все накопленные строки и останавливает фоновую задачу"""
+        if self._task is None or self._task.done():
+            return
+        if self._resync_task is not None:
+            self._resync_task.cancel()
+        await self._queue.put(_STOP)
+        await self._task
+        logger.info("Очередь записи остановлена")
+
+    def _add(self, item: dict) -> None:
+        self._pending.setdefault(item['sheet_id'], []).append(item)
+        self._pending_rows += 1
+
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            if not self._pending:
+                item = await self._queue.get()
+                if item is _STOP:
+                    break
+                self._add(item)
+
+            # Собираем пачку до заполнения или до истечения интервала
+            stopping = await self._collect(self.flush_interval)
+            await self._flush()
+
+            if self._pending and not stopping:
+                # Строки не записаны: ждем перед следующей попыткой, продолжая принимать новые
+                stopping = await self._collect(self._retry_delay(), until_full=False)
+
+        # Дописываем все, что осталось в очереди на момент остановки
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                self._add(item)
+        await self._flush(final=True)
+
+    async def _collect(self, timeout: float, until_full: bool = True) -> bool:
+        """Добавляет строки из очереди в пачку в течение timeout секунд; True - получен сигнал остановки"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not (until_full and self._pending_rows >= self.batch_size):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if item is _STOP:
+                return True
+            self._add(item)
+        return False
+
+    def _retry_delay(self) -> float:
+        """Пауза после неудачной записи: пока предохранитель разомкнут, с ростом задержки после ошибок"""
+        delay = self.gateway.breaker.retry_after()
+        attempts = max(self._attempts.values(), default=0)
+        if attempts:
+            # Попытки не ограничены, а задержка ограничена сверху: степень больше не нужна
+            delay = max(delay, backoff_delay(min(attempts, 10)))
+        return max(delay, self.flush_interval)
+
+    async def _flush(self, final: bool = False) -> None:
+        if not self._pending:
+            return
+        batches = list(self._pending.items())
+        await asyncio.gather(*(self._flush_sheet(sheet_id, items, final) for sheet_id, items in batches))
+
+    async def _build_rows(self, sheet_id: str, items: List[dict]) -> None:
+        """Собирает строки для записей, поставленных в очередь без готовой строки"""
+        missing = [item for item in items if item['row'] is None]
+        if not missing:
+            return
+        if self.build_rows is None:
+            raise RuntimeError("Не задан build_rows для записей без строки")
+        for item, row in zip(missing, await self.build_rows(sheet_id, missing)):
+            item['row'] = row
+
+    async def _flush_sheet(self, sheet_id: str, items: List[dict], final: bool) -> None:
+        try:
+            # Запись в фоне уступает квоту запросам пользователей
+            with background():
+                await self._build_rows(sheet_id, items)
+                rows = [item['row'] for item in items]
+                await self.gateway.append_rows(sheet_id, rows)
+        except SheetsUnavailableError:
+            # Попытка не засчитывается: строки ждут, пока Google Sheets снова станет доступен
+            return
+        except Exception as e:
+            attempts = self._attempts.get(sheet_id, 0) + 1
+            if not final:
+                # Строки остаются в начале очереди таблицы: новые строки не обгонят их
+                self._attempts[sheet_id] = attempts
+                if attempts < self.max_attempts:
+                    logger.warning("Не удалось записать %s строк в таблицу %s (попытка %s): %s", len(items), sheet_id, attempts, e)
+                else:
+                    logger.error("❌ Строки для таблицы %s не записаны после %s попыток, повторим позже: %s", sheet_id, attempts, e)
+                return
+            logger.error("❌ Строки для таблицы %s не записаны до остановки: %s", sheet_id, e)
+        else:
+            logger.info("✅ Записано %s строк в таблицу %s", len(rows), sheet_id)
+            await db.mark_entries_synced([item['entry_id'] for item in items if item['entry_id'] is not None])
+            await db.add_to_sheet_summary(sheet_id, len(rows), rows[-1][0], rows[-1])
+            if self.on_written is not None:
+                self.on_written(sheet_id)
+
+        # Не записанные до остановки строки остаются в журнале и будут поставлены в очередь после запуска
+        for item in items:
+            self._queued_ids.discard(item['entry_id'])
+        self._attempts.pop(sheet_id, None)
+        self._pending.pop(sheet_id, None)
+        self._pending_rows -= len(items)
+
+
+# Глобальная очередь записи в таблицы
+append_queue = AppendQueue()
@@ -0,0 +1,598 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, List, Tuple
+from urllib.parse import quote
+
+import aiohttp
+from google.auth import crypt, jwt
+
+from cache import LRUCache
+from circuit_breaker import CircuitBreaker
+from metrics import registry
+from tracing import span
+from quota import QuotaScheduler, backoff_delay, current_priority
+
+logger = logging.getLogger(__name__)
+
+SHEETS_API_URL = "https://sheets.googleapis.com/v4/spreadsheets"
+SHEETS_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+DEFAULT_TOKEN_URI = "https://oauth2.googleapis.com/token"
+
+# Статусы, после которых запрос повторяется с задержкой
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+sheets_requests = registry.counter(
+    'sheets_requests_total', 'Запросы к Google Sheets API', ('operation', 'status')
+)
+sheets_reads = registry.counter(
+    'sheets_reads_total', 'Чтения из Google Sheets: выполненные запросом к API и присоединенные к уже идущему', ('operation', 'result')
+)
+sheets_request_seconds = registry.histogram(
+    'sheets_request_seconds', 'Время запросов к Google Sheets API (с ожиданием слотов)', ('operation',)
+)
+
+
+class SheetsAPIError(Exception):
+    """Ошибка ответа Google Sheets API"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Sheets API {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class SheetsUnavailableError(SheetsAPIError):
+    """Запрос отклонен без обращения к API: Google Sheets недавно не отвечал"""
+
+    def __init__(self):
+        super().__init__(503, "Google Sheets временно недоступен")
+
+
+async def read_error(response: aiohttp.ClientResponse) -> SheetsAPIError:
+    """Ошибка по ответу со статусом >= 400; тело может быть HTML (502/503 от фронтенда Google)"""
+    text = await response.text()
+    try:
+        payload = json.loads(text)
+    except ValueError:
+        return SheetsAPIError(response.status, text[:200] or response.reason or '')
+    if isinstance(payload, dict):
+        error = payload.get('error')
+        if isinstance(error, dict):
+            return SheetsAPIError(response.status, error.get('message', str(payload)))
+        if isinstance(error, str):
+            # Ответ OAuth: {"error": "invalid_grant", "error_description": "..."}
+            return SheetsAPIError(response.status, payload.get('error_description', error))
+    return SheetsAPIError(response.status, str(payload))
+
+
+def column_letter(index: int) -> str:
+    """Преобразует номер столбца (с 1) в буквенное обозначение A1"""
+    letters = ''
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def column_index(letters: str) -> int:
+    """Преобразует буквенное обозначение столбца в номер (с 1)"""
+    index = 0
+    for char in letters.upper():
+        index = index * 26 + (ord(char) - ord('A') + 1)
+    return index
+
+
+def quote_worksheet(title: str) -> str:
+    """Экранирует название листа для A1-нотации"""
+    return "'" + title.replace("'", "''") + "'"
+
+
+def a1_to_grid_range(a1_range: str, worksheet_id: int) -> dict:
+    """Преобразует диапазон вида 'A1' или 'A1:D1' в GridRange"""
+    def parse_cell(cell: str) -> Tuple[int, int]:
+        letters = ''.join(c for c in cell if c.isalpha())
+        digits = ''.join(c for c in cell if c.isdigit())
+        return int(digits), column_index(letters)
+
+    start, _, end = a1_range.partition(':')
+    start_row, start_col = parse_cell(start)
+    end_row, end_col = parse_cell(end) if end else (start_row, start_col)
+    return {
+        'sheetId': worksheet_id,
+        'startRowIndex': start_row - 1,
+        'endRowIndex': end_row,
+        'startColumnIndex': start_col - 1,
+        'endColumnIndex': end_col
+    }
+
+
+class ServiceAccountToken:
+    """Access token сервисного аккаунта, переиспользуемый до истечения срока"""
+
+    def __init__(self, credentials_info: dict, scopes: List[str] = None):
+        self.client_email = credentials_info['client_email']
+        self.token_uri = credentials_info.get('token_uri', DEFAULT_TOKEN_URI)
+        self.scopes = scopes or SHEETS_SCOPES
+        self._signer = crypt.RSASigner.from_service_account_info(credentials_info)
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _assertion(self) -> str:
+        now = int(time.time())
+        payload = {
+            'iss': self.client_email,
+            'scope': ' '.join(self.scopes),
+            'aud': self.token_uri,
+            'iat': now,
+            'exp': now + 3600
+        }
+        return jwt.encode(self._signer, payload).decode('utf-8')
+
+    async def get(self, session: aiohttp.ClientSession) -> str:
+        """Возвращает действующий токен, обновляя его за минуту до истечения"""
+        if self._token and time.monotonic() < self._expires_at:
+            return self._token
+
+        async with self._lock:
+            if self._token and time.monotonic() < self._expires_at:
+                return self._token
+
+            data = {
+                'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
+                'assertion': self._assertion()
+            }
+            async with session.post(self.token_uri, data=data) as response:
+                if response.status != 200:
+                    raise await read_error(response)
+                payload = await response.json(content_type=None)
+
+            self._token = payload['access_token']
+            self._expires_at = time.monotonic() + int(payload.get('expires_in', 3600)) - 60
+            logger.info("Получен новый access token Google API")
+            return self._token
+
+    def invalidate(self) -> None:
+        self._token = None
+
+
+class SheetsClient:
+    """Асинхронный клиент Google Sheets API v4 на aiohttp.
+
+    Использует общий пул keep-alive соединений и один токен сервисного
+    аккаунта для всех запросов.
+    """
+
+    def __init__(self, credentials_info: dict, pool_size: int = None, timeout: float = None):
+        if pool_size is None:
+            pool_size = int(os.getenv('SHEETS_POOL_SIZE', '10'))
+        if timeout is None:
+            timeout = float(os.getenv('SHEETS_TIMEOUT', '30'))
+
+        self.token = ServiceAccountToken(credentials_info)
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Сессия создается лениво, внутри работающего event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def _request(self, method: str, url: str, params=None, body: dict = None, retry_auth: bool = True) -> dict:
+        session = self._get_session()
+        token = await self.token.get(session)
+        headers = {'Authorization': f'Bearer {token}'}
+
+        async with session.request(method, url, params=params, json=body, headers=headers) as response:
+            if response.status == 401 and retry_auth:
+                self.token.invalidate()
+                return await self._request(method, url, params, body, retry_auth=False)
+
+            if response.status >= 400:
+                raise await read_error(response)
+            payload = await response.json(content_type=None)
+            return payload or {}
+
+    async def get_spreadsheet(self, spreadsheet_id: str, fields: str = 'sheets.properties') -> dict:
+        """spreadsheets.get (по умолчанию только свойства листов)"""
+        return await self._request('GET', f"{SHEETS_API_URL}/{spreadsheet_id}", params={'fields': fields})
+
+    async def values_get(self, spreadsheet_id: str, range_name: str) -> List[List[str]]:
+        """spreadsheets.values.get"""
+        url = f"{SHEETS_API_URL}/{spreadsheet_id}/values/{quote(range_name, safe='')}"
+        payload = await self._request('GET', url)
+        return payload.get('values', [])
+
+    async def values_batch_get(self, spreadsheet_id: str, ranges: List[str]) -> List[List[List[str]]]:
+        """spreadsheets.values.batchGet, значения в порядке запрошенных диапазонов"""
+        url = f"{SHEETS_API_URL}/{spreadsheet_id}/values:batchGet"
+        payload = await self._request('GET', url, params=[('ranges', r) for r in ranges])
+        return [value_range.get('values', []) for value_range in payload.get('valueRanges', [])]
+
+    async def values_append(self, spreadsheet_id: str, range_name: str, rows: List[list],
+                            value_input_option: str = 'RAW') -> dict:
+        """spreadsheets.values.append"""
+        url = f"{SHEETS_API_URL}/{spreadsheet_id}/values/{quote(range_name, safe='')}:append"
+        params = {'valueInputOption': value_input_option, 'insertDataOption': 'INSERT_ROWS'}
+        return await self._request('POST', url, params=params, body={'values': rows})
+
+    async def values_update(self, spreadsheet_id: str, range_name: str, rows: List[list],
+                            value_input_option: str = 'RAW') -> dict:
+        """spreadsheets.values.update"""
+        url = f"{SHEETS_API_URL}/{spreadsheet_id}/values/{quote(range_name, safe='')}"
+        params = {'valueInputOption': value_input_option}
+        return await self._request('PUT', url, params=params, body={'values': rows})
+
+    async def values_clear(self, spreadsheet_id: str, range_name: str) -> dict:
+        """spreadsheets.values.clear"""
+        url = f"{SHEETS_API_URL}/{spreadsheet_id}/values/{quote(range_name, safe='')}:clear"
+        return await self._request('POST', url, body={})
+
+    async def batch_update(self, spreadsheet_id: str, requests: List[dict]) -> dict:
+        """spreadsheets.batchUpdate"""
+        url = f"{SHEETS_API_URL}/{spreadsheet_id}:batchUpdate"
+        return await self._request('POST', url, body={'requests': requests})
+
+    async def add_worksheet(self, spreadsheet_id: str, title: str, rows: int = 100, cols: int = 10) -> dict:
+        """Создает лист через batchUpdate/addSheet"""
+        return await self.batch_update(spreadsheet_id, [{
+            'addSheet': {
+                'properties': {
+                    'title': title,
+                    'gridProperties': {'rowCount': rows, 'columnCount': cols}
+                }
+            }
+        }])
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+class SheetsGateway:
+    """Асинхронный шлюз к Google Sheets для обработчиков бота.
+
+    Ограничивает количество одновременных запросов глобально и для каждой
+    таблицы, чтобы одна медленная таблица не занимала все соединения.
+    Все запросы проходят через квоты чтения и записи (quota.QuotaScheduler),
+    а ответы 429 и 5xx повторяются с экспоненциальной задержкой. После
+    нескольких сбоев подряд (5xx, таймауты, ошибки соединения) предохранитель
+    размыкается, и запросы сразу завершаются SheetsUnavailableError.
+
+    Одинаковые одновременные чтения (тот же метод, таблица и диапазон)
+    объединяются: выполняется один запрос, остальные вызовы получают его
+    результат. Интерактивный вызов не присоединяется к фоновому чтению,
+    чтобы не ждать в очереди квоты за фоновыми запросами. Результаты чтений
+    общие, изменять их нельзя. Запись в
+    таблицу отсоединяет идущие чтения, поэтому вызовы после записи
+    не получают данные, прочитанные до нее.
+    """
+
+    def __init__(self, max_concurrent: int = None, max_per_sheet: int = None,
+                 max_retries: int = None, quota: QuotaScheduler = None):
+        if max_concurrent is None:
+            max_concurrent = int(os.getenv('SHEETS_MAX_CONCURRENT', '16'))
+        if max_per_sheet is None:
+            max_per_sheet = int(os.getenv('SHEETS_MAX_PER_SHEET', '2'))
+        if max_retries is None:
+            max_retries = int(os.getenv('SHEETS_MAX_RETRIES', '5'))
+
+        self.client: Optional[SheetsClient] = None
+        self.max_per_sheet = max_per_sheet
+        self.max_retries = max_retries
+        self.quota = quota or QuotaScheduler()
+        self.breaker = CircuitBreaker("Google Sheets")
+        self.retries = 0
+        self._global_semaphore = asyncio.Semaphore(max_concurrent)
+        # sheet_id -> [семафор, количество ожидающих/выполняющихся вызовов]
+        self._sheet_slots: Dict[str, list] = {}
+        # sheet_id -> свойства листов (название, числовой id), отсортированные по порядку
+        self._worksheet_props = LRUCache(
+            maxsize=int(os.getenv('SHEETS_PROPS_CACHE_SIZE', '1000')),
+            ttl=float(os.getenv('SHEETS_PROPS_CACHE_TTL', '600'))
+        )
+        # sheet_id -> {(метод, аргументы): (приоритет, задача чтения)}
+        self._reads: Dict[str, Dict[tuple, Tuple[int, asyncio.Task]]] = {}
+
+    def configure(self, client: SheetsClient) -> None:
+        """Устанавливает клиент Sheets API"""
+        self.client = client
+
+    @property
+    def available(self) -> bool:
+        return self.client is not None
+
+    @property
+    def degraded(self) -> bool:
+        """Google Sheets недавно не отвечал: доступны только закэшированные данные"""
+        return not self.breaker.closed
+
+    @asynccontextmanager
+    async def _sheet_slot(self, sheet_id: str):
+        """Ограничивает количество одновременных запросов к одной таблице"""
+        slot = self._sheet_slots.get(sheet_id)
+        if slot is None:
+            slot = [asyncio.Semaphore(self.max_per_sheet), 0]
+            self._sheet_slots[sheet_id] = slot
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0:
+                # Освобождаем семафор, чтобы словарь не рос с числом таблиц
+                self._sheet_slots.pop(sheet_id, None)
+
+    async def _run(self, sheet_id: str, method, *args, write: bool = False):
+        """Выполняет запрос к API; одинаковые одновременные чтения выполняются одним запросом"""
+        if write:
+            self._reads.pop(sheet_id, None)
+            try:
+                return await self._call(sheet_id, method, *args, write=True)
+            finally:
+                # Чтения, начатые во время записи, могли ее не увидеть
+                self._reads.pop(sheet_id, None)
+
+        operation = method.__name__
+        key = (operation,) + tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
+        priority = current_priority()
+        reads = self._reads.setdefault(sheet_id, {})
+        # Задача идет с приоритетом начавшего ее вызова: интерактивный вызов
+        # не ждет фоновое чтение в очереди квоты, а начинает свое
+        running = reads.get(key)
+        if running is not None and running[0] <= priority:
+            sheets_reads.inc(operation=operation, result='coalesced')
+            # Запрос пишется в трассу начавшего его вызова, здесь - только ожидание
+            with span('sheets', f"{operation}:shared"):
+                return await asyncio.shield(running[1])
+
+        sheets_reads.inc(operation=operation, result='fetched')
+        task = asyncio.create_task(self._call(sheet_id, method, *args))
+        reads[key] = (priority, task)
+        task.add_done_callback(lambda done: self._read_finished(sheet_id, key, done))
+        # Отмена одного из вызовов не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    def _read_finished(self, sheet_id: str, key: tuple, task: asyncio.Task) -> None:
+        reads = self._reads.get(sheet_id)
+        if reads is not None and reads.get(key, (None, None))[1] is task:
+            del reads[key]
+            if not reads:
+                del self._reads[sheet_id]
+        # Если все вызовы отменены, ошибку никто не заберет
+        if not task.cancelled():
+            task.exception()
+
+    @property
+    def reads_in_flight(self) -> int:
+        return sum(len(reads) for reads in self._reads.values())
+
+    async def _call(self, sheet_id: str, method, *args, write: bool = False):
+        """Выполняет запрос к API с учетом квот и ограничений параллельности"""
+        if self.client is None:
+            raise RuntimeError("Google Sheets клиент не настроен")
+
+        operation = method.__name__
+        if not self.breaker.allow():
+            sheets_requests.inc(operation=operation, status='rejected')
+            raise SheetsUnavailableError()
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                with span('sheets', 'quota_wait'):
+                    await self.quota.acquire(write)
+                started = time.perf_counter()
+                status = 'error'
+                try:
+                    # Сначала ждем слот таблицы, затем глобальный слот: запросы к одной
+                    # "горячей" таблице не занимают общие слоты, пока стоят в очереди
+                    with span('sheets', operation):
+                        async with self._sheet_slot(sheet_id):
+                            async with self._global_semaphore:
+                                result = await method(*args)
+                    status = 'ok'
+                except SheetsAPIError as e:
+                    status = str(e.status)
+                    if e.status >= 500:
+                        self.breaker.record_failure()
+                    else:
+                        # API ответил, ошибка относится к самому запросу
+                        self.breaker.record_success()
+                    if e.status not in RETRY_STATUSES or attempt == self.max_retries:
+                        raise
+                    if self.degraded:
+                        raise SheetsUnavailableError() from e
+                    if e.status == 429:
+                        self.quota.throttle(write)
+                    delay = backoff_delay(attempt)
+                    self.retries += 1
+                    logger.warning("Sheets API %s для таблицы %s, повтор через %.1f с (попытка %s)", e.status, sheet_id, delay, attempt + 1)
+                except asyncio.TimeoutError:
+                    status = 'timeout'
+                    self.breaker.record_failure()
+                    raise
+                except aiohttp.ClientError:
+                    self.breaker.record_failure()
+                    raise
+                except Exception:
+                    # Неожиданный ответ (например, не JSON) - тоже сбой, иначе пробный
+                    # запрос полуоткрытого предохранителя так и не получит результата
+                    self.breaker.record_failure()
+                    raise
+                else:
+                    self.breaker.record_success()
+                    return result
+                finally:
+                    sheets_requests.inc(operation=operation, status=status)
+                    sheets_request_seconds.observe(time.perf_counter() - started, operation=operation)
+                # Ждем без занятых слотов, чтобы не задерживать другие таблицы
+                await asyncio.sleep(delay)
+        except BaseException:
+            # Пробный запрос завершился без ответа API (отмена, ошибка до запроса); после record_* ничего не меняет
+            self.breaker.abandon()
+            raise
+
+    async def _worksheets(self, sheet_id: str, refresh: bool = False) -> List[dict]:
+        if not refresh:
+            cached = self._worksheet_props.get(sheet_id)
+            if cached is not None:
+                return cached
+
+        payload = await self._run(sheet_id, self.client.get_spreadsheet, sheet_id)
+        sheets_props = [s['properties'] for s in payload.get('sheets', [])]
+        sheets_props.sort(key=lambda p: p.get('index', 0))
+        self._worksheet_props.set(sheet_id, sheets_props)
+        return sheets_props
+
+    async def _first_worksheet(self, sheet_id: str) -> Tuple[str, int]:
+        sheets_props = await self._worksheets(sheet_id)
+        if not sheets_props:
+            raise SheetsAPIError(404, f"В таблице {sheet_id} нет листов")
+        return sheets_props[0]['title'], sheets_props[0].get('sheetId', 0)
+
+    async def _range(self, sheet_id: str, worksheet: Optional[str], cells: str = '') -> str:
+        if worksheet is None:
+            worksheet, _ = await self._first_worksheet(sheet_id)
+        title = quote_worksheet(worksheet)
+        return f"{title}!{cells}" if cells else title
+
+    async def _on_first_worksheet(self, sheet_id: str, worksheet: Optional[str], operation):
+        """Выполняет операцию над листом; при переименовании первого листа повторяет ее"""
+        try:
+            return await operation(await self._range(sheet_id, worksheet))
+        except SheetsAPIError as e:
+            if worksheet is not None or e.status != 400:
+                raise
+            self._worksheet_props.invalidate(sheet_id)
+            return await operation(await self._range(sheet_id, worksheet))
+
+    async def get_all_values(self, sheet_id: str, worksheet: Optional[str] = None) -> List[List[str]]:
+        """Возвращает все значения листа (по умолчанию первого)"""
+        return await self._on_first_worksheet(
+            sheet_id, worksheet,
+            lambda range_name: self._run(sheet_id, self.client.values_get, sheet_id, range_name)
+        )
+
+    async def get_cells(self, sheet_id: str, cells: str, worksheet: Optional[str] = None) -> List[List[str]]:
+        """Возвращает значения диапазона листа (по умолчанию первого), например '1:1' или 'A:A'"""
+        return await self._on_first_worksheet(
+            sheet_id, worksheet,
+            lambda range_name: self._run(sheet_id, self.client.values_get, sheet_id, f"{range_name}!{cells}")
+        )
+
+    async def get_values(self, sheet_id: str, range_name: str) -> List[List[str]]:
+        """Возвращает значения диапазона в A1-нотации"""
+        return (await self.batch_get(sheet_id, [range_name]))[0]
+
+    async def batch_get(self, sheet_id: str, ranges: List[str]) -> List[List[List[str]]]:
+        """Возвращает значения нескольких диапазонов одним запросом"""
+        try:
+            return await self._run(sheet_id, self.client.values_batch_get, sheet_id, ranges)
+        except SheetsAPIError as e:
+            if e.status == 400:
+                # Диапазон мог сослаться на переименованный или удаленный лист
+                self._worksheet_props.invalidate(sheet_id)
+            raise
+
+    async def worksheet_titles(self, sheet_id: str) -> List[str]:
+        """Возвращает названия листов по порядку (первый - основной лист)"""
+        return [p['title'] for p in await self._worksheets(sheet_id)]
+
+    async def append_row(self, sheet_id: str, row: list, worksheet: Optional[str] = None) -> None:
+        """Добавляет строку в конец листа"""
+        await self.append_rows(sheet_id, [row], worksheet)
+
+    async def append_rows(self, sheet_id: str, rows: List[list], worksheet: Optional[str] = None) -> None:
+        """Добавляет несколько строк в конец листа одним запросом"""
+        await self._on_first_worksheet(
+            sheet_id, worksheet,
+            lambda range_name: self._run(sheet_id, self.client.values_append, sheet_id, range_name, rows, write=True)
+        )
+
+    async def update_cell(self, sheet_id: str, row: int, col: int, value) -> None:
+        """Обновляет ячейку первого листа"""
+        cell = f"{column_letter(col)}{row}"
+        await self._on_first_worksheet(
+            sheet_id, None,
+            lambda range_name: self._run(
+                sheet_id, self.client.values_update, sheet_id, f"{range_name}!{cell}", [[value]], write=True
+            )
+        )
+
+    async def format(self, sheet_id: str, range_name: str, cell_format: dict, worksheet: Optional[str] = None) -> None:
+        """Форматирует диапазон ячеек"""
+        if worksheet is None:
+            _, worksheet_id = await self._first_worksheet(sheet_id)
+        else:
+            props = await self._worksheets(sheet_id)
+            if not any(p['title'] == worksheet for p in props):
+                props = await self._worksheets(sheet_id, refresh=True)
+            worksheet_id = next(p['sheetId'] for p in props if p['title'] == worksheet)
+
+        fields = ','.join(f"userEnteredFormat.{key}" for key in cell_format)
+        await self.batch_update(sheet_id, {'requests': [{
+            'repeatCell': {
+                'range': a1_to_grid_range(range_name, worksheet_id),
+                'cell': {'userEnteredFormat': cell_format},
+                'fields': fields
+            }
+        }]})
+
+    async def clear(self, sheet_id: str) -> None:
+        """Очищает первый лист"""
+        await self._on_first_worksheet(
+            sheet_id, None,
+            lambda range_name: self._run(sheet_id, self.client.values_clear, sheet_id, range_name, write=True)
+        )
+
+    async def has_worksheet(self, sheet_id: str, title: str) -> bool:
+        """Проверяет, существует ли лист с указанным названием"""
+        return any(p['title'] == title for p in await self._worksheets(sheet_id, refresh=True))
+
+    async def add_worksheet(self, sheet_id: str, title: str, rows: int = 100, cols: int = 10) -> None:
+        """Создает новый лист"""
+        await self._run(sheet_id, self.client.add_worksheet, sheet_id, title, rows, cols, write=True)
+        self._worksheet_props.invalidate(sheet_id)
+
+    async def first_worksheet_id(self, sheet_id: str) -> int:
+        """Возвращает числовой id первого листа (нужен для batch_update)"""
+        _, worksheet_id = await self._first_worksheet(sheet_id)
+        return worksheet_id
+
+    async def batch_update(self, sheet_id: str, body: dict) -> dict:
+        """Выполняет spreadsheets.batchUpdate"""
+        return await self._run(sheet_id, self.client.batch_update, sheet_id, body['requests'], write=True)
+
+    async def close(self) -> None:
+        """Закрывает пул HTTP-соединений"""
+        if self.client is not None:
+            await self.client.close()
+
+
+# Глобальный экземпляр шлюза Google Sheets
+sheets = SheetsGateway()
+
+registry.track_cache('worksheet_props', sheets._worksheet_props)
+registry.gauge('sheets_breaker_open', 'Предохранитель Google Sheets разомкнут (1) или замкнут (0)',
+               lambda: int(sheets.degraded))
+registry.gauge('sheets_reads_in_flight', 'Выполняющиеся чтения, к которым могут присоединиться другие вызовы',
+               lambda: sheets.reads_in_flight)
+registry.gauge('sheets_retries_total', 'Повторы запросов после 429 и 5xx', lambda: sheets.retries, kind='counter')
+registry.gauge('sheets_quota_queued', 'Запросы, ожидающие квоты', lambda: {
+    (name,): bucket['queued'] for name, bucket in sheets.quota.stats().items()
+}, ('bucket',))
+registry.gauge('sheets_quota_throttled_total', 'Ответы 429 по квотам', lambda: {
+    (name,): bucket['throttled'] for name, bucket in sheets.quota.stats().items()
+}, ('bucket',), kind='counter')
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict
+
+from cache import LRUCache
+from quota import background
+
+logger = logging.getLogger(__name__)
+
+
+class StatusService:
+    """Снимки статуса таблиц по схеме stale-while-revalidate.
+
+    Снимок (количество записей, последняя запись, схема) строится функцией
+    build и считается свежим ttl секунд. Свежий снимок отдается сразу;
+    устаревший тоже отдается сразу, а новый строится в фоне. Одновременные
+    запросы по одной таблице ждут одного и того же построения.
+    """
+
+    def __init__(self, build: Callable[[str], Awaitable[dict]], ttl: float = None, maxsize: int = None):
+        if ttl is None:
+            ttl = float(os.getenv('STATUS_SNAPSHOT_TTL', '60'))
+        if maxsize is None:
+            maxsize = int(os.getenv('STATUS_SNAPSHOT_CACHE_SIZE', '1000'))
+
+        self.build = build
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        # sheet_id -> задача построения снимка
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.refreshes = 0
+        self.shared = 0
+
+    async def get(self, sheet_id: str) -> dict:
+        """Возвращает снимок статуса таблицы"""
+        snapshot = self.cache.get(sheet_id)
+        if snapshot is not None:
+            return snapshot
+
+        stale = self.cache.get_stale(sheet_id)
+        if stale is not None:
+            self._refresh(sheet_id, in_background=True)
+            return stale
+
+        # Отмена одного из ожидающих не отменяет общее построение
+        return await asyncio.shield(self._refresh(sheet_id))
+
+    def invalidate(self, sheet_id: str) -> None:
+        """Сбрасывает снимок после изменения таблицы (построение в процессе не сохранится)"""
+        self.cache.invalidate(sheet_id)
+        self._inflight.pop(sheet_id, None)
+
+    def _refresh(self, sheet_id: str, in_background: bool = False) -> asyncio.Task:
+        task = self._inflight.get(sheet_id)
+        if task is not None:
+            self.shared += 1
+            return task
+
+        task = asyncio.create_task(self._build(sheet_id, in_background), name=f"status-{sheet_id}")
+        self._inflight[sheet_id] = task
+        task.add_done_callback(lambda done: self._finished(sheet_id, done))
+        return task
+
+    async def _build(self, sheet_id: str, in_background: bool) -> dict:
+        self.refreshes += 1
+        try:
+            if in_background:
+                # Обновление снимка уступает квоту запросам пользователей
+                with background():
+                    snapshot = await self.build(sheet_id)
+            else:
+                snapshot = await self.build(sheet_id)
+        except Exception as e:
+            if in_background:
+                logger.warning("Не удалось обновить статус таблицы %s: %s", sheet_id, e)
+            raise
+
+        # Если таблицу изменили во время построения, снимок уже устарел
+        if self._inflight.get(sheet_id) is asyncio.current_task():
+            self.cache.set(sheet_id, snapshot)
+        return snapshot
+
+    def _finished(self, sheet_id: str, task: asyncio.Task) -> None:
+        if self._inflight.get(sheet_id) is task:
+            del self._inflight[sheet_id]
+        # Ошибку фонового обновления уже записали в лог
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.cache),
+            'refreshes': self.refreshes,
+            'shared': self.shared,
+            'in_flight': len(self._inflight)
+        }
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Запуск бота в нескольких процессах
+
+Процесс-приемщик получает обновления от Telegram (long polling) и раздает
+их WORKERS рабочим процессам. Пользователь всегда попадает в один и тот же
+процесс (user_id по модулю числа процессов), поэтому шаги его диалога
+обрабатываются по порядку. Рабочие процессы делят общую базу SQLite, а
+клиенты Google Sheets, кэши и хранилище состояний у каждого свои.
+
+Запуск: WORKERS=4 python supervisor.py
+"""
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import signal
+from typing import Optional, Dict, List
+
+import aiohttp
+
+from logging_setup import setup_logging
+
+logger = logging.getLogger("supervisor")
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+# Маркер остановки рабочего процесса
+_STOP = None
+
+
+def shard_for(user_id, workers: int) -> int:
+    """Номер рабочего процесса для пользователя"""
+    if user_id is None:
+        return 0
+    return int(user_id) % workers
+
+
+def update_user_id(update: dict) -> Optional[int]:
+    """user_id (или chat_id) из необработанного обновления Telegram"""
+    for key, event in update.items():
+        if not isinstance(event, dict):
+            continue
+        user = event.get('from') or event.get('user')
+        if user:
+            return user['id']
+        chat = event.get('chat')
+        if chat:
+            return chat['id']
+    return None
+
+
+class UpdateSequencer:
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя"""
+
+    def __init__(self, dispatcher, bot, max_in_flight: int):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self._slots = asyncio.Semaphore(max_in_flight)
+        # user_id -> задача последнего обновления пользователя
+        self._chains: Dict[Optional[int], asyncio.Task] = {}
+
+    async def submit(self, raw_update: dict) -> None:
+        from aiogram.types import Update
+
+        await self._slots.acquire()
+        user_id = update_user_id(raw_update)
+        update = Update.model_validate(raw_update, context={"bot": self.bot})
+        previous = self._chains.get(user_id)
+        task = asyncio.create_task(self._process(update, previous))
+        self._chains[user_id] = task
+        task.add_done_callback(lambda done, key=user_id: self._release(key, done))
+
+    def _release(self, user_id, task: asyncio.Task) -> None:
+        if self._chains.get(user_id) is task:
+            del self._chains[user_id]
+        self._slots.release()
+
+    async def _process(self, update, previous: Optional[asyncio.Task]) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception as e:
+            logger.error("❌ Ошибка при обработке обновления %s: %s", update.update_id, e)
+
+    async def drain(self) -> None:
+        """Дожидается обработки принятых обновлений"""
+        if self._chains:
+            await asyncio.wait(list(self._chains.values()))
+
+
+def run_worker(index: int, workers: int, queue) -> None:
+    """Точка входа рабочего процесса"""
+    os.environ['WORKER_INDEX'] = str(index)
+    # Квоты Google Sheets делятся между процессами (см. quota.QuotaScheduler)
+    os.environ['WORKERS'] = str(workers)
+    # Остановкой управляет приемщик через маркер в очереди
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    import bot as worker_bot
+    asyncio.run(_worker_main(worker_bot, index, workers, queue))
+
+
+async def _worker_main(worker_bot, index: int, workers: int, queue) -> None:
+    logger.info("👷 Рабочий процесс %s запущен (PID %s)", index, os.getpid())
+    # Журнал пользователей своего сегмента синхронизирует только этот процесс
+    worker_bot.append_queue.shard = (index, workers)
+    await worker_bot.on_startup()
+
+    loop = asyncio.get_running_loop()
+    sequencer = UpdateSequencer(
+        worker_bot.dp, worker_bot.bot,
+        max_in_flight=int(os.getenv('WORKER_MAX_IN_FLIGHT', '100'))
+    )
+    try:
+        while True:
+            raw_update = await loop.run_in_executor(None, queue.get)
+            if raw_update is _STOP:
+                break
+            await sequencer.submit(raw_update)
+        await sequencer.drain()
+    finally:
+        await worker_bot.on_shutdown()
+        logger.info("Рабочий процесс %s остановлен", index)
+
+
+class Supervisor:
+    """Прием обновлений и распределение их по рабочим процессам.
+
+    Упавший рабочий процесс перезапускается с новой очередью: старая могла
+    остаться заблокированной процессом, завершившимся посреди чтения, и
+    обновления из нее теряются. Если очередь процесса не освобождается
+    put_timeout секунд, обновление отбрасывается, чтобы один сегмент не
+    останавливал прием для всех.
+    """
+
+    def __init__(self, token: str, workers: int = None, queue_size: int = None, poll_timeout: int = 30,
+                 put_timeout: float = None, stop_timeout: float = None):
+        if workers is None:
+            workers = int(os.getenv('WORKERS', str(os.cpu_count() or 1)))
+        if queue_size is None:
+            queue_size = int(os.getenv('WORKER_QUEUE_SIZE', '1000'))
+        if put_timeout is None:
+            put_timeout = float(os.getenv('WORKER_PUT_TIMEOUT', '10'))
+        if stop_timeout is None:
+            stop_timeout = float(os.getenv('WORKER_STOP_TIMEOUT', '30'))
+
+        self.token = token
+        self.workers = max(workers, 1)
+        self.queue_size = queue_size
+        self.poll_timeout = poll_timeout
+        self.put_timeout = put_timeout
+        self.stop_timeout = stop_timeout
+        self.restarts = 0
+        self.dropped = 0
+        # spawn: каждый процесс импортирует бота заново и получает свои глобальные объекты
+        self._context = multiprocessing.get_context('spawn')
+        self._queues: List = []
+        self._processes: List = []
+        self._stopping = asyncio.Event()
+
+    def _api_url(self, method: str) -> str:
+        return f"{TELEGRAM_API_URL}/bot{self.token}/{method}"
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=run_worker, args=(index, self.workers, self._queues[index]),
+            name=f"bot-worker-{index}", daemon=False
+        )
+        process.start()
+        return process
+
+    def start_workers(self) -> None:
+        for index in range(self.workers):
+            self._queues.append(self._context.Queue(maxsize=self.queue_size))
+            self._processes.append(self._spawn(index))
+        logger.info("✅ Запущено рабочих процессов: %s", self.workers)
+
+    def _ensure_alive(self, index: int) -> None:
+        """Перезапускает рабочий процесс, если он завершился"""
+        process = self._processes[index]
+        if process.is_alive() or self._stopping.is_set():
+            return
+        old_queue = self._queues[index]
+        try:
+            lost = old_queue.qsize()
+        except NotImplementedError:
+            lost = 'неизвестно'
+        logger.error("❌ Рабочий процесс %s завершился (код %s), перезапускаем; потеряно обновлений: %s",
+                     index, process.exitcode, lost)
+        process.join()
+        old_queue.cancel_join_thread()
+        old_queue.close()
+        self._queues[index] = self._context.Queue(maxsize=self.queue_size)
+        self._processes[index] = self._spawn(index)
+        self.restarts += 1
+
+    async def watch_workers(self, interval: float = 1.0) -> None:
+        """Следит за рабочими процессами и перезапускает упавшие"""
+        while not self._stopping.is_set():
+            for index in range(self.workers):
+                self._ensure_alive(index)
+            await asyncio.sleep(interval)
+
+    async def stop_workers(self) -> None:
+        loop = asyncio.get_running_loop()
+        for queue, process in zip(self._queues, self._processes):
+            if not process.is_alive():
+                continue
+            try:
+                await loop.run_in_executor(None, functools.partial(queue.put, _STOP, timeout=self.stop_timeout))
+            except queue_module.Full:
+                logger.warning("Очередь процесса %s переполнена, он будет остановлен принудительно", process.name)
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, self.stop_timeout)
+            if process.is_alive():
+                logger.warning("Рабочий процесс %s не остановился за %s с, завершаем", process.name, self.stop_timeout)
+                process.terminate()
+                await loop.run_in_executor(None, process.join)
+        logger.info("Рабочие процессы остановлены")
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    async def _dispatch(self, raw_update: dict) -> None:
+        index = shard_for(update_user_id(raw_update), self.workers)
+        self._ensure_alive(index)
+        # Очередь ограничена: если процесс не успевает, прием обновлений ждет, но не дольше put_timeout
+        put = functools.partial(self._queues[index].put, raw_update, timeout=self.put_timeout)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, put)
+        except (queue_module.Full, ValueError):
+            # ValueError: очередь закрыта, пока ждали места (процесс перезапущен)
+            self.dropped += 1
+            logger.error("❌ Очередь процесса %s переполнена, обновление %s отброшено", index, raw_update.get('update_id'))
+
+    async def poll(self) -> None:
+        """Long polling getUpdates с раздачей обновлений по процессам"""
+        timeout = aiohttp.ClientTimeout(total=self.poll_timeout + 10)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.post(self._api_url('deleteWebhook'), json={'drop_pending_updates': True}) as response:
+                await response.read()
+            logger.info("🔄 Начинаем polling...")
+
+            offset = None
+            while not self._stopping.is_set():
+                try:
+                    async with session.post(self._api_url('getUpdates'), json={
+                        'offset': offset, 'timeout': self.poll_timeout
+                    }) as response:
+                        payload = await response.json(content_type=None)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.warning("Ошибка getUpdates: %s", e)
+                    await asyncio.sleep(1)
+                    continue
+
+                if not payload.get('ok'):
+                    retry_after = payload.get('parameters', {}).get('retry_after', 1)
+                    logger.warning("getUpdates вернул ошибку: %s", payload.get('description'))
+                    await asyncio.sleep(retry_after)
+                    continue
+
+                for raw_update in payload['result']:
+                    await self._dispatch(raw_update)
+                    offset = raw_update['update_id'] + 1
+
+    async def run(self) -> None:
+        self.start_workers()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        poll_task = asyncio.create_task(self.poll())
+        watch_task = asyncio.create_task(self.watch_workers())
+        await self._stopping.wait()
+        poll_task.cancel()
+        watch_task.cancel()
+        await asyncio.gather(poll_task, watch_task, return_exceptions=True)
+        await self.stop_workers()
+
+
+async def prepare_database() -> None:
+    """Миграции выполняются один раз до запуска рабочих процессов"""
+    from database import db
+    await db.init()
+    await db.close()
+
+
+def main():
+    setup_logging(text_format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s')
+    token = os.getenv('BOT_TOKEN')
+    if not token:
+        raise ValueError("BOT_TOKEN не найден в переменных окружения")
+
+    asyncio.run(prepare_database())
+    supervisor = Supervisor(token)
+    logger.info("🚀 Запуск бота в %s процессах...", supervisor.workers)
+    asyncio.run(supervisor.run())
+
+
+if __name__ == "__main__":
+    main()
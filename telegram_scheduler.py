@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Any
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod, EditMessageText, EditMessageReplyMarkup
+from aiogram.methods.base import Response, TelegramType
+
+from quota import TokenBucket, worker_count
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Правки, которые можно схлопнуть: до отправки важна только последняя
+MERGEABLE_EDITS = (EditMessageText, EditMessageReplyMarkup)
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Middleware сессии бота, распределяющая исходящие сообщения во времени.
+
+    Учитывает ограничения Telegram: около 30 сообщений в секунду на бота,
+    в среднем не чаще раза в секунду в личный чат (с коротким всплеском до
+    chat_burst сообщений, например ответ и правка в одном шаге) и
+    20 сообщений в минуту в группу.
+    Запросы без chat_id (ответы на callback, служебные методы) проходят
+    без задержки. Если несколько правок одного сообщения ждут своей
+    очереди, отправляется только последняя. При RetryAfter запрос
+    повторяется после указанной паузы, а общий запас сбрасывается.
+    Общий лимит бота в рабочих процессах supervisor.py делится на WORKERS;
+    лимиты чатов не делятся: каждый чат обслуживает один процесс.
+    """
+
+    def __init__(self, global_rate: float = None, chat_interval: float = None,
+                 group_interval: float = None, chat_burst: int = None, max_retries: int = None):
+        if global_rate is None:
+            global_rate = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+        if chat_interval is None:
+            chat_interval = float(os.getenv('TELEGRAM_CHAT_INTERVAL', '1'))
+        if group_interval is None:
+            group_interval = float(os.getenv('TELEGRAM_GROUP_INTERVAL', '3'))
+        if chat_burst is None:
+            chat_burst = int(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+        if max_retries is None:
+            max_retries = int(os.getenv('TELEGRAM_MAX_RETRIES', '3'))
+
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.chat_burst = max(chat_burst, 1)
+        self.max_retries = max_retries
+        # Лимит на бота общий для всех процессов
+        global_rate /= worker_count()
+        self._global = TokenBucket(global_rate * 60, max(global_rate, 1))
+        # chat_id -> расчетный момент отправки следующего сообщения без всплеска (GCRA)
+        self._chat_next: Dict[Any, float] = {}
+        # (тип правки, chat_id, message_id) -> ожидающая отправки правка
+        self._pending_edits: Dict[tuple, dict] = {}
+
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+        self.failed = 0
+        self.delayed = 0
+        self.delay_seconds = 0.0
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        with span('telegram', type(method).__name__):
+            return await self._schedule(make_request, bot, method)
+
+    async def _schedule(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        if isinstance(method, MERGEABLE_EDITS):
+            key = (type(method), chat_id, method.message_id)
+            entry = self._pending_edits.get(key)
+            if entry is not None:
+                # Более ранняя правка еще не отправлена: отправим вместо нее эту
+                entry['method'] = method
+                self.merged += 1
+                return await asyncio.shield(entry['future'])
+
+            future = asyncio.get_running_loop().create_future()
+            entry = {'method': method, 'future': future}
+            self._pending_edits[key] = entry
+            try:
+                try:
+                    await self._wait_turn(chat_id)
+                finally:
+                    self._pending_edits.pop(key, None)
+                response = await self._send(make_request, bot, entry['method'], chat_id)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                # Помечаем исключение полученным: объединенных правок может и не быть
+                future.exception()
+                raise
+            future.set_result(response)
+            return response
+
+        await self._wait_turn(chat_id)
+        return await self._send(make_request, bot, method, chat_id)
+
+    def _interval(self, chat_id) -> float:
+        # Отрицательные id у групп и каналов
+        return self.group_interval if isinstance(chat_id, int) and chat_id < 0 else self.chat_interval
+
+    async def _wait_turn(self, chat_id) -> None:
+        """Резервирует место в очереди чата и глобальный токен"""
+        now = time.monotonic()
+        interval = self._interval(chat_id)
+        expected = max(now, self._chat_next.get(chat_id, now))
+        # Всплеск допускается, пока чат опережает средний темп не больше чем на chat_burst сообщений
+        send_at = max(now, expected - interval * (self.chat_burst - 1))
+        self._chat_next[chat_id] = expected + interval
+        if len(self._chat_next) > 10000:
+            self._chat_next = {key: value for key, value in self._chat_next.items() if value > now}
+
+        delay = send_at - now
+        if delay > 0:
+            self.delayed += 1
+            self.delay_seconds += delay
+            await asyncio.sleep(delay)
+        await self._global.acquire()
+
+    async def _send(self, make_request, bot, method, chat_id):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await make_request(bot, method)
+                self.sent += 1
+                return response
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+                self.retried += 1
+                self._global.throttle()
+                # Следующие сообщения в этот чат ждут окончания паузы без всплеска
+                self._chat_next[chat_id] = (
+                    time.monotonic() + e.retry_after + self._interval(chat_id) * self.chat_burst
+                )
+                logger.warning("Flood control Telegram для чата %s: повтор через %s с", chat_id, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+                await self._global.acquire()
+
+    def stats(self) -> dict:
+        """Счетчики отправленных, объединенных и задержанных запросов"""
+        return {
+            'sent': self.sent,
+            'merged': self.merged,
+            'retried': self.retried,
+            'failed': self.failed,
+            'delayed': self.delayed,
+            'delay_seconds': round(self.delay_seconds, 3),
+            'pending_edits': len(self._pending_edits),
+            'global_queued': self._global.queued
+        }
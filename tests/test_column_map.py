@@ -0,0 +1,73 @@
+from column_map import ColumnMap, compile_column_map
+
+HEADERS = ("Время", "Сон", "Сон (часы)", "Настроение (0-10)", "Комментарий")
+
+
+def legacy_assemble(headers: list, timestamp: str, values: dict) -> list:
+    """Прежний алгоритм save_complete_data (совпадение по подстроке)"""
+    row = [timestamp]
+    for header in headers[1:]:
+        value = ''
+        for name, measurement_value in values.items():
+            if name.lower() in header.lower() or header.lower() in name.lower():
+                value = measurement_value
+                break
+        row.append(value)
+    return row
+
+
+def test_exact_match():
+    column_map = ColumnMap(HEADERS)
+    assert column_map.column_for("Сон") == 1
+    # Без учета регистра и лишних пробелов
+    assert column_map.column_for("  сон   (ЧАСЫ) ") == 2
+    assert column_map.column_for("Настроение (0-10)") == 3
+
+
+def test_base_name_fallback():
+    column_map = ColumnMap(HEADERS)
+    assert column_map.column_for("Настроение") == 3
+
+
+def test_exact_match_wins_over_base_name():
+    # "Сон" совпадает и с "Сон", и с базовым названием "Сон (часы)"
+    assert ColumnMap(HEADERS).column_for("Сон") == 1
+
+
+def test_ambiguous_base_name_is_not_mapped():
+    column_map = ColumnMap(("Время", "Сон (часы)", "Сон (качество)"))
+    assert column_map.column_for("Сон") is None
+    assert column_map.column_for("Сон (качество)") == 2
+
+
+def test_unmatched_measurement():
+    column_map = ColumnMap(HEADERS)
+    # Подстрока заголовка не считается совпадением
+    assert column_map.column_for("Комм") is None
+
+    row, unmatched = column_map.assemble("2024-01-01 10:00", {"Сон (часы)": "7", "Настроение": "5", "Энергия": "3"})
+    assert row == ["2024-01-01 10:00", "", "7", "5", ""]
+    assert unmatched == ["Энергия"]
+
+
+def test_parity_with_legacy_layout():
+    # Там, где названия не пересекаются, строка совпадает с прежней
+    headers = ["Время", "Настроение", "Энергия", "Сон", "Комментарий"]
+    values = {"Настроение": "7", "Энергия": "5", "Сон": "8", "Комментарий": "ок"}
+    row, unmatched = compile_column_map(tuple(headers)).assemble("t", values)
+    assert row == legacy_assemble(headers, "t", values)
+    assert not unmatched
+
+    # Пропущенные значения дают пустые ячейки, как и раньше
+    partial = {"Энергия": "5"}
+    assert compile_column_map(tuple(headers)).assemble("t", partial)[0] == legacy_assemble(headers, "t", partial)
+
+
+def test_wide_schema_does_not_confuse_prefixes():
+    headers = ("Время",) + tuple(f"Измерение {i} (0-10)" for i in range(1, 30))
+    values = {f"Измерение {i}": str(i) for i in range(1, 30)}
+    row, unmatched = ColumnMap(headers).assemble("t", values)
+    assert row == ["t"] + [str(i) for i in range(1, 30)]
+    assert not unmatched
+    # Старый алгоритм записывал в "Измерение 10" значение "Измерение 1"
+    assert legacy_assemble(list(headers), "t", values)[10] == "1"
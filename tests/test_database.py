@@ -0,0 +1,52 @@
+import asyncio
+import os
+
+from database import Database
+
+
+def test_cancelled_transaction_is_rolled_back(tmp_path):
+    async def scenario():
+        db = Database(os.path.join(tmp_path, 'bot.db'))
+        await db.init()
+        started = asyncio.Event()
+
+        async def cancelled_write():
+            async with db._transaction() as conn:
+                await conn.execute("INSERT INTO user_sheets (user_id, sheet_id) VALUES ('1', 'partial')")
+                started.set()
+                await asyncio.sleep(3600)
+
+        task = asyncio.create_task(cancelled_write())
+        await started.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        try:
+            # Следующая запись коммитит только свои изменения
+            assert await db.set_user_sheet('2', 'sheet')
+            assert await db.get_user_sheet('1') is None
+            assert await db.get_user_sheet('2') == 'sheet'
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_unsynced_entries_are_filtered_by_shard_before_limit(tmp_path):
+    async def scenario():
+        db = Database(os.path.join(tmp_path, 'bot.db'))
+        await db.init()
+        try:
+            # Первые записи журнала принадлежат сегменту 0
+            for _ in range(5):
+                await db.add_entry('2', 'sheet', 't', {}, ['t'])
+            await db.add_entry('3', 'sheet', 't', {}, ['t'])
+
+            entries = await db.get_unsynced_entries(limit=2, shard=(1, 2))
+            assert [entry['user_id'] for entry in entries] == ['3']
+            assert len(await db.get_unsynced_entries(limit=2, shard=(0, 2))) == 2
+            assert len(await db.get_unsynced_entries()) == 6
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,133 @@
+import asyncio
+
+import sheet_writer
+from circuit_breaker import CircuitBreaker
+from database import db
+from sheet_writer import AppendQueue
+from sheets import SheetsUnavailableError
+
+
+class FailingGateway:
+    """Шлюз, который не может записать ни одной строки"""
+
+    def __init__(self, error: Exception, breaker_open: bool):
+        self.error = error
+        self.breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=60)
+        if breaker_open:
+            self.breaker.record_failure()
+        self.attempts = 0
+
+    async def append_rows(self, sheet_id, rows, worksheet=None):
+        self.attempts += 1
+        raise self.error
+
+
+async def run_queue(gateway, duration: float, rows: int = 10) -> AppendQueue:
+    queue = AppendQueue(gateway=gateway, batch_size=2, flush_interval=0.01, max_attempts=1000)
+    for i in range(rows):
+        await queue.enqueue('sheet', [str(i)])
+    task = asyncio.create_task(queue._run())
+    await asyncio.sleep(duration)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return queue
+
+
+def test_breaker_open_pauses_writes():
+    gateway = FailingGateway(SheetsUnavailableError(), breaker_open=True)
+    queue = asyncio.run(run_queue(gateway, 0.5))
+
+    # Пачка больше batch_size, но до пробного запроса предохранителя попытка одна
+    assert gateway.attempts == 1
+    assert queue.depth == 10
+
+
+def test_errors_back_off_between_attempts():
+    gateway = FailingGateway(RuntimeError("boom"), breaker_open=False)
+    queue = asyncio.run(run_queue(gateway, 0.5))
+
+    # Без паузы между попытками их были бы тысячи
+    assert 1 <= gateway.attempts <= 20
+    assert queue.depth == 10
+
+
+class RecordingGateway:
+    def __init__(self):
+        self.breaker = CircuitBreaker("test")
+        self.appended = []
+
+    async def append_rows(self, sheet_id, rows, worksheet=None):
+        self.appended.extend(rows)
+
+
+def test_rows_are_built_right_before_append(monkeypatch):
+    async def no_db(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr(db, 'mark_entries_synced', no_db)
+    monkeypatch.setattr(db, 'add_to_sheet_summary', no_db)
+
+    async def scenario():
+        gateway = RecordingGateway()
+        queue = AppendQueue(gateway=gateway, batch_size=10, flush_interval=0.01)
+        built = []
+
+        async def build_rows(sheet_id, items):
+            built.append(len(items))
+            return [[item['recorded_at'], item['values']['Сон']] for item in items]
+
+        queue.build_rows = build_rows
+        await queue.enqueue('sheet', ['готовая строка'])
+        await queue.enqueue('sheet', None, values={'Сон': '7'}, recorded_at='t1')
+        await queue.enqueue('sheet', None, values={'Сон': '8'}, recorded_at='t2')
+        # Без start(): синхронизация с журналом здесь не нужна
+        queue._task = asyncio.create_task(queue._run())
+        await queue.stop()
+        return gateway, built
+
+    gateway, built = asyncio.run(scenario())
+    # Одна сборка на пачку, готовые строки не пересобираются, порядок сохраняется
+    assert built == [2]
+    assert gateway.appended == [['готовая строка'], ['t1', '7'], ['t2', '8']]
+
+
+class FlakyGateway(RecordingGateway):
+    """Шлюз, который первые failures попыток записи завершает ошибкой"""
+
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+
+    async def append_rows(self, sheet_id, rows, worksheet=None):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("boom")
+        await super().append_rows(sheet_id, rows, worksheet)
+
+
+def test_failed_rows_stay_ahead_of_newer_ones(monkeypatch):
+    async def no_db(*args, **kwargs):
+        return True
+
+    monkeypatch.setattr(db, 'mark_entries_synced', no_db)
+    monkeypatch.setattr(db, 'add_to_sheet_summary', no_db)
+    monkeypatch.setattr(sheet_writer, 'backoff_delay', lambda attempt: 0.01)
+
+    async def scenario():
+        gateway = FlakyGateway(failures=3)
+        queue = AppendQueue(gateway=gateway, batch_size=10, flush_interval=0.01, max_attempts=2)
+        await queue.enqueue('sheet', ['1'])
+        queue._task = asyncio.create_task(queue._run())
+        # Неудачных попыток больше, чем max_attempts
+        while gateway.failures:
+            await asyncio.sleep(0.005)
+        await queue.enqueue('sheet', ['2'])
+        await queue.stop()
+        return gateway, queue
+
+    gateway, queue = asyncio.run(scenario())
+    assert gateway.appended == [['1'], ['2']]
+    assert queue.depth == 0
@@ -0,0 +1,124 @@
+import asyncio
+import json
+
+import pytest
+
+from circuit_breaker import CLOSED, OPEN
+from quota import QuotaScheduler, background
+from sheets import SheetsAPIError, SheetsGateway, SheetsUnavailableError, read_error
+
+
+class ScriptedClient:
+    """Клиент, отвечающий по очереди заданными результатами или исключениями"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+
+    async def values_get(self, spreadsheet_id, range_name):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+
+class FakeResponse:
+    def __init__(self, status: int, body: str, reason: str = ''):
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+    async def text(self) -> str:
+        return self.body
+
+
+def test_read_error_handles_html_body():
+    error = asyncio.run(read_error(FakeResponse(502, "<html><body>Bad Gateway</body></html>", "Bad Gateway")))
+    assert isinstance(error, SheetsAPIError)
+    assert error.status == 502
+    assert "Bad Gateway" in error.message
+
+
+def test_read_error_uses_api_message():
+    body = json.dumps({'error': {'code': 400, 'message': 'Unable to parse range: Лист2'}})
+    error = asyncio.run(read_error(FakeResponse(400, body)))
+    assert (error.status, error.message) == (400, 'Unable to parse range: Лист2')
+
+    body = json.dumps({'error': 'invalid_grant', 'error_description': 'Invalid JWT Signature.'})
+    error = asyncio.run(read_error(FakeResponse(400, body)))
+    assert error.message == 'Invalid JWT Signature.'
+
+
+def make_gateway(client) -> SheetsGateway:
+    gateway = SheetsGateway(max_retries=0, quota=QuotaScheduler(6000, 6000, 100))
+    gateway.breaker.failure_threshold = 1
+    gateway.breaker.reset_timeout = 0
+    gateway.configure(client)
+    return gateway
+
+
+def test_unexpected_probe_error_reopens_breaker():
+    async def scenario():
+        client = ScriptedClient(json.JSONDecodeError("Expecting value", "<html>", 0), [['ok']])
+        gateway = make_gateway(client)
+        gateway.breaker.record_failure()
+        assert gateway.breaker.state == OPEN
+
+        # Пробный запрос падает не с ошибкой API - предохранитель снова разомкнут, а не завис
+        with pytest.raises(json.JSONDecodeError):
+            await gateway.get_cells('sheet', '1:1', worksheet='Лист1')
+        assert gateway.breaker.state == OPEN
+
+        # Следующий пробный запрос проходит и замыкает предохранитель
+        assert await gateway.get_cells('sheet', '1:1', worksheet='Лист1') == [['ok']]
+        assert gateway.breaker.state == CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_open_breaker_rejects_without_calling_api():
+    async def scenario():
+        client = ScriptedClient()
+        gateway = make_gateway(client)
+        gateway.breaker.reset_timeout = 60
+        gateway.breaker.record_failure()
+        with pytest.raises(SheetsUnavailableError):
+            await gateway.get_cells('sheet', '1:1', worksheet='Лист1')
+
+    asyncio.run(scenario())
+
+
+class SlowClient:
+    """Клиент, который отвечает с задержкой и считает запросы"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def values_get(self, spreadsheet_id, range_name):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return [['ok']]
+
+
+def test_interactive_read_does_not_join_background_one():
+    async def background_read(gateway):
+        with background():
+            return await gateway.get_cells('sheet', '1:1', worksheet='Лист1')
+
+    async def scenario():
+        client = SlowClient()
+        gateway = make_gateway(client)
+        first = asyncio.create_task(background_read(gateway))
+        await asyncio.sleep(0)
+
+        # Интерактивный вызов не ждет фоновый запрос, а делает свой
+        interactive = asyncio.create_task(gateway.get_cells('sheet', '1:1', worksheet='Лист1'))
+        await asyncio.sleep(0)
+        # Фоновый вызов присоединяется к интерактивному запросу
+        second = asyncio.create_task(background_read(gateway))
+        await asyncio.sleep(0)
+        results = await asyncio.gather(first, interactive, second)
+        return client.calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert calls == 2
+    assert results == [[['ok']]] * 3
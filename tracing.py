@@ -0,0 +1,233 @@
+import collections
+import contextvars
+import cProfile
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Не больше стольких спанов в одной трассе
+MAX_SPANS = 500
+
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar('trace', default=None)
+_current_span: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar('span', default=None)
+
+
+class Trace:
+    """Трасса обработки одного обновления: дерево спанов с временем вызовов"""
+
+    def __init__(self, update_id: int, user_id: Optional[int] = None, event_type: str = ''):
+        self.update_id = update_id
+        self.user_id = user_id
+        self.event_type = event_type
+        self.handler: Optional[str] = None
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.duration = 0.0
+        self.status = 'ok'
+        self.spans: List[dict] = []
+        self.dropped_spans = 0
+        self._ids = itertools.count(1)
+
+    def offset(self) -> float:
+        return time.perf_counter() - self._started
+
+    def finish(self) -> None:
+        self.duration = self.offset()
+
+    def to_dict(self) -> dict:
+        return {
+            'update_id': self.update_id,
+            'user_id': self.user_id,
+            'event_type': self.event_type,
+            'handler': self.handler,
+            'started_at': round(self.started_at, 3),
+            'duration_ms': round(self.duration * 1000, 1),
+            'status': self.status,
+            'spans': self.spans,
+            'dropped_spans': self.dropped_spans
+        }
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(update_id: int, user_id: Optional[int] = None, event_type: str = ''):
+    """Открывает трассу обновления; вложенные span() попадают в нее"""
+    trace = Trace(update_id, user_id, event_type)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        yield trace
+    except BaseException:
+        trace.status = 'error'
+        raise
+    finally:
+        trace.finish()
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+
+@contextmanager
+def span(kind: str, name: str):
+    """Замеряет вызов внутри текущей трассы (без трассы ничего не делает)"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    span_id = next(trace._ids)
+    parent = _current_span.get()
+    token = _current_span.set(span_id)
+    start = trace.offset()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        _current_span.reset(token)
+        if len(trace.spans) < MAX_SPANS:
+            trace.spans.append({
+                'id': span_id,
+                'parent': parent,
+                'kind': kind,
+                'name': name,
+                'start_ms': round(start * 1000, 1),
+                'duration_ms': round((trace.offset() - start) * 1000, 1),
+                'status': status
+            })
+        else:
+            trace.dropped_spans += 1
+
+
+class SlowTraceWriter:
+    """Дописывает трассы медленных обновлений в файл JSON Lines"""
+
+    def __init__(self, path: str = None, threshold: float = None):
+        if path is None:
+            path = os.getenv('TRACE_FILE', 'slow_updates.jsonl')
+        if threshold is None:
+            threshold = float(os.getenv('TRACE_SLOW_THRESHOLD', '2'))
+
+        self.path = path
+        self.threshold = threshold
+        self.written = 0
+        self._lock = threading.Lock()
+
+    def should_write(self, trace: Trace) -> bool:
+        return trace.duration >= self.threshold
+
+    def write(self, trace: Trace) -> None:
+        """Синхронная запись; из event loop вызывается через asyncio.to_thread"""
+        line = json.dumps(trace.to_dict(), ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as trace_file:
+                trace_file.write(line + '\n')
+            self.written += 1
+
+
+class StackSampler:
+    """Статистический профилировщик: периодически снимает стек потока event loop.
+
+    Показывает, на что уходит процессорное время (ожидание ввода-вывода
+    в стек не попадает - для него есть спаны). Стеки записываются в
+    "свернутом" формате для flamegraph.pl / speedscope.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Dict[str, int] = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> Dict[str, int]:
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+
+class Profiler:
+    """Профилирование части обновлений по переменной окружения PROFILE_MODE.
+
+    cprofile - cProfile, результат в PROFILE_DIR/update_<id>.prof;
+    sample - StackSampler, результат в PROFILE_DIR/update_<id>.folded.
+    Профилируется доля PROFILE_SAMPLE_RATE обновлений, не больше одного
+    одновременно. Профиль охватывает весь поток event loop, поэтому в него
+    попадают и другие обновления, обрабатываемые в то же время.
+    """
+
+    def __init__(self, mode: str = None, sample_rate: float = None, directory: str = None):
+        if mode is None:
+            mode = os.getenv('PROFILE_MODE', 'off').lower()
+        if sample_rate is None:
+            sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE', '0.01'))
+        if directory is None:
+            directory = os.getenv('PROFILE_DIR', 'profiles')
+
+        self.mode = mode if mode in ('cprofile', 'sample') else 'off'
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self._active = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'off'
+
+    @contextmanager
+    def maybe_profile(self, update_id: int):
+        if not self.enabled or self._active or random.random() >= self.sample_rate:
+            yield
+            return
+
+        self._active = True
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"update_{update_id}")
+        try:
+            if self.mode == 'cprofile':
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                    profile.dump_stats(path + '.prof')
+            else:
+                sampler = StackSampler(threading.get_ident())
+                sampler.start()
+                try:
+                    yield
+                finally:
+                    samples = sampler.stop()
+                    with open(path + '.folded', 'w', encoding='utf-8') as folded_file:
+                        for stack, count in samples.items():
+                            folded_file.write(f"{stack} {count}\n")
+            logger.info("📊 Профиль обновления %s сохранен в %s", update_id, path)
+        finally:
+            self._active = False
@@ -0,0 +1,138 @@
+import asyncio
+import hmac
+import logging
+import os
+from typing import Optional, Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from metrics import registry, handle_metrics
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передает секрет вебхука
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """Прием обновлений Telegram через вебхук.
+
+    Telegram получает ответ 200 сразу после разбора обновления, а обработка
+    идет в отдельной задаче. Одновременно обрабатывается не больше
+    max_in_flight обновлений: при заполнении лимита ответ задерживается до
+    освобождения места, и Telegram сам притормаживает отправку.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, url: str = None, path: str = None,
+                 secret: str = None, host: str = None, port: int = None, max_in_flight: int = None):
+        if url is None:
+            url = os.getenv('WEBHOOK_URL', '')
+        if path is None:
+            path = os.getenv('WEBHOOK_PATH', '/webhook')
+        if secret is None:
+            secret = os.getenv('WEBHOOK_SECRET', '')
+        if host is None:
+            host = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+        if port is None:
+            port = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8080')))
+        if max_in_flight is None:
+            max_in_flight = int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '100'))
+
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.url = url
+        self.path = path
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.max_in_flight = max_in_flight
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tasks: Set[asyncio.Task] = set()
+        self._runner: Optional[web.AppRunner] = None
+        self.received = 0
+        self.failed = 0
+        registry.gauge('webhook_in_flight', 'Обновления вебхука в обработке', lambda: self.in_flight)
+
+    @property
+    def in_flight(self) -> int:
+        """Количество обновлений в обработке"""
+        return len(self._tasks)
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/health', self.handle_health)
+        app.router.add_get('/metrics', handle_metrics)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logger.warning("Некорректное обновление от вебхука: %s", e)
+            return web.Response(status=400)
+
+        await self._slots.acquire()
+        self.received += 1
+        task = asyncio.create_task(self._process(update), name=f"update-{update.update_id}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'status': 'ok',
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'received': self.received,
+            'failed': self.failed
+        })
+
+    async def _process(self, update: Update) -> None:
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception as e:
+            self.failed += 1
+            logger.error("❌ Ошибка при обработке обновления %s: %s", update.update_id, e)
+        finally:
+            self._slots.release()
+
+    async def start(self) -> None:
+        """Запускает HTTP-сервер и регистрирует вебхук в Telegram"""
+        self._runner = web.AppRunner(self.build_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("🌐 Вебхук слушает %s:%s%s (до %s обновлений одновременно)", self.host, self.port, self.path, self.max_in_flight)
+
+        if self.url:
+            await self.bot.set_webhook(
+                url=self.url.rstrip('/') + self.path,
+                secret_token=self.secret or None,
+                allowed_updates=self.dispatcher.resolve_used_update_types(),
+                max_connections=min(self.max_in_flight, 100),
+                drop_pending_updates=True
+            )
+            logger.info("✅ Вебхук зарегистрирован в Telegram")
+        else:
+            logger.warning("⚠️ WEBHOOK_URL не задан, вебхук в Telegram не регистрируется")
+
+    async def stop(self) -> None:
+        """Останавливает прием и дожидается обработки принятых обновлений"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._tasks:
+            logger.info("Ожидание обработки %s обновлений...", len(self._tasks))
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def serve(self) -> None:
+        """Работает до отмены задачи"""
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()